@@ -0,0 +1,95 @@
+"""
+Cache of file access decisions.
+
+Whether a user may open a file (before any password check) depends only on
+the file's status, visibility, owner and sharedWith set, and on who the user
+is. The decision for a (file, user) pair is cached until the file's next
+status transition, and at most `ttl` seconds, so it is never served past the
+moment it could change on its own. Deleting or changing a file must call
+invalidate(), which drops every decision about it.
+"""
+
+import threading
+from collections import OrderedDict
+
+from records import FileRecord
+
+US_PER_SECOND = 1_000_000
+
+# Decisions, in the order validate_file_access() checks them
+EXPIRED = "expired"
+PENDING = "pending"
+LOGIN_REQUIRED = "login_required"
+NOT_SHARED = "not_shared"
+PRIVATE = "private"
+ALLOWED = "allowed"
+
+
+def access_decision(file_meta: FileRecord, email: str | None, now: int) -> str:
+    status = file_meta.status(now)
+    is_owner = email is not None and email == file_meta.owner_email
+
+    if status == "expired":
+        return EXPIRED
+    if status == "pending" and not is_owner:
+        return PENDING
+    if not file_meta.is_public or file_meta.shared_with:
+        if email is None:
+            return LOGIN_REQUIRED
+        if file_meta.shared_with:
+            if email not in file_meta.shared_with and not is_owner:
+                return NOT_SHARED
+        elif not is_owner:
+            return PRIVATE
+    return ALLOWED
+
+
+class AccessDecisionCache:
+    """
+    access_decision() results for up to `capacity` (file, user) pairs, least
+    recently used dropped first.
+    """
+
+    def __init__(self, ttl: float = 60, capacity: int = 100_000):
+        self.ttl = int(ttl * US_PER_SECOND)
+        self.capacity = capacity
+        # entries[(file_id, email)] = (decision, expires_at)
+        self._entries = OrderedDict()
+        # by_file[file_id] = set of emails with a cached decision
+        self._by_file = {}
+        self._lock = threading.Lock()
+
+    def decide(self, file_meta: FileRecord, email: str | None, now: int) -> str:
+        key = (file_meta.id, email)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry[1]:
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        decision = access_decision(file_meta, email, now)
+        expires_at = now + self.ttl
+        transition = file_meta.next_transition(now)
+        if transition is not None:
+            expires_at = min(expires_at, transition)
+
+        with self._lock:
+            self._entries[key] = (decision, expires_at)
+            self._entries.move_to_end(key)
+            self._by_file.setdefault(file_meta.id, set()).add(email)
+            while len(self._entries) > self.capacity:
+                (file_id, old_email), _ = self._entries.popitem(last=False)
+                self._discard(file_id, old_email)
+        return decision
+
+    def _discard(self, file_id: str, email: str | None) -> None:
+        emails = self._by_file.get(file_id)
+        if emails is not None:
+            emails.discard(email)
+            if not emails:
+                del self._by_file[file_id]
+
+    def invalidate(self, file_id: str) -> None:
+        with self._lock:
+            for email in self._by_file.pop(file_id, ()):
+                self._entries.pop((file_id, email), None)
@@ -0,0 +1,330 @@
+"""
+ASGI entry point, for serving many slow downloads at once:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Several worker processes (--workers, or WEB_CONCURRENCY) only share users,
+sessions and files with STATE_BACKEND=sqlite, and only accept each other's
+tokens and fingerprints when FINGERPRINT_SALT, ACCESS_TOKEN_SECRET and
+PRESIGNED_URL_SECRET are set; workers refuse to start otherwise.
+
+Every request still runs through the Flask app, on a small thread pool, but
+the response body is pulled from it one chunk at a time and sent from the
+event loop. A thread is only busy while a chunk is read from disk. While a
+slow client drains its socket the transfer waits in `await send()`, which
+applies the server's backpressure. So thousands of slow downloads share
+ASGI_THREADS threads.
+
+Request bodies of up to ASGI_BODY_BUFFER_BYTES are received on the event loop
+before the request is handed to a thread. Larger ones, and bodies of unknown
+length, are uploads: they are streamed to the app, whose thread waits while
+the client sends them, so they run on a pool of their own (ASGI_UPLOAD_THREADS)
+and slow uploads only hold up other uploads, never downloads or metadata
+requests.
+"""
+
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.wsgi import FileWrapper
+
+# Every worker process must use the same values; server.py makes up its own
+# when they are unset
+SHARED_SECRETS = ("FINGERPRINT_SALT", "ACCESS_TOKEN_SECRET", "PRESIGNED_URL_SECRET")
+
+
+def uvicorn_workers() -> int:
+    """
+    Number of worker processes of the uvicorn server this module is loaded
+    in. uvicorn spawns workers with its own command line, so it is read from
+    there; with --reload, or in a single-process server, it is 1.
+    """
+    if multiprocessing.parent_process() is None:
+        return 1
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1))
+    )
+    parser.add_argument("--reload", action="store_true")
+    args, _ = parser.parse_known_args(sys.argv[1:])
+    return 1 if args.reload else args.workers
+
+
+def refuse_to_start(message: str) -> None:
+    # uvicorn restarts workers that exit, so stop its supervisor as well
+    os.kill(multiprocessing.parent_process().pid, signal.SIGTERM)
+    raise RuntimeError(message)
+
+
+# Checked before server.py is imported, which builds the state backend and
+# starts the password hash workers
+if uvicorn_workers() > 1:
+    if os.environ.get("STATE_BACKEND", "memory") != "sqlite":
+        refuse_to_start(
+            "Several uvicorn workers need STATE_BACKEND=sqlite; with the memory "
+            "backend each worker has its own users, sessions and files"
+        )
+    missing = [name for name in SHARED_SECRETS if not os.environ.get(name)]
+    if missing:
+        refuse_to_start(
+            "Several uvicorn workers need shared secrets; set " + ", ".join(missing)
+        )
+
+from blobstore import COPY_CHUNK_SIZE
+from server import app as flask_app
+from server import password_hasher, state
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 16))
+ASGI_UPLOAD_THREADS = int(os.environ.get("ASGI_UPLOAD_THREADS", 16))
+ASGI_BODY_BUFFER_BYTES = int(os.environ.get("ASGI_BODY_BUFFER_BYTES", 64 * 1024))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="asgi")
+upload_executor = ThreadPoolExecutor(
+    max_workers=ASGI_UPLOAD_THREADS, thread_name_prefix="asgi-upload"
+)
+
+
+class BlobFileWrapper(FileWrapper):
+    """
+    wsgi.file_wrapper for send_file(): reads COPY_CHUNK_SIZE blocks, so each
+    hop to the thread pool moves a useful amount of data.
+    """
+
+    def __init__(self, file, buffer_size: int = 8192):
+        super().__init__(file, max(buffer_size, COPY_CHUNK_SIZE))
+
+
+class RequestBody:
+    """
+    wsgi.input fed by ASGI receive(). Read from an upload pool thread; each
+    read waits for the event loop to deliver more of the body.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+
+    def _fill(self, size: int) -> None:
+        while self._more and (size < 0 or len(self._buffer) < size):
+            message = asyncio.run_coroutine_threadsafe(
+                self._receive(), self._loop
+            ).result()
+            if message["type"] == "http.disconnect":
+                self._more = False
+                break
+            self._buffer += message.get("body", b"")
+            self._more = message.get("more_body", False)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        while (
+            self._more
+            and b"\n" not in self._buffer
+            and (size < 0 or len(self._buffer) < size)
+        ):
+            self._fill(len(self._buffer) + 1)
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        return self.read(end)
+
+    def __iter__(self):
+        while line := self.readline():
+            yield line
+
+
+def declared_length(scope: dict) -> int | None:
+    """
+    Content-Length of the request body, 0 without one; None when the length
+    is not known up front (chunked) or not a number.
+    """
+    length = 0
+    for name, value in scope["headers"]:
+        if name == b"transfer-encoding":
+            return None
+        if name == b"content-length":
+            if not value.strip().isdigit():
+                return None
+            length = int(value)
+    return length
+
+
+async def receive_body(receive) -> bytes | None:
+    """
+    The whole request body, or None if the client went away first.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return bytes(body)
+
+
+def build_environ(scope: dict, body) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The ASGI server has already removed any transfer encoding, so the
+        # body ends where receive() says it does
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": BlobFileWrapper,
+    }
+    for raw_name, raw_value in scope["headers"]:
+        name = raw_name.decode("latin-1")
+        value = raw_value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def start_wsgi(environ: dict):
+    """
+    Run the Flask app up to its first body chunk. Returns (status, headers,
+    result, chunks, first_chunk); first_chunk is None for an empty body.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+        def write(data):
+            # Flask returns its body as an iterable and never calls write()
+            raise RuntimeError(
+                "The ASGI bridge does not support the WSGI write() callable; "
+                "return the response body as an iterable instead"
+            )
+
+        return write
+
+    result = flask_app(environ, start_response)
+    chunks = iter(result)
+    first = next(chunks, None)
+    return started["status"], started["headers"], result, chunks, first
+
+
+async def watch_disconnect(receive, disconnected: asyncio.Event) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            disconnected.set()
+            return
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Apply queued download events and stop the password hash workers
+            # before the process exits. uvicorn ends by re-raising the signal
+            # that stopped it, which skips atexit handlers, so a pool left
+            # running would leave its workers behind.
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, state.close)
+            await loop.run_in_executor(executor, password_hasher.close)
+            executor.shutdown(wait=False)
+            upload_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] == "websocket":
+        # The app has no websocket endpoints: closing before accepting makes
+        # the server reject the handshake (HTTP 403)
+        message = await receive()
+        if message["type"] == "websocket.connect":
+            await send({"type": "websocket.close", "code": 1000})
+        return
+    if scope["type"] != "http":
+        # Other scope types are left unhandled, as the ASGI spec allows
+        return
+
+    loop = asyncio.get_running_loop()
+    length = declared_length(scope)
+    if length is not None and length <= ASGI_BODY_BUFFER_BYTES:
+        # The request only takes a thread once its body is all here
+        data = await receive_body(receive)
+        if data is None:
+            return
+        body, pool = io.BytesIO(data), executor
+    else:
+        body, pool = RequestBody(receive, loop), upload_executor
+    environ = build_environ(scope, body)
+    status, headers, result, chunks, chunk = await loop.run_in_executor(
+        pool, start_wsgi, environ
+    )
+
+    # The request body has been consumed; from here on receive() only reports
+    # a client that went away, which stops the transfer
+    disconnected = asyncio.Event()
+    watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+        while chunk is not None and not disconnected.is_set():
+            if chunk:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            chunk = await loop.run_in_executor(pool, next, chunks, None)
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        watcher.cancel()
+        if hasattr(result, "close"):
+            await loop.run_in_executor(pool, result.close)
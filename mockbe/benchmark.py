@@ -0,0 +1,179 @@
+"""
+Throughput of the gunicorn setup for a growing number of worker processes.
+
+    python benchmark.py --workers 1 2 4 --duration 10
+
+Each run starts gunicorn on a fresh SQLite state directory, creates a session
+and a public file, then hammers session lookups (GET /api/user) and metadata
+lookups (GET /api/files/<token>) from several client processes over
+keep-alive connections. The load generator runs on the same machine, so leave
+it some cores.
+"""
+
+import argparse
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(conn, method: str, path: str, body=None, headers=None):
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def prepare(port: int):
+    """
+    Log in and upload a small public file. Returns (token, share_token).
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    body = json.dumps(
+        {"email": "bigbluewhale@hcmut.edu.vn", "password": "bigbluewhale@123"}
+    )
+    _, data = request(
+        conn,
+        "POST",
+        "/api/auth/login",
+        body,
+        {"Content-Type": "application/json"},
+    )
+    token = json.loads(data)["accessToken"]
+
+    boundary = uuid.uuid4().hex
+    form = io.BytesIO()
+    form.write(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="isPublic"\r\n\r\n'
+        f'true\r\n--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+        f'filename="bench.txt"\r\nContent-Type: text/plain\r\n\r\n'.encode()
+    )
+    form.write(b"benchmark payload\r\n")
+    form.write(f"--{boundary}--\r\n".encode())
+    _, data = request(
+        conn,
+        "POST",
+        "/api/files/upload",
+        form.getvalue(),
+        {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+        },
+    )
+    conn.close()
+    return token, json.loads(data)["file"]["shareToken"]
+
+
+def client(port: int, token: str, share_token: str, duration: float, results):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    headers = {"Authorization": f"Bearer {token}"}
+    paths = ["/api/user", f"/api/files/{share_token}"]
+    done = errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            status, _ = request(conn, "GET", paths[done % 2], headers=headers)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            errors += 1
+            continue
+        if status != 200:
+            errors += 1
+        done += 1
+    conn.close()
+    results.put((done, errors))
+
+
+def run(workers: int, clients: int, duration: float, threads: int) -> dict:
+    port = free_port()
+    data_dir = tempfile.mkdtemp(prefix="mockbe-bench-")
+    env = dict(
+        os.environ,
+        STATE_BACKEND="sqlite",
+        DATA_DIR=data_dir,
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_THREADS=str(threads),
+        GUNICORN_BIND=f"127.0.0.1:{port}",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "server:app"],
+        cwd=HERE,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        token, share_token = prepare(port)
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=client, args=(port, token, share_token, duration, results)
+            )
+            for _ in range(clients)
+        ]
+        for proc in procs:
+            proc.start()
+        totals = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    done = sum(d for d, _ in totals)
+    return {
+        "workers": workers,
+        "requests": done,
+        "errors": sum(e for _, e in totals),
+        "rps": done / duration,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>7} {'requests':>9} {'errors':>6} {'req/s':>9} {'speedup':>7}")
+    for workers in args.workers:
+        result = run(workers, args.clients, args.duration, args.threads)
+        baseline = baseline or result["rps"]
+        print(
+            f"{result['workers']:>7} {result['requests']:>9} {result['errors']:>6} "
+            f"{result['rps']:>9.0f} {result['rps'] / baseline:>6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Blob storage for uploaded file contents.
+
+File metadata only keeps a blob key; the bytes live in a BlobStore. The local
+backend keeps blobs on disk so downloads can be handed to send_file (sendfile)
+or to nginx (X-Accel-Redirect) without the Python process copying them.
+
+Blobs are content-addressed by their SHA-256 digest: uploading bytes that are
+already stored only adds a reference, and a blob is removed once its last
+reference is released. Reference counts live in a ReferenceCounts object, in
+process memory by default or in the state database when several processes
+share one blob directory.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+COPY_CHUNK_SIZE = 64 * 1024
+# Mode of committed blobs: nginx, running as another user, serves them from disk
+BLOB_MODE = 0o644
+
+
+class ReferenceCounts:
+    """
+    In-memory blob reference counts: refs[key] = [reference_count, size].
+    add() and remove() run their create/destroy callbacks under the same lock
+    as the count change, so a blob is never deleted while it gains a reference.
+    """
+
+    def __init__(self):
+        self.refs = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, create) -> bool:
+        """
+        Add a reference to `key`. If it had none, call create() (which stores
+        the blob and returns its size) and return True.
+        """
+        with self._lock:
+            entry = self.refs.get(key)
+            if entry:
+                entry[0] += 1
+                return False
+            self.refs[key] = [1, create()]
+            return True
+
+    def remove(self, key: str, destroy) -> int:
+        """
+        Drop a reference to `key`, calling destroy() when it was the last one.
+        Returns the size of the destroyed blob, or 0.
+        """
+        with self._lock:
+            entry = self.refs.get(key)
+            if not entry:
+                return 0
+            entry[0] -= 1
+            if entry[0] > 0:
+                return 0
+            del self.refs[key]
+            destroy()
+            return entry[1]
+
+    def entries(self) -> list:
+        """
+        (reference_count, size) of every stored blob.
+        """
+        with self._lock:
+            return [tuple(entry) for entry in self.refs.values()]
+
+
+class BlobStore:
+    """
+    Minimal interface every blob backend implements.
+    """
+
+    def open_staging(self):
+        """
+        Return a writable binary file object to stream a new blob into.
+        """
+        raise NotImplementedError
+
+    def commit(self, staging_path: str, sha256: str) -> str:
+        """
+        Turn a finished staging file with the given SHA-256 hex digest into a
+        reference to a stored blob and return the blob key. If the content is
+        already stored the staging file is dropped and the existing blob gains
+        a reference.
+        """
+        raise NotImplementedError
+
+    def discard(self, staging_path: str) -> None:
+        raise NotImplementedError
+
+    def put(self, stream) -> str:
+        digest = hashlib.sha256()
+        with self.open_staging() as staging:
+            while data := stream.read(COPY_CHUNK_SIZE):
+                digest.update(data)
+                staging.write(data)
+        return self.commit(staging.name, digest.hexdigest())
+
+    def open(self, key: str):
+        raise NotImplementedError
+
+    def path(self, key: str) -> str | None:
+        """
+        Local filesystem path of a blob, or None if the backend is not local.
+        """
+        return None
+
+    def release(self, key: str) -> int:
+        """
+        Drop one reference to a blob, deleting it when none are left. Returns
+        the number of bytes reclaimed.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Blobs stored under root/<aa>/<bb>/<key>, where aa/bb come from a hash of the
+    key so no single directory grows too large. Staging files live under the
+    same root, so committing a blob is a rename rather than a copy.
+    """
+
+    def __init__(self, root: str, fanout: int = 2, refs: ReferenceCounts = None):
+        self.root = os.path.abspath(root)
+        self.fanout = fanout
+        self.staging_dir = os.path.join(self.root, "staging")
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.refs = refs if refs is not None else ReferenceCounts()
+
+    def relative_path(self, key: str) -> str:
+        shard = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        parts = [shard[i * 2 : i * 2 + 2] for i in range(self.fanout)]
+        return "/".join(parts + [key])
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *self.relative_path(key).split("/"))
+
+    def open_staging(self):
+        return tempfile.NamedTemporaryFile(
+            dir=self.staging_dir, prefix="blob-", delete=False
+        )
+
+    def commit(self, staging_path: str, sha256: str) -> str:
+        key = sha256
+        target = self.path(key)
+
+        def create():
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # NamedTemporaryFile creates staging files 0600
+            os.chmod(staging_path, BLOB_MODE)
+            os.replace(staging_path, target)
+            return os.path.getsize(target)
+
+        if not self.refs.add(key, create):
+            self.discard(staging_path)
+        return key
+
+    def discard(self, staging_path: str) -> None:
+        try:
+            os.remove(staging_path)
+        except FileNotFoundError:
+            pass
+
+    def open(self, key: str):
+        return open(self.path(key), "rb")
+
+    def clear(self) -> None:
+        """
+        Delete every stored blob and staging file. For reference counts that
+        start empty (in process memory): blobs from an earlier process would
+        otherwise never be released.
+        """
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name == "staging":
+                for staged in os.listdir(path):
+                    if staged.startswith("blob-"):
+                        os.remove(os.path.join(path, staged))
+            elif len(name) == 2 and os.path.isdir(path):
+                # A shard directory (see relative_path)
+                shutil.rmtree(path)
+            elif len(name) == 64 and os.path.isfile(path):
+                # A blob, with fanout 0
+                os.remove(path)
+
+    def release(self, key: str) -> int:
+        def destroy():
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+        return self.refs.remove(key, destroy)
+
+    def stats(self) -> dict:
+        entries = self.refs.entries()
+        stored = sum(size for _, size in entries)
+        logical = sum(count * size for count, size in entries)
+        return {
+            "blobs": len(entries),
+            "references": sum(count for count, _ in entries),
+            "storedBytes": stored,
+            "logicalBytes": logical,
+            "dedupSavedBytes": logical - stored,
+        }
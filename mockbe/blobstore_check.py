@@ -0,0 +1,68 @@
+"""
+Checks for the local blob store.
+
+    python blobstore_check.py
+
+Stores blobs in a temporary directory and checks that:
+
+- committed blobs are readable by other users (nginx serves them from disk),
+- storing the same bytes again adds a reference instead of a second file,
+- releasing the last reference deletes the blob,
+- clear() removes blobs and staging files an earlier store left behind.
+
+The script exits non-zero if any check fails.
+"""
+
+import argparse
+import io
+import os
+import stat
+import sys
+import tempfile
+
+from blobstore import BLOB_MODE, LocalBlobStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.parse_args()
+
+    store = LocalBlobStore(tempfile.mkdtemp(prefix="mockbe-blobs-"))
+    key = store.put(io.BytesIO(b"blob contents"))
+    path = store.path(key)
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    same_key = store.put(io.BytesIO(b"blob contents"))
+    references = store.stats()["references"]
+    staged = os.listdir(store.staging_dir)
+    store.release(key)
+    kept = os.path.exists(path)
+    store.release(key)
+
+    # A store whose reference counts start empty clears blobs left behind
+    left_behind = store.path(store.put(io.BytesIO(b"left behind")))
+    with store.open_staging() as staging:
+        staging.write(b"partial")
+    restarted = LocalBlobStore(store.root)
+    restarted.clear()
+
+    checks = [
+        ("committed blob mode", oct(mode), oct(BLOB_MODE)),
+        ("same bytes, same key", same_key == key, True),
+        ("references after storing twice", references, 2),
+        ("staging files left", staged, []),
+        ("blob kept while referenced", kept, True),
+        ("blob deleted with its last reference", os.path.exists(path), False),
+        ("blob left behind after clear()", os.path.exists(left_behind), False),
+        ("staging files after clear()", os.listdir(store.staging_dir), []),
+    ]
+
+    failed = 0
+    for name, actual, expected in checks:
+        ok = actual == expected
+        failed += not ok
+        print(f"{'ok' if ok else 'FAIL':4}  {name}: {actual} (expected {expected})")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Download bookkeeping off the request path.
+
+A download only appends an event to a queue (a deque, whose append needs no
+lock of ours). A background thread drains the queue in batches, groups the
+events per file and hands each batch to the state backend, which applies one
+increment per file instead of one per download. History entry ids are made
+while grouping, on the background thread.
+
+Reads of download stats flush the queue first, so a client always sees its
+own downloads counted.
+
+A batch the backend fails to apply is logged and retried on the next flush,
+up to `max_attempts` times. SQLite applies a batch in one transaction, so a
+retry never counts a download twice.
+"""
+
+import logging
+import threading
+import uuid
+from collections import deque
+
+from records import FileRecord
+
+logger = logging.getLogger(__name__)
+
+
+class FileDownloads:
+    """
+    A batch's downloads of one file.
+    """
+
+    __slots__ = (
+        "file_meta",
+        "count",
+        "last_downloaded_at",
+        "entries",
+        "downloader_keys",
+        "per_second",
+    )
+
+    def __init__(self, file_meta: FileRecord):
+        self.file_meta = file_meta
+        self.count = 0
+        self.last_downloaded_at = 0
+        # (entry_id, downloaded_at, downloader) in download order
+        self.entries = []
+        self.downloader_keys = []
+        # per_second[epoch second] = downloads, for the rollups
+        self.per_second = {}
+
+    def add(
+        self, downloaded_at: int, downloader_key: str | None, downloader: dict | None
+    ) -> None:
+        self.count += 1
+        self.last_downloaded_at = max(self.last_downloaded_at, downloaded_at)
+        self.entries.append((str(uuid.uuid4()), downloaded_at, downloader))
+        if downloader_key:
+            self.downloader_keys.append(downloader_key)
+        second = downloaded_at // 1_000_000
+        self.per_second[second] = self.per_second.get(second, 0) + 1
+
+
+class DownloadQueue:
+    """
+    Queue of download events, applied by `apply(batch)` with `batch` a list of
+    FileDownloads. Batches hold at most `batch_size` events; the queue is
+    drained every `flush_interval` seconds, or as soon as a full batch is
+    waiting. With `flush_interval` 0 there is no background thread and a full
+    batch is applied by the request that fills it.
+    """
+
+    def __init__(
+        self,
+        apply,
+        batch_size: int = 256,
+        flush_interval: float = 1.0,
+        max_attempts: int = 5,
+    ):
+        self.apply = apply
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._events = deque()
+        # (batch, failed attempts) of batches to apply again
+        self._retry = []
+        # Held while a batch is applied, so a flush() returns only once every
+        # event queued before it is visible
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._worker = None
+        if flush_interval > 0:
+            self._worker = threading.Thread(
+                target=self._run,
+                args=(flush_interval,),
+                name="download-writer",
+                daemon=True,
+            )
+            self._worker.start()
+
+    def push(
+        self,
+        file_meta: FileRecord,
+        downloaded_at: int,
+        downloader_key: str | None,
+        downloader: dict | None,
+    ) -> None:
+        self._events.append((file_meta, downloaded_at, downloader_key, downloader))
+        if len(self._events) >= self.batch_size:
+            if self._worker is None:
+                self.flush()
+            else:
+                self._wake.set()
+
+    def flush(self) -> None:
+        """
+        Apply every event queued so far. Events queued meanwhile are left for
+        the next flush, so a steady stream of downloads cannot keep a reader
+        waiting. Batches that fail are kept for the next flush instead.
+        """
+        with self._flush_lock:
+            retry, self._retry = self._retry, []
+            for batch, attempts in retry:
+                self._apply(batch, attempts)
+            remaining = len(self._events)
+            while remaining > 0:
+                size = min(remaining, self.batch_size)
+                self._apply(self._next_batch(size))
+                remaining -= size
+
+    def _apply(self, batch: list, attempts: int = 0) -> None:
+        try:
+            self.apply(batch)
+        except Exception:
+            attempts += 1
+            events = sum(downloads.count for downloads in batch)
+            if attempts < self.max_attempts:
+                logger.exception(
+                    "Applying %d download events failed (attempt %d), will retry",
+                    events,
+                    attempts,
+                )
+                self._retry.append((batch, attempts))
+            else:
+                logger.exception(
+                    "Dropping %d download events after %d failed attempts",
+                    events,
+                    attempts,
+                )
+
+    def _next_batch(self, size: int) -> list:
+        per_file = {}
+        for _ in range(size):
+            try:
+                file_meta, downloaded_at, downloader_key, downloader = (
+                    self._events.popleft()
+                )
+            except IndexError:
+                break
+            downloads = per_file.get(file_meta.id)
+            if downloads is None:
+                downloads = per_file[file_meta.id] = FileDownloads(file_meta)
+            downloads.add(downloaded_at, downloader_key, downloader)
+        return list(per_file.values())
+
+    def _run(self, interval: float) -> None:
+        while not self._closed:
+            self._wake.wait(interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self) -> None:
+        """
+        Stop the background thread and apply everything still queued, retrying
+        failed batches until they succeed or run out of attempts.
+        """
+        self._closed = True
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join()
+        self.flush()
+        while self._retry:
+            self.flush()
@@ -0,0 +1,50 @@
+"""
+Production server settings:
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Worker processes only share users, sessions and files with
+STATE_BACKEND=sqlite; with the memory backend each process would have its own
+copy, so a single worker is started.
+"""
+
+import multiprocessing
+import os
+import secrets
+import sys
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8080")
+
+# Threaded workers: downloads and uploads mostly wait on I/O
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+if os.environ.get("STATE_BACKEND", "memory") == "sqlite":
+    workers = int(
+        os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1)
+    )
+else:
+    workers = 1
+
+# Large uploads and slow downloads keep a thread busy for a long time
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG")
+
+# Every worker must hash anonymous downloaders with the same salt, and check
+# signed access tokens and download URLs with the same secrets. Empty values
+# (as in example.env) count as unset. With md5 download URLs nginx checks
+# them too, so the secret must be configured and none is made up here.
+generated_secrets = [("FINGERPRINT_SALT", 16), ("ACCESS_TOKEN_SECRET", 32)]
+if os.environ.get("PRESIGNED_URL_SIGNATURE", "hmac") != "md5":
+    generated_secrets.append(("PRESIGNED_URL_SECRET", 32))
+for name, size in generated_secrets:
+    if not os.environ.get(name):
+        os.environ[name] = secrets.token_hex(size)
+
+
+def worker_exit(server, worker):
+    # Apply download events still queued in this worker before it goes away
+    app_module = sys.modules.get("server")
+    if app_module is not None:
+        app_module.state.close()
@@ -0,0 +1,132 @@
+"""
+Download history storage.
+
+Each file's history is append-only. The most recent entries are kept in memory
+and older ones spill, in batches, to a per-file JSON-lines log on disk; an
+array of line offsets gives random access into the log so newest-first pages
+can be read without loading the whole history.
+"""
+
+import json
+import os
+import threading
+from array import array
+from collections import deque
+
+
+class DownloadHistory:
+    """
+    History of one file. Holds at most 2 * `tail_size` entries in memory: once
+    the in-memory tail reaches that size, its oldest `tail_size` entries are
+    appended to the spill log in one write.
+    """
+
+    def __init__(self, path: str, tail_size: int):
+        self.path = path
+        self.tail_size = tail_size
+        self._tail = deque()
+        # _offsets[k] = byte offset of the k-th oldest spilled entry
+        self._offsets = array("Q")
+        self._spill_size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._offsets) + len(self._tail)
+
+    def append(self, entry: dict) -> None:
+        with self._lock:
+            self._tail.append(entry)
+            if len(self._tail) >= 2 * self.tail_size:
+                self._spill(self.tail_size)
+
+    def page(self, offset: int, limit: int) -> list:
+        """
+        Entries newest first, skipping the `offset` newest.
+        """
+        with self._lock:
+            result = []
+            tail_len = len(self._tail)
+            for i in range(offset, min(offset + limit, tail_len)):
+                result.append(self._tail[tail_len - 1 - i])
+
+            remaining = limit - len(result)
+            spilled = len(self._offsets)
+            first = max(0, offset - tail_len)
+            if remaining <= 0 or first >= spilled:
+                return result
+
+            # Spilled entries are numbered oldest first, so newest-first index
+            # j maps to k = spilled - 1 - j; read the whole range in one go
+            high = spilled - 1 - first
+            low = max(0, high - remaining + 1)
+            start = self._offsets[low]
+            end = self._offsets[high + 1] if high + 1 < spilled else self._spill_size
+            with open(self.path, "rb") as log:
+                log.seek(start)
+                lines = log.read(end - start).splitlines()
+            result.extend(json.loads(line) for line in reversed(lines))
+            return result
+
+    def drop(self) -> None:
+        with self._lock:
+            self._tail.clear()
+            self._offsets = array("Q")
+            self._spill_size = 0
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _spill(self, count: int) -> None:
+        chunks = []
+        for _ in range(count):
+            line = json.dumps(self._tail.popleft(), separators=(",", ":"))
+            chunks.append(line.encode("utf-8") + b"\n")
+
+        with open(self.path, "ab") as log:
+            log.write(b"".join(chunks))
+        for chunk in chunks:
+            self._offsets.append(self._spill_size)
+            self._spill_size += len(chunk)
+
+
+class HistoryStore:
+    """
+    Download histories of all files, spilling to `directory`. A store starts
+    empty, so spill logs an earlier process left there are deleted: the rest
+    of their histories was only in that process's memory.
+    """
+
+    def __init__(self, directory: str, tail_size: int):
+        if tail_size < 1:
+            raise ValueError(f"History tail size must be at least 1, not {tail_size}")
+        self.directory = directory
+        self.tail_size = tail_size
+        self._histories = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".jsonl"):
+                os.remove(os.path.join(directory, name))
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self._histories
+
+    def create(self, file_id: str) -> None:
+        path = os.path.join(self.directory, f"{file_id}.jsonl")
+        self._histories[file_id] = DownloadHistory(path, self.tail_size)
+
+    def append(self, file_id: str, entry: dict) -> None:
+        self._histories[file_id].append(entry)
+
+    def count(self, file_id: str) -> int:
+        history = self._histories.get(file_id)
+        return len(history) if history else 0
+
+    def page(self, file_id: str, offset: int, limit: int) -> list:
+        history = self._histories.get(file_id)
+        return history.page(offset, limit) if history else []
+
+    def drop(self, file_id: str) -> None:
+        history = self._histories.pop(file_id, None)
+        if history:
+            history.drop()
@@ -0,0 +1,289 @@
+"""
+In-memory indexes over file metadata, kept up to date by upload and delete so
+hot paths do not have to scan every file.
+"""
+
+import bisect
+import heapq
+import threading
+
+
+class ExpiryIndex:
+    """
+    Min-heap of (expires_at, file_id). Removed files are dropped lazily: their
+    heap entries are skipped when popped, and the heap is rebuilt once stale
+    entries outnumber live ones.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # Live entries: _expiry[file_id] = expires_at (epoch microseconds)
+        self._expiry = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def add(self, file_id: str, expires_at: int) -> None:
+        with self._lock:
+            self._expiry[file_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, file_id))
+
+    def discard(self, file_id: str) -> None:
+        with self._lock:
+            self._expiry.pop(file_id, None)
+            if len(self._heap) > 2 * len(self._expiry) + 64:
+                self._heap = [(ts, fid) for fid, ts in self._expiry.items()]
+                heapq.heapify(self._heap)
+
+    def pop_expired(self, now: int) -> list:
+        """
+        Remove and return the ids of files whose expiry is before `now`.
+        Runs in O(k log N) for k expired entries.
+        """
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                expires_at, file_id = heapq.heappop(self._heap)
+                if self._expiry.get(file_id) == expires_at:
+                    del self._expiry[file_id]
+                    expired.append(file_id)
+        return expired
+
+
+class SortedIndex:
+    """
+    Sorted list of (sort_key, file_id), paged by position so reading page N
+    only touches `limit` entries.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self._keys
+
+    def add(self, file_id: str, sort_key) -> None:
+        with self._lock:
+            if file_id in self._keys:
+                return
+            self._keys[file_id] = sort_key
+            bisect.insort(self._entries, (sort_key, file_id))
+
+    def discard(self, file_id: str) -> None:
+        with self._lock:
+            sort_key = self._keys.pop(file_id, None)
+            if sort_key is None:
+                return
+            pos = bisect.bisect_left(self._entries, (sort_key, file_id))
+            del self._entries[pos]
+
+    def page(self, offset: int, limit: int, descending: bool = False) -> list:
+        with self._lock:
+            if descending:
+                end = max(0, len(self._entries) - offset)
+                selected = self._entries[max(0, end - limit) : end][::-1]
+            else:
+                selected = self._entries[offset : offset + limit]
+        return [file_id for _, file_id in selected]
+
+
+class OwnerIndex:
+    """
+    Per-owner sorted lists of (sort_key, file_id), one list per sort field, so
+    listing a user's files costs O(limit) after a bisect instead of a scan and
+    sort of every file in the system.
+    """
+
+    def __init__(self, fields=("createdAt", "fileName")):
+        self.fields = fields
+        # _lists[(owner, field)] = sorted [(sort_key, file_id)]
+        self._lists = {}
+        # _entries[file_id] = (owner, {field: sort_key})
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def count(self, owner: str) -> int:
+        return len(self._lists.get((owner, self.fields[0]), ()))
+
+    def sort_key(self, file_id: str, field: str):
+        return self._entries[file_id][1][field]
+
+    def add(self, owner: str, file_id: str, keys: dict) -> None:
+        with self._lock:
+            self._entries[file_id] = (owner, keys)
+            for field in self.fields:
+                entries = self._lists.setdefault((owner, field), [])
+                bisect.insort(entries, (keys[field], file_id))
+
+    def discard(self, file_id: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(file_id, None)
+            if not entry:
+                return
+            owner, keys = entry
+            for field in self.fields:
+                entries = self._lists[(owner, field)]
+                pos = bisect.bisect_left(entries, (keys[field], file_id))
+                if pos < len(entries) and entries[pos][1] == file_id:
+                    del entries[pos]
+                if not entries:
+                    del self._lists[(owner, field)]
+
+    def page(
+        self,
+        owner: str,
+        field: str,
+        descending: bool = False,
+        after=None,
+        offset: int = 0,
+        limit: int | None = None,
+        predicate=None,
+    ) -> list:
+        """
+        Up to `limit` of an owner's file ids in `field` order, skipping the first
+        `offset` matches. `after` is a (sort_key, file_id) position from a
+        previous page; the page starts right past it even if files were added
+        or removed in between. `predicate(file_id)` filters entries.
+        """
+        result = []
+        with self._lock:
+            entries = self._lists.get((owner, field), [])
+            if descending:
+                end = len(entries)
+                if after is not None:
+                    end = bisect.bisect_left(entries, tuple(after))
+                if predicate is None:
+                    end, offset = max(0, end - offset), 0
+                indices = range(end - 1, -1, -1)
+            else:
+                start = 0
+                if after is not None:
+                    start = bisect.bisect_right(entries, tuple(after))
+                if predicate is None:
+                    start, offset = start + offset, 0
+                indices = range(start, len(entries))
+
+            for i in indices:
+                if limit is not None and len(result) >= limit:
+                    break
+                file_id = entries[i][1]
+                if predicate is not None and not predicate(file_id):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                result.append(file_id)
+        return result
+
+
+class StatusTracker:
+    """
+    Current status of every file and per-owner status counters. Instead of
+    recomputing statuses per request, each file schedules its pending -> active
+    (at availableFrom) and active -> expired (one microsecond after
+    availableTo) transitions in a heap, each at the first instant status_at()
+    gives the new status; advance() applies the ones that are due, so reading
+    a summary is O(1) plus whatever transitions happened since the last call.
+    """
+
+    STATUSES = ("active", "pending", "expired", "deleted")
+
+    def __init__(self):
+        self._status = {}
+        # _files[file_id] = (owner, available_from, available_to)
+        self._files = {}
+        self._counts = {}
+        # Heap of (first timestamp of next_status, file_id, next_status); stale
+        # entries are skipped
+        self._schedule = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def status_at(available_from: int, available_to: int, now: int) -> str:
+        if now < available_from:
+            return "pending"
+        if now > available_to:
+            return "expired"
+        return "active"
+
+    def add(
+        self,
+        file_id: str,
+        owner: str | None,
+        available_from: int,
+        available_to: int,
+        now: int,
+    ) -> None:
+        status = self.status_at(available_from, available_to, now)
+        with self._lock:
+            self._files[file_id] = (owner, available_from, available_to)
+            self._status[file_id] = status
+            self._bump(owner, status, 1)
+            self._schedule_transitions(file_id, status)
+
+    def remove(self, file_id: str) -> None:
+        """
+        Forget a file and count it as deleted for its owner.
+        """
+        with self._lock:
+            status = self._status.pop(file_id, None)
+            if status is None:
+                return
+            owner = self._files.pop(file_id)[0]
+            self._bump(owner, status, -1)
+            self._bump(owner, "deleted", 1)
+            if len(self._schedule) > 4 * len(self._files) + 64:
+                self._rebuild_schedule()
+
+    def advance(self, now: int) -> list:
+        """
+        Apply every transition due at `now`. Returns the applied transitions as
+        (file_id, new_status) pairs.
+        """
+        applied = []
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                at, file_id, next_status = heapq.heappop(self._schedule)
+                current = self._status.get(file_id)
+                if current is None or current == next_status:
+                    continue
+                if current == "expired":
+                    continue
+                owner = self._files[file_id][0]
+                self._bump(owner, current, -1)
+                self._bump(owner, next_status, 1)
+                self._status[file_id] = next_status
+                applied.append((file_id, next_status))
+        return applied
+
+    def status(self, file_id: str) -> str | None:
+        return self._status.get(file_id)
+
+    def summary(self, owner: str) -> dict:
+        with self._lock:
+            counts = self._counts.get(owner)
+            return dict(counts) if counts else dict.fromkeys(self.STATUSES, 0)
+
+    def _bump(self, owner, status: str, delta: int) -> None:
+        counts = self._counts.get(owner)
+        if counts is None:
+            counts = self._counts[owner] = dict.fromkeys(self.STATUSES, 0)
+        counts[status] += delta
+
+    def _schedule_transitions(self, file_id: str, status: str) -> None:
+        owner, available_from, available_to = self._files[file_id]
+        if status == "pending":
+            heapq.heappush(self._schedule, (available_from, file_id, "active"))
+        if status != "expired":
+            heapq.heappush(self._schedule, (available_to + 1, file_id, "expired"))
+
+    def _rebuild_schedule(self) -> None:
+        self._schedule = []
+        for file_id, status in self._status.items():
+            self._schedule_transitions(file_id, status)
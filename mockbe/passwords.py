@@ -0,0 +1,163 @@
+"""
+Password hashing.
+
+Account and file passwords are stored as scrypt hashes:
+
+    scrypt$<log2 n>$<r>$<p>$<salt>$<hash>      (salt and hash in base64)
+
+scrypt is slow and memory-hard on purpose, so hashing and checking run in a
+bounded process pool: at most `workers` hashes are computed at once, however
+many request threads ask for one, and at most `max_pending` wait for a free
+worker before further requests are turned away with PasswordHasherBusy. A
+batch counts one pending hash per password.
+
+The workers are forked, and all of them at once, by start(). Call it before
+the process starts threads or opens database connections: a later fork
+would copy locks held by other threads, and open SQLite handles, into every
+worker. (spawn and forkserver avoid that, but re-run the main script in
+each worker, which for server.py means building a whole state backend.)
+
+Values without the scrypt$ prefix are plaintext passwords stored before
+hashing was introduced; they still verify, and callers can replace them with
+a hash once one is checked (see is_password_hash).
+"""
+
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+PREFIX = "scrypt$"
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Too many passwords are already waiting to be hashed.
+    """
+
+
+def scrypt_hash(password: str, log_n: int, r: int, p: int, salt: bytes) -> bytes:
+    return hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=salt,
+        n=1 << log_n,
+        r=r,
+        p=p,
+        maxmem=(1 << log_n) * r * 256,
+        dklen=32,
+    )
+
+
+def hash_password(password: str, log_n: int = 14, r: int = 8, p: int = 1) -> str:
+    salt = os.urandom(16)
+    digest = scrypt_hash(password, log_n, r, p, salt)
+    return PREFIX + "$".join(
+        [
+            str(log_n),
+            str(r),
+            str(p),
+            base64.b64encode(salt).decode("ascii"),
+            base64.b64encode(digest).decode("ascii"),
+        ]
+    )
+
+
+def verify_password(password: str, stored: str) -> bool:
+    if not stored.startswith(PREFIX):
+        return hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+    try:
+        log_n, r, p, salt, digest = stored[len(PREFIX) :].split("$")
+        expected = base64.b64decode(digest)
+        actual = scrypt_hash(
+            password, int(log_n), int(r), int(p), base64.b64decode(salt)
+        )
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+def is_password_hash(value: str) -> bool:
+    return value.startswith(PREFIX)
+
+
+class PasswordHasher:
+    """
+    Runs hash_password and verify_password in a pool of `workers` processes,
+    started by start() or else on first use. With `workers` 0 they run in the
+    calling thread.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 64, log_n: int = 14):
+        self.workers = workers
+        self.log_n = log_n
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                context = None
+                if "fork" in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context("fork")
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context
+                )
+            return self._pool
+
+    def start(self) -> None:
+        """
+        Fork the worker processes now rather than on first use.
+        """
+        if self.workers:
+            # A forking pool starts every worker on its first task
+            self._get_pool().submit(int).result()
+
+    @contextmanager
+    def _executor(self, count: int = 1):
+        acquired = 0
+        try:
+            while acquired < count:
+                if not self._pending.acquire(blocking=False):
+                    raise PasswordHasherBusy()
+                acquired += 1
+            yield self._get_pool()
+        finally:
+            for _ in range(acquired):
+                self._pending.release()
+
+    def hash(self, password: str) -> str:
+        if not self.workers:
+            return hash_password(password, self.log_n)
+        with self._executor() as pool:
+            return pool.submit(hash_password, password, self.log_n).result()
+
+    def verify(self, password: str, stored: str) -> bool:
+        # Plaintext values are compared right away, without a round trip
+        if not self.workers or not is_password_hash(stored):
+            return verify_password(password, stored)
+        with self._executor() as pool:
+            return pool.submit(verify_password, password, stored).result()
+
+    def hash_many(self, passwords: list) -> list:
+        """
+        Hashes of a batch of passwords, spread over every worker. Raises
+        PasswordHasherBusy unless the whole batch fits under max_pending.
+        """
+        if not self.workers:
+            return [hash_password(password, self.log_n) for password in passwords]
+        with self._executor(len(passwords)) as pool:
+            chunksize = max(1, len(passwords) // (self.workers * 4))
+            log_ns = [self.log_n] * len(passwords)
+            return list(pool.map(hash_password, passwords, log_ns, chunksize=chunksize))
+
+    def close(self) -> None:
+        """
+        Stop the worker processes, waiting for the hashes they are computing.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
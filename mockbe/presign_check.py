@@ -0,0 +1,105 @@
+"""
+Tamper checks for presigned download URLs.
+
+    python presign_check.py --backend sqlite
+
+Uploads a file through the Flask test client, gets presigned URLs of it and
+checks that the download endpoint serves them as issued but refuses them
+once the signature, expiry, bind flag or path has been changed, including a
+URL bound to one client with bind=1 dropped and that client's address moved
+into the path. The script exits non-zero if any check fails.
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+
+
+def login(client, email: str, password: str) -> dict:
+    response = client.post(
+        "/api/auth/login", json={"email": email, "password": password}
+    )
+    return {"Authorization": "Bearer " + response.get_json()["accessToken"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    args = parser.parse_args()
+
+    # server.py reads its configuration on import
+    os.environ["STATE_BACKEND"] = args.backend
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="mockbe-presign-")
+    os.environ.pop("BLOB_ACCEL_REDIRECT_PREFIX", None)
+    os.environ.pop("PRESIGNED_URL_CLIENT_HEADER", None)
+    import server
+
+    client = server.app.test_client()
+    headers = login(client, "bigbluewhale@hcmut.edu.vn", "bigbluewhale@123")
+    response = client.post(
+        "/api/files/upload",
+        data={"file": (io.BytesIO(b"presigned"), "check.txt"), "isPublic": "true"},
+        headers=headers,
+    )
+    file_id = response.get_json()["file"]["id"]
+
+    def issue(remote_addr: str, bind: bool) -> str:
+        response = client.post(
+            f"/api/files/{file_id}/download-url",
+            json={"bindClient": bind},
+            environ_base={"REMOTE_ADDR": remote_addr},
+        )
+        return response.get_json()["url"]
+
+    def status(url: str, remote_addr: str) -> int:
+        return client.get(url, environ_base={"REMOTE_ADDR": remote_addr}).status_code
+
+    unbound = issue("10.1.2.3", bind=False)
+    bound = issue("10.1.2.3", bind=True)
+    checks = [
+        ("unbound URL", status(unbound, "6.6.6.6"), 200),
+        ("bound URL from its client", status(bound, "10.1.2.3"), 200),
+        ("bound URL from another client", status(bound, "6.6.6.6"), 403),
+        (
+            "bound URL without bind=1",
+            status(bound.replace("&bind=1", ""), "6.6.6.6"),
+            403,
+        ),
+        (
+            "bound URL without bind=1, address moved into the path",
+            status(
+                bound.replace("&bind=1", "").replace("?", "10.1.2.3?", 1), "6.6.6.6"
+            ),
+            403,
+        ),
+        ("unbound URL with bind=1 added", status(unbound + "&bind=1", "6.6.6.6"), 403),
+        (
+            "changed signature",
+            status(unbound.replace("sig=", "sig=A"), "6.6.6.6"),
+            403,
+        ),
+        (
+            "changed expiry",
+            status(unbound.replace("expires=", "expires=9"), "6.6.6.6"),
+            403,
+        ),
+        (
+            "changed file name",
+            status(unbound.replace("check.txt", "other.txt"), "6.6.6.6"),
+            403,
+        ),
+    ]
+
+    failed = 0
+    for name, actual, expected in checks:
+        ok = actual == expected
+        failed += not ok
+        print(f"{'ok' if ok else 'FAIL':4}  {name}: {actual} (expected {expected})")
+    server.state.close()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Typed file metadata.
+
+Timestamps are kept as integer microseconds since the Unix epoch so status
+checks and sorting are plain integer comparisons; they are only formatted as
+ISO 8601 strings when a record is serialized to JSON.
+"""
+
+import time
+from datetime import datetime, timedelta, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+US_PER_HOUR = 3600 * 1_000_000
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def to_epoch_us(value: datetime) -> int:
+    """
+    Epoch microseconds of a datetime; naive datetimes are taken as UTC.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def from_epoch_us(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value)
+
+
+def isoformat_us(value: int | None) -> str | None:
+    if value is None:
+        return None
+    return from_epoch_us(value).isoformat()
+
+
+class FileRecord:
+    """
+    Metadata of one shared file. `__slots__` keeps per-file memory small.
+    """
+
+    __slots__ = (
+        "id",
+        "filename",
+        "size",
+        "blob_key",
+        "sha256",
+        "mime_type",
+        "share_token",
+        "owner_email",
+        "is_public",
+        "password",
+        "available_from",
+        "available_to",
+        "shared_with",
+        "share_link",
+        "created_at",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        filename: str,
+        size: int,
+        blob_key: str,
+        sha256: str,
+        mime_type: str,
+        share_token: str,
+        owner_email: str | None,
+        is_public: bool,
+        password: str | None,
+        available_from: int,
+        available_to: int,
+        shared_with: frozenset,
+        share_link: str,
+        created_at: int,
+    ):
+        self.id = id
+        self.filename = filename
+        self.size = size
+        self.blob_key = blob_key
+        self.sha256 = sha256
+        self.mime_type = mime_type
+        self.share_token = share_token
+        self.owner_email = owner_email
+        self.is_public = is_public
+        self.password = password
+        self.available_from = available_from
+        self.available_to = available_to
+        self.shared_with = shared_with
+        self.share_link = share_link
+        self.created_at = created_at
+
+    @property
+    def password_protected(self) -> bool:
+        return bool(self.password)
+
+    def status(self, now: int) -> str:
+        if now < self.available_from:
+            return "pending"
+        if now > self.available_to:
+            return "expired"
+        return "active"
+
+    def next_transition(self, now: int) -> int | None:
+        """
+        When status() next changes after `now`, or None once expired.
+        """
+        if now < self.available_from:
+            return self.available_from
+        if now <= self.available_to:
+            return self.available_to + 1
+        return None
+
+    def to_dict(self) -> dict:
+        """
+        API representation, in the shape the JSON endpoints have always used.
+        """
+        data = {
+            "id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "mimeType": self.mime_type,
+            "shareToken": self.share_token,
+            "ownerEmail": self.owner_email,
+            "isPublic": self.is_public,
+            "passwordProtected": self.password_protected,
+            "availableFrom": isoformat_us(self.available_from),
+            "availableTo": isoformat_us(self.available_to),
+            "sharedWith": sorted(self.shared_with),
+            "shareLink": self.share_link,
+            "createdAt": isoformat_us(self.created_at),
+        }
+        return data
@@ -1,26 +1,141 @@
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Request, jsonify, request, send_file
 from flask_cors import CORS
 
 from datetime import datetime, timezone, timedelta
 import uuid
 import base64
-import io
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from werkzeug.exceptions import RequestEntityTooLarge, RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
 
+import access
+from access import AccessDecisionCache
+from blobstore import COPY_CHUNK_SIZE, LocalBlobStore
+from passwords import PasswordHasher, PasswordHasherBusy, is_password_hash
+from presign import DownloadUrlSigner
+from records import (
+    US_PER_HOUR,
+    FileRecord,
+    from_epoch_us,
+    isoformat_us,
+    now_us,
+    to_epoch_us,
+)
+from sessions import SessionStore
+from sqlite_state import SQLiteBackend
+from state import MemoryBackend, sort_key
+from stats import DownloadRollup
+from tokens import TokenDenylist, TokenSigner, b64url_encode, is_signed_token
+from totp import QrCodeCache
+from uploads import ChunkError, UploadSessionStore
+
+# Uploaded contents live on disk; metadata only keeps the blob key
+DATA_DIR = os.environ.get("DATA_DIR", os.path.join(os.path.dirname(__file__), "data"))
+BLOB_STORAGE_DIR = os.environ.get("BLOB_STORAGE_DIR", os.path.join(DATA_DIR, "blobs"))
+# When set (e.g. "/_blobs/"), downloads are handed to nginx via X-Accel-Redirect
+BLOB_ACCEL_REDIRECT_PREFIX = os.environ.get("BLOB_ACCEL_REDIRECT_PREFIX")
+# Range requests asking for more parts than this get the whole body instead
+MAX_BYTERANGES = 8
+
+# Resumable uploads: chunk size is negotiated within these bounds and idle
+# sessions are garbage-collected after the TTL
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+MIN_UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_SESSION_TTL_SECONDS = int(
+    os.environ.get("UPLOAD_SESSION_TTL_SECONDS", 24 * 60 * 60)
+)
+
+
+class UploadSpool:
+    """
+    Write target for an uploaded file part. Bytes go straight into a blob store
+    staging file; they are counted and hashed as the multipart parser streams
+    them in and the upload is aborted with 413 as soon as the limit is crossed,
+    so an oversized upload is rejected before the rest of the body is read.
+    """
+
+    def __init__(self, limit: int | None = None):
+        self.limit = limit
+        self.size = 0
+        self.committed = False
+        self._hash = hashlib.sha256()
+        self._file = blob_store.open_staging()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            self.close()
+            raise RequestEntityTooLarge()
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def commit(self) -> str:
+        """
+        Move the staged bytes into the blob store and return the blob key.
+        """
+        self._file.close()
+        key = blob_store.commit(self._file.name, self.sha256)
+        self.committed = True
+        return key
+
+    def close(self):
+        self._file.close()
+        if not self.committed:
+            blob_store.discard(self._file.name)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    # Set by upload handlers before touching request.files
+    max_upload_bytes: int | None = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_spools = []
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        spool = UploadSpool(self.max_upload_bytes)
+        self.upload_spools.append(spool)
+        return spool
+
+    def close(self):
+        super().close()
+        # Also covers parts parsed before an aborted upload
+        for spool in self.upload_spools:
+            spool.close()
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # cors for localhost:3000 make request
 CORS(
     app,
     resources={r"/api/*": {"origins": "*"}},
     supports_credentials=True,
+    expose_headers=["X-Download-Token"],
 )
 
 # Mock "database"
 
-# Users stored in memory:
-users = {
-    "jitensha@hcmut.edu.vn": {
+# Users created on first start (and on every start with the memory backend)
+SEED_USERS = [
+    {
         "id": str(uuid.uuid4()),
         "username": "jitensha",
         "email": "jitensha@hcmut.edu.vn",
@@ -29,7 +144,7 @@ users = {
         "totp_enabled": False,
         "totp_secret": None,
     },
-    "eenose@hcmut.edu.vn": {
+    {
         "id": str(uuid.uuid4()),
         "username": "eenose",
         "email": "eenose@hcmut.edu.vn",
@@ -38,7 +153,7 @@ users = {
         "totp_enabled": True,
         "totp_secret": None,
     },
-    "bigbluewhale@hcmut.edu.vn": {
+    {
         "id": str(uuid.uuid4()),
         "username": "bigbluewhale",
         "email": "bigbluewhale@hcmut.edu.vn",
@@ -47,31 +162,227 @@ users = {
         "totp_enabled": False,
         "totp_secret": None,
     },
-}
+]
 
-# Active sessions:
-# sessions[token] = email
-sessions = {}
-
-# Temp sessions waiting for TOTP:
-# totp_temp_sessions[cid] = email
-totp_temp_sessions = {}
+DEFAULT_POLICY = {
+    "id": 1,
+    "maxFileSizeMB": 50,
+    "minValidityHours": 1,
+    "maxValidityDays": 30,
+    "defaultValidityDays": 7,
+    "requirePasswordMinLength": 6,
+}
 
 # Very simple TOTP code for all users in this mock
 MOCK_TOTP_CODE = "123456"
+# QR codes of TOTP secrets are cached, TOTP_QR_CACHE_SIZE of them, and with
+# TOTP_QR_THREADS > 0 rendered on that many threads (see totp.py)
+TOTP_ISSUER = os.environ.get("TOTP_ISSUER", "FileSharing")
+TOTP_QR_CACHE_SIZE = int(os.environ.get("TOTP_QR_CACHE_SIZE", 1024))
+TOTP_QR_THREADS = int(os.environ.get("TOTP_QR_THREADS", 0))
+
+# Unique downloaders are counted exactly up to this many per file, then with a
+# HyperLogLog sketch of 2**precision registers; 0 keeps exact sets (memory
+# backend only, the SQLite backend always counts exactly)
+UNIQUE_DOWNLOADERS_HLL_THRESHOLD = int(
+    os.environ.get("UNIQUE_DOWNLOADERS_HLL_THRESHOLD", 0)
+)
+UNIQUE_DOWNLOADERS_HLL_PRECISION = int(
+    os.environ.get("UNIQUE_DOWNLOADERS_HLL_PRECISION", 12)
+)
+# Also count anonymous downloaders, keyed on a salted hash of IP and user agent.
+# Worker processes must share the salt (gunicorn.conf.py sets one for them)
+COUNT_ANONYMOUS_DOWNLOADERS = os.environ.get(
+    "COUNT_ANONYMOUS_DOWNLOADERS", "false"
+).lower() in ("1", "true", "yes", "on")
+FINGERPRINT_SALT = (
+    bytes.fromhex(os.environ["FINGERPRINT_SALT"])
+    if os.environ.get("FINGERPRINT_SALT")
+    else os.urandom(16)
+)
+
+# Passwords are hashed with scrypt by PASSWORD_HASH_WORKERS processes (0: in
+# the request thread); past PASSWORD_HASH_MAX_PENDING waiting checks requests
+# get 503. Successful file password checks are cached for
+# FILE_PASSWORD_CACHE_TTL_SECONDS, up to FILE_PASSWORD_CACHE_SIZE of them.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", 64))
+FILE_PASSWORD_CACHE_TTL_SECONDS = float(
+    os.environ.get("FILE_PASSWORD_CACHE_TTL_SECONDS", 5 * 60)
+)
+FILE_PASSWORD_CACHE_SIZE = int(os.environ.get("FILE_PASSWORD_CACHE_SIZE", 10_000))
+FILE_PASSWORD_CACHE_KEY = os.urandom(32)
+
+# Access decisions per (file, user) are cached up to the file's next status
+# change, and at most this long. Another worker's delete is not seen, but the
+# file lookup before every check already fails for deleted files.
+ACCESS_DECISION_CACHE_TTL_SECONDS = float(
+    os.environ.get("ACCESS_DECISION_CACHE_TTL_SECONDS", 60)
+)
+ACCESS_DECISION_CACHE_SIZE = int(os.environ.get("ACCESS_DECISION_CACHE_SIZE", 100_000))
+
+# Most users /api/admin/users/import accepts in one request, and most of them
+# with a plaintext password: those are hashed during the request, which must
+# finish well within the server timeout (about 70 ms per password and worker),
+# and each counts against PASSWORD_HASH_MAX_PENDING. Larger imports should
+# send passwordHash instead.
+MAX_IMPORT_USERS = 50_000
+MAX_IMPORT_PLAINTEXT_PASSWORDS = min(
+    int(os.environ.get("MAX_IMPORT_PLAINTEXT_PASSWORDS", 32)),
+    PASSWORD_HASH_MAX_PENDING,
+)
+
+# Longest series /api/files/stats/timeline returns in one call
+MAX_TIMELINE_BUCKETS = 2000
+
+# With the memory backend, the newest DOWNLOAD_HISTORY_MEMORY_ENTRIES history
+# entries per file stay in memory and older ones spill to DATA_DIR/history
+DOWNLOAD_HISTORY_MEMORY_ENTRIES = int(
+    os.environ.get("DOWNLOAD_HISTORY_MEMORY_ENTRIES", 100)
+)
+if DOWNLOAD_HISTORY_MEMORY_ENTRIES < 1:
+    raise ValueError("DOWNLOAD_HISTORY_MEMORY_ENTRIES must be at least 1")
+
+# Where users, sessions, files and stats live: "memory" (lost on restart) or
+# "sqlite" (a WAL-mode database at SQLITE_PATH)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(DATA_DIR, "mockbe.sqlite3"))
+# Download events are queued and applied in batches of up to this many, at
+# least every DOWNLOAD_FLUSH_INTERVAL_SECONDS. With SQLite, stats read from one
+# worker see other workers' downloads after at most that delay
+DOWNLOAD_BATCH_SIZE = int(os.environ.get("DOWNLOAD_BATCH_SIZE", 256))
+DOWNLOAD_FLUSH_INTERVAL_SECONDS = float(
+    os.environ.get("DOWNLOAD_FLUSH_INTERVAL_SECONDS", 1.0)
+)
+
+# Login sessions end SESSION_ABSOLUTE_TTL_SECONDS after login or after
+# SESSION_IDLE_TTL_SECONDS without a request; past SESSION_CAPACITY the least
+# recently used one is dropped. Logins waiting for a TOTP code get a short TTL
+# so abandoned ones do not pile up. 0 disables a limit.
+SESSION_ABSOLUTE_TTL_SECONDS = float(
+    os.environ.get("SESSION_ABSOLUTE_TTL_SECONDS", 7 * 24 * 60 * 60)
+)
+SESSION_IDLE_TTL_SECONDS = float(
+    os.environ.get("SESSION_IDLE_TTL_SECONDS", 24 * 60 * 60)
+)
+SESSION_CAPACITY = int(os.environ.get("SESSION_CAPACITY", 100_000))
+TOTP_SESSION_TTL_SECONDS = float(os.environ.get("TOTP_SESSION_TTL_SECONDS", 5 * 60))
+TOTP_SESSION_CAPACITY = int(os.environ.get("TOTP_SESSION_CAPACITY", 10_000))
+SESSION_LIMITS = (
+    SESSION_ABSOLUTE_TTL_SECONDS,
+    SESSION_IDLE_TTL_SECONDS,
+    SESSION_CAPACITY,
+)
+TOTP_SESSION_LIMITS = (TOTP_SESSION_TTL_SECONDS, 0, TOTP_SESSION_CAPACITY)
+# Seconds between sweeps dropping expired sessions; lookups drop them anyway
+SESSION_SWEEP_INTERVAL_SECONDS = float(
+    os.environ.get("SESSION_SWEEP_INTERVAL_SECONDS", 60)
+)
+
+# "session" issues opaque tokens looked up in the session store; "signed"
+# issues HMAC-signed tokens checked without one (see tokens.py). Every process
+# must share ACCESS_TOKEN_SECRET. Logouts of signed tokens reach other
+# processes within TOKEN_DENYLIST_REFRESH_SECONDS.
+ACCESS_TOKEN_MODE = os.environ.get("ACCESS_TOKEN_MODE", "session")
+ACCESS_TOKEN_SECRET = (
+    bytes.fromhex(os.environ["ACCESS_TOKEN_SECRET"])
+    if os.environ.get("ACCESS_TOKEN_SECRET")
+    else os.urandom(32)
+)
+ACCESS_TOKEN_TTL_SECONDS = float(
+    os.environ.get("ACCESS_TOKEN_TTL_SECONDS", 24 * 60 * 60)
+)
+TOKEN_DENYLIST_REFRESH_SECONDS = float(
+    os.environ.get("TOKEN_DENYLIST_REFRESH_SECONDS", 1.0)
+)
 
+# Presigned download URLs (see presign.py). "md5" signs them in the format
+# nginx's secure_link_md5 checks, so nginx serves them without the backend;
+# every process, and nginx, must then share PRESIGNED_URL_SECRET.
+PRESIGNED_URL_SIGNATURE = os.environ.get("PRESIGNED_URL_SIGNATURE", "hmac")
+PRESIGNED_URL_SECRET = os.environ.get("PRESIGNED_URL_SECRET", "")
+if not PRESIGNED_URL_SECRET:
+    if PRESIGNED_URL_SIGNATURE == "md5":
+        raise ValueError(
+            "PRESIGNED_URL_SIGNATURE=md5 needs PRESIGNED_URL_SECRET, shared with nginx"
+        )
+    PRESIGNED_URL_SECRET = os.urandom(32).hex()
+PRESIGNED_URL_TTL_SECONDS = int(os.environ.get("PRESIGNED_URL_TTL_SECONDS", 300))
+PRESIGNED_URL_MAX_TTL_SECONDS = int(
+    os.environ.get("PRESIGNED_URL_MAX_TTL_SECONDS", 3600)
+)
+# Header a trusted proxy puts the client address in (e.g. X-Real-IP). URLs
+# bound to a client must name the address nginx sees, not the proxy's.
+PRESIGNED_URL_CLIENT_HEADER = os.environ.get("PRESIGNED_URL_CLIENT_HEADER")
+
+# A download's first response carries an X-Download-Token; later range
+# requests of the same download that send it back skip the access check and
+# are not counted again. Tokens are signed with PRESIGNED_URL_SECRET.
+DOWNLOAD_TOKEN_TTL_SECONDS = int(os.environ.get("DOWNLOAD_TOKEN_TTL_SECONDS", 6 * 3600))
+
+# Started before the state backend, so its threads and connections are not
+# forked into the hash workers
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+password_hasher.start()
+
+if STATE_BACKEND == "sqlite":
+    os.makedirs(os.path.dirname(os.path.abspath(SQLITE_PATH)), exist_ok=True)
+    state = SQLiteBackend(
+        SQLITE_PATH,
+        SEED_USERS,
+        DEFAULT_POLICY,
+        batch_size=DOWNLOAD_BATCH_SIZE,
+        flush_interval=DOWNLOAD_FLUSH_INTERVAL_SECONDS,
+        session_limits=SESSION_LIMITS,
+        totp_session_limits=TOTP_SESSION_LIMITS,
+    )
+elif STATE_BACKEND == "memory":
+    state = MemoryBackend(
+        SEED_USERS,
+        DEFAULT_POLICY,
+        os.path.join(DATA_DIR, "history"),
+        DOWNLOAD_HISTORY_MEMORY_ENTRIES,
+        UNIQUE_DOWNLOADERS_HLL_THRESHOLD,
+        UNIQUE_DOWNLOADERS_HLL_PRECISION,
+        batch_size=DOWNLOAD_BATCH_SIZE,
+        flush_interval=DOWNLOAD_FLUSH_INTERVAL_SECONDS,
+        session_limits=SESSION_LIMITS,
+        totp_session_limits=TOTP_SESSION_LIMITS,
+    )
+else:
+    raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+
+# Blob reference counts and upload sessions are kept by the state backend, so
+# with SQLite they are shared by every worker process
+blob_store = LocalBlobStore(BLOB_STORAGE_DIR, refs=state.blob_reference_counts())
+if STATE_BACKEND == "memory":
+    # No file record survived the last restart, so no stored blob is referenced
+    blob_store.clear()
+upload_sessions = UploadSessionStore(
+    blob_store, UPLOAD_SESSION_TTL_SECONDS, registry=state.upload_registry()
+)
+
+file_password_cache = SessionStore(
+    FILE_PASSWORD_CACHE_TTL_SECONDS, 0, FILE_PASSWORD_CACHE_SIZE
+)
 
-# In-memory file store for uploaded files (mock)
-# files[file_id] = { id, filename, size, ownerEmail, isPublic, passwordProtected, password, availableFrom, availableTo, sharedWith, shareLink, totpEnabled }
-files = {}
+access_decisions = AccessDecisionCache(
+    ACCESS_DECISION_CACHE_TTL_SECONDS, ACCESS_DECISION_CACHE_SIZE
+)
+download_urls = DownloadUrlSigner(PRESIGNED_URL_SECRET, PRESIGNED_URL_SIGNATURE)
+totp_qr_codes = QrCodeCache(TOTP_ISSUER, TOTP_QR_CACHE_SIZE, TOTP_QR_THREADS)
 
-# Statistics
-# file_stats[file_id] = { downloadCount: int, uniqueDownloaders: set(emails), lastDownloadedAt: datetime }
-file_stats = {}
+if ACCESS_TOKEN_MODE == "signed":
+    token_signer = TokenSigner(ACCESS_TOKEN_SECRET, ACCESS_TOKEN_TTL_SECONDS)
+    token_denylist = TokenDenylist(state, TOKEN_DENYLIST_REFRESH_SECONDS)
+elif ACCESS_TOKEN_MODE == "session":
+    token_signer = None
+    token_denylist = None
+else:
+    raise ValueError(f"Unknown ACCESS_TOKEN_MODE: {ACCESS_TOKEN_MODE}")
 
-# Download History
-# download_history[file_id] = [ { id, downloader: {username, email} | null, downloadedAt, downloadCompleted } ]
-download_history = {}
+# Seconds between background cleanup sweeps; 0 leaves cleanup to the admin API
+CLEANUP_INTERVAL_SECONDS = float(os.environ.get("CLEANUP_INTERVAL_SECONDS", 0))
 
 
 # Helper functions
@@ -79,20 +390,66 @@ def create_token(prefix: str = "token") -> str:
     return f"{prefix}-{uuid.uuid4().hex}"
 
 
-def get_current_user():
+def issue_access_token(user: dict) -> str:
     """
-    Read Authorization: Bearer <token> and return (token, user_dict) or (None, None)
+    Access token for a user who just logged in: a signed token, or an opaque
+    one backed by a session.
+    """
+    if token_signer is not None:
+        return token_signer.issue(user)
+    token = create_token("token")
+    state.add_session(token, user["email"])
+    return token
+
+
+def user_from_signed_token(token: str, load: bool = False) -> dict | None:
+    """
+    The user a signed token was issued to, built from its claims alone (id,
+    username, email, role) with no store lookup. With `load` the stored
+    record is returned instead, for handlers that need more of it; a role
+    change only shows there until the token expires.
+    """
+    claims = token_signer.verify(token)
+    if claims is None or token_denylist.is_revoked(claims["jti"]):
+        return None
+    if not load:
+        return {
+            "id": claims["sub"],
+            "username": claims.get("username"),
+            "email": claims["email"],
+            "role": claims["role"],
+        }
+    user = state.get_user_by_id(claims["sub"])
+    # A changed email or role invalidates older tokens
+    if (
+        not user
+        or user["email"] != claims["email"]
+        or user.get("role", "user") != claims["role"]
+    ):
+        return None
+    return user
+
+
+def get_current_user(load: bool = False):
+    """
+    Read Authorization: Bearer <token> and return (token, user_dict) or (None, None).
+    Users of signed tokens only carry id, username, email and role unless
+    `load` asks for the whole stored record.
     """
     auth_header = request.headers.get("Authorization", "")
     if not auth_header.startswith("Bearer "):
         return None, None
 
     token = auth_header.split(" ", 1)[1].strip()
-    email = sessions.get(token)
+    if token_signer is not None and is_signed_token(token):
+        user = user_from_signed_token(token, load)
+        return (token, user) if user else (None, None)
+
+    email = state.get_session(token)
     if not email:
         return None, None
 
-    user = users.get(email)
+    user = state.get_user(email)
     if not user:
         return None, None
 
@@ -109,86 +466,215 @@ def serialize_user(user: dict) -> dict:
     }
 
 
-def get_file_status(file_meta: dict) -> str:
+def get_file_status(file_meta: FileRecord) -> str:
     """
     Determines the status of a file based on its availableFrom and availableTo dates.
     """
-    now = datetime.now(timezone.utc)
-    available_from_str = file_meta.get("availableFrom")
-    available_to_str = file_meta.get("availableTo")
+    return file_meta.status(now_us())
 
-    available_from = None
-    available_to = None
 
-    if available_from_str:
-        available_from = datetime.fromisoformat(
-            available_from_str.replace("Z", "+00:00")
+def serialize_file_meta(file_meta: FileRecord) -> dict:
+    response_file = file_meta.to_dict()
+    owner = state.get_user(file_meta.owner_email) if file_meta.owner_email else None
+    response_file["owner"] = serialize_user(owner) if owner else None
+    return response_file
+
+
+def blob_validators(file_meta: FileRecord):
+    """
+    (etag, last_modified) for a file's contents. The ETag is the content hash;
+    a file's blob never changes after upload.
+    """
+    created_at = from_epoch_us(file_meta.created_at)
+    return file_meta.sha256, created_at.replace(microsecond=0)
+
+
+def requested_ranges(file_meta: FileRecord):
+    """
+    Byte ranges asked for by a Range request, as sorted, merged (start, stop)
+    pairs clipped to the file size. Returns None when the whole body should be
+    sent: no Range header, an If-Range validator that no longer matches, or
+    more parts than MAX_BYTERANGES. Raises 416 if no range is satisfiable.
+    """
+    rng = request.range
+    size = file_meta.size
+    if rng is None or rng.units != "bytes" or size == 0:
+        return None
+
+    etag, last_modified = blob_validators(file_meta)
+    if "If-Range" in request.headers and is_resource_modified(
+        request.environ, etag, last_modified=last_modified, ignore_if_range=False
+    ):
+        return None
+
+    if len(rng.ranges) > MAX_BYTERANGES:
+        return None
+
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(0, size + start), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+
+    if not ranges:
+        raise RequestedRangeNotSatisfiable(length=size)
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, stop in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def iter_blob_range(path: str, start: int, stop: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def send_blob_ranges(file_meta: FileRecord, mimetype: str, ranges):
+    """
+    206 response for one range, or multipart/byteranges for several.
+    """
+    path = blob_store.path(file_meta.blob_key)
+    size = file_meta.size
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response = app.response_class(
+            iter_blob_range(path, start, stop), status=206, mimetype=mimetype
         )
-    if available_to_str:
-        available_to = datetime.fromisoformat(available_to_str.replace("Z", "+00:00"))
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response.content_length = stop - start
+        return response
+
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (
+            f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode("ascii")
+        for start, stop in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    def generate():
+        for header, (start, stop) in zip(part_headers, ranges):
+            yield header
+            yield from iter_blob_range(path, start, stop)
+        yield closing
+
+    response = app.response_class(
+        generate(),
+        status=206,
+        mimetype=f"multipart/byteranges; boundary={boundary}",
+    )
+    response.content_length = (
+        sum(len(h) for h in part_headers)
+        + sum(stop - start for start, stop in ranges)
+        + len(closing)
+    )
+    return response
 
-    if available_from and now < available_from:
-        return "pending"
-    if available_to and now > available_to:
-        return "expired"
 
-    return "active"
+def send_blob(file_meta: FileRecord, mimetype: str, as_attachment: bool, ranges=None):
+    """
+    Send a file's stored blob without copying it through Python: nginx serves it
+    when X-Accel-Redirect is configured, otherwise send_file gets a real path so
+    the WSGI server can use sendfile. `ranges` comes from requested_ranges().
+    """
+    key = file_meta.blob_key
+    etag, last_modified = blob_validators(file_meta)
+    if BLOB_ACCEL_REDIRECT_PREFIX:
+        # nginx answers Range/If-Range itself for the redirected location
+        response = app.response_class(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = (
+            BLOB_ACCEL_REDIRECT_PREFIX + blob_store.relative_path(key)
+        )
+    elif ranges:
+        response = send_blob_ranges(file_meta, mimetype, ranges)
+        response.accept_ranges = "bytes"
+    else:
+        return send_file(
+            blob_store.path(key) or blob_store.open(key),
+            mimetype=mimetype,
+            as_attachment=as_attachment,
+            download_name=file_meta.filename,
+            etag=etag,
+            last_modified=last_modified,
+        )
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers.set(
+        "Content-Disposition",
+        "attachment" if as_attachment else "inline",
+        filename=file_meta.filename,
+    )
+    return response
 
 
-def validate_file_access(file_meta: dict, user: dict, password_header: str):
+def validate_file_access(file_meta: FileRecord, user: dict, password_header: str):
     """
     Validates access to a file based on status, whitelist, and password.
     Returns (error_response, status_code) if access is denied, otherwise (None, None).
+    Everything but the password check is cached per (file, user), see access.py.
     """
-    status = get_file_status(file_meta)
-    is_owner = user and user["email"] == file_meta.get("ownerEmail")
+    now = now_us()
+    decision = access_decisions.decide(file_meta, user["email"] if user else None, now)
 
-    if status == "expired":
+    if decision == access.EXPIRED:
         return jsonify(
             {
                 "error": "File expired",
-                "expiredAt": file_meta.get("availableTo"),
+                "expiredAt": isoformat_us(file_meta.available_to),
                 "message": "File has expired",
             }
         ), 410
 
-    if status == "pending" and not is_owner:
-        hours_until = 0
-        if file_meta.get("availableFrom"):
-            frm = datetime.fromisoformat(file_meta["availableFrom"])
-            diff = frm - datetime.now(timezone.utc)
-            hours_until = max(0, diff.total_seconds() / 3600)
+    if decision == access.PENDING:
+        hours_until = max(0, (file_meta.available_from - now) / US_PER_HOUR)
         return jsonify(
             {
                 "error": "File not yet available",
-                "availableFrom": file_meta.get("availableFrom"),
+                "availableFrom": isoformat_us(file_meta.available_from),
                 "hoursUntilAvailable": hours_until,
                 "message": "File not yet available",
             }
         ), 423
 
-    shared_with = file_meta.get("sharedWith", [])
-    if not file_meta["isPublic"] or shared_with:
-        if not user:
-            return jsonify(
-                {
-                    "error": "Unauthorized",
-                    "message": "Authentication required for private file",
-                }
-            ), 401
+    if decision == access.LOGIN_REQUIRED:
+        return jsonify(
+            {
+                "error": "Unauthorized",
+                "message": "Authentication required for private file",
+            }
+        ), 401
 
-        if shared_with:
-            if user["email"] not in shared_with and not is_owner:
-                return jsonify(
-                    {
-                        "error": "Access denied",
-                        "message": "You are not in the shared list",
-                    }
-                ), 403
-        elif not file_meta["isPublic"] and not is_owner:
-            return jsonify({"error": "Access denied", "message": "Private file"}), 403
+    if decision == access.NOT_SHARED:
+        return jsonify(
+            {
+                "error": "Access denied",
+                "message": "You are not in the shared list",
+            }
+        ), 403
 
-    if file_meta["passwordProtected"]:
+    if decision == access.PRIVATE:
+        return jsonify({"error": "Access denied", "message": "Private file"}), 403
+
+    if file_meta.password_protected:
         if not password_header:
             return jsonify(
                 {
@@ -196,7 +682,7 @@ def validate_file_access(file_meta: dict, user: dict, password_header: str):
                     "message": "This file is password-protected. Please provide the password parameter",
                 }
             ), 403
-        if password_header != file_meta.get("password"):
+        if not file_password_matches(file_meta, password_header):
             return jsonify(
                 {
                     "error": "Incorrect password",
@@ -207,50 +693,86 @@ def validate_file_access(file_meta: dict, user: dict, password_header: str):
     return None, None
 
 
+def file_password_matches(file_meta: FileRecord, password: str) -> bool:
+    """
+    Check an X-File-Password against the file's hash. Successful checks are
+    remembered for a short while, so resumed and repeated downloads skip the
+    KDF. The cache key holds a keyed digest of the password, never the
+    password, and the stored hash, so changing the password misses.
+    """
+    digest = hmac.new(FILE_PASSWORD_CACHE_KEY, password.encode("utf-8"), "sha256")
+    key = (file_meta.id, file_meta.password, digest.digest())
+    now = now_us()
+    if file_password_cache.get(key, now):
+        return True
+    if not password_hasher.verify(password, file_meta.password):
+        return False
+    file_password_cache.put(key, True, now)
+    return True
+
+
 # temporary /auth endpoints
-@app.post("/api/auth/register")
-def register():
+CONFLICT_MESSAGES = {
+    "email": "Email already exists",
+    "username": "Username already exists",
+}
+
+
+def build_user(data: dict, roles=("user",), accept_hashes: bool = False):
     """
-    Mock user registration.
-    Body: { "username": string, "email": string, "password": string }
+    New user from a registration body, with its password still in plaintext
+    (or, with `accept_hashes`, an already hashed "passwordHash"). Returns
+    (user, None), or (None, message) if the body is invalid.
     """
-    data = request.get_json(silent=True) or {}
     username = data.get("username")
     email = data.get("email")
     password = data.get("password")
+    role = data.get("role", "user")
+    if accept_hashes and not password and data.get("passwordHash"):
+        password = data["passwordHash"]
+        if not isinstance(password, str) or not is_password_hash(password):
+            return None, "passwordHash must be an scrypt hash"
 
     if not username or not email or not password:
-        return jsonify(
-            {
-                "error": "Validation error",
-                "message": "username, email and password are required",
-            }
-        ), 400
+        return None, "username, email and password are required"
+    if not all(isinstance(value, str) for value in (username, email, password)):
+        return None, "username, email and password must be strings"
+    if role not in roles:
+        return None, f"role must be one of: {', '.join(roles)}"
 
-    if email in users:
-        return jsonify({"error": "Conflict", "message": "Email already exists"}), 409
-
-    for u in users.values():
-        if u["username"] == username:
-            return jsonify(
-                {"error": "Conflict", "message": "Username already exists"}
-            ), 409
-
-    user_id = str(uuid.uuid4())
-    users[email] = {
-        "id": user_id,
+    return {
+        "id": str(uuid.uuid4()),
         "email": email,
         "username": username,
         "password": password,
-        "role": "user",
+        "role": role,
         "totp_enabled": False,
         "totp_secret": None,
-    }
+    }, None
+
+
+@app.post("/api/auth/register")
+def register():
+    """
+    Mock user registration.
+    Body: { "username": string, "email": string, "password": string }
+    """
+    data = request.get_json(silent=True) or {}
+    user, message = build_user(data)
+    if message:
+        return jsonify({"error": "Validation error", "message": message}), 400
+
+    user["password"] = password_hasher.hash(user["password"])
+    conflict = state.add_user(user)
+    if conflict:
+        return jsonify(
+            {"error": "Conflict", "message": CONFLICT_MESSAGES[conflict]}
+        ), 409
 
     return jsonify(
         {
             "message": "User registered successfully",
-            "userId": user_id,
+            "userId": user["id"],
         }
     ), 200
 
@@ -265,16 +787,23 @@ def login():
     email = data.get("email")
     password = data.get("password")
 
-    user = users.get(email)
-    if not user or user["password"] != password:
+    user = state.get_user(email)
+    if (
+        not user
+        or not isinstance(password, str)
+        or not password_hasher.verify(password, user["password"])
+    ):
         return jsonify(
             {"error": "Unauthorized", "message": "Invalid email or password"}
         ), 401
+    if not is_password_hash(user["password"]):
+        # Stored before passwords were hashed
+        user["password"] = password_hasher.hash(password)
+        state.save_user(user)
 
-    global totp_temp_sessions
     if user["totp_enabled"]:
         cid = str(uuid.uuid4())
-        totp_temp_sessions[cid] = email
+        state.add_totp_session(cid, email)
         return jsonify(
             {
                 "requireTOTP": True,
@@ -283,8 +812,7 @@ def login():
             }
         ), 200
     else:
-        token = create_token("token")
-        sessions[token] = email
+        token = issue_access_token(user)
         return jsonify(
             {
                 "accessToken": token,
@@ -308,7 +836,7 @@ def login_totp():
             {"error": "Validation error", "message": "cid and code are required"}
         ), 400
 
-    email = totp_temp_sessions.get(cid)
+    email = state.get_totp_session(cid)
     if not email:
         return jsonify(
             {
@@ -322,11 +850,9 @@ def login_totp():
             {"error": "Unauthorized", "message": "Invalid or expired TOTP code"}
         ), 401
 
-    token = create_token("token")
-    sessions[token] = email
-    del totp_temp_sessions[cid]
-
-    user = users.get(email)
+    user = state.get_user(email)
+    token = issue_access_token(user)
+    state.remove_totp_session(cid)
 
     return jsonify(
         {
@@ -339,23 +865,20 @@ def login_totp():
 
 @app.post("/api/auth/totp/setup")
 def totp_setup():
-    token, user = get_current_user()
+    token, user = get_current_user(load=True)
     if not user:
         return jsonify(
             {"error": "Unauthorized", "message": "Bearer token is required"}
         ), 401
 
     secret = "NB2W45DFOIZA===="  # Match example for consistency or keep random
-    qr_code = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAPoAAAD6CAYAAACI7Fo9AAAQAElEQVR4Aeydi3XcNhOFedSF0kZchqIypDJilSGXIbsMpYwkZeT3l5i/9VjOHS2GWJC8PhmvxQHm8YF342NguVe//vrrP0eyp6enf9SvCh7Pz89hmj///FNyf3x8DGNknNTR2s/NzY1MRa2tee7u7mSeigHcA621bm3+1eRfJmACuydgoe9+id2gCUyThe67wAQOQGBNoR8An1s0gW0QsNC3sU6u0gSaCFjoTfg82QS2QcBC38Y6uUoTaCIghX59fT1930cdzRbraaLxY3JFv3/99df09evXRfv27dtiD3P+73u1Pypa94U8c85Tr7/99ttiH3OP9Htq7strmS7meC2vmTxqjGLysq9L/xmNqn6k0Gn48+fP0+cNGDekajjjr+gVIT88PExLxo2s8sA+U2/rmLu7u3B9uZGX+piv//LLL2EMelU35B9//LHIa86TeW3lwXzFhH5Gscx9IoVO0zYTMIFtE7DQt71+rt4EUgQs9PeYfMUEdkfAQt/dkrohE3hPwEJ/z8RXTGB3BCz03S2pGzKB9wQs9PdM1rzi2CZwEQIlQv/y5ct0f3+/unEo4yKU3iRlv1f1y5g301b5kb3cqBb8qyQ+Iyi1PD4+Tkv2+++/y6jsby/Nn6/LIEUDIu5VPphVlFsidG7qHlbRcEUM3nBUvxV5MjFUHX///XcmTJcxHOyIjEM3qhAO3UQx8KkYFf7MPaDWJuOvWr8SoVeAcwwTMIH1CFjo67HtHdn5TGCRgIW+iMYOE9gPAQt9P2vpTkxgkYCFvojGDhPYDwELfT9ruWYnjr1xAhb6GQvINhDbPJGdEfbdFLZwlL2bdKELqk78FaWx3USsyCry7C2GhX7GirJXy4MjImPMGaFfTeHhFbe3t1Nk3PivJl3oh0ytiLO1PA5nRTzwtebY43wLfY+r6p5M4A0BC/0NEP/YnYATdiBgoXeA7BQmcGkCFvqlV8D5TaADAQu9A2SnMIFLE7DQL70Czr8mAcf+QcBC/wHCLyawZwIW+kqry5ce8JCEyNgTjozSovn4GNNqnAeI6sDXmqNqfoZrVa49xbHQV1pNvjUGIS4ZB2oQUGSUtjR/vs7pPMa1GIddojrwt8SvnAu3ufel18p8e4lloe9lJd1HbwKbymehb2q5XKwJnEfAQj+Pm2eZwKYIWOibWi4XawLnEbDQz+PmWSawJoHy2BZ6OVIHNIHxCFjo462JKzKBcgIlQucbNp6enqa1jSe7lBM4IyAP3mefPDLGnBH61RQOskQ58PFNHhF3vr3kVdATP/Rav4eHh4mal0z1Qp88aGNp/nz9RIurXKKetS2zfpnmSoSOAHtYpqEeY3hSCjdcZBV1RPFnHwdmIvaZOqL5lT7FLZNLxYBLpufWMZlaK8a01jnPfyH0+ZJfTcAE9kbAQt/birofEzhBwEI/AcWXTGBvBCz0va2o+zGBEwQ6Cf1EZl8yARPoRsBC74baiUzgcgSk0NmuYE94K1aBUvVKDj4XHRljVJxoPj62zogzgqle2PYaoc6qGuhH9TyKH42qvqXQaeb+/n7agvHwBNVwxq96hQkHGSKjligO/mg+Pg6AZOpdeww3fdQLvpEeTlHBg8M99LUF435UPUuhqwCX97sCEzABRcBCV4TsN4EdELDQd7CIbsEEFAELXRGy3wR2QMBCDxfRThPYBwELfR/r6C5MICRgoYd47DSBfRC44qEDRzIOorQuHfuWPCQhMg67RFyjubOPB0+oWtmPn8efeiVGVAc+9slPzZ2vsaes6tiSn3uAvo9kVxzKOJLxMIDWm5KTSBwQiUwxvb6+nqL5+MijamVcZMRQtUTz8fHGpurYkp97QDHZm99/dd/SHepaTeBMAhb6meA8zQS2RMBC39JquVYTOJOAhX4muLGnuToTeE3AQn/Nwz+... [truncated]"
 
     user["totp_secret"] = secret
+    state.save_user(user)
 
     return jsonify(
         {
-            "totpSetup": {
-                "secret": secret,
-                "qrCode": qr_code,
-            },
+            "totpSetup": totp_qr_codes.setup_payload(secret, user["email"]),
             "message": "TOTP secret generated",
         }
     ), 200
@@ -363,7 +886,7 @@ def totp_setup():
 
 @app.post("/api/auth/totp/verify")
 def totp_verify():
-    token, user = get_current_user()
+    token, user = get_current_user(load=True)
     if not user:
         return jsonify(
             {"error": "Unauthorized", "message": "Bearer token is required"}
@@ -386,6 +909,7 @@ def totp_verify():
         ), 400
 
     user["totp_enabled"] = True
+    state.save_user(user)
 
     return jsonify(
         {
@@ -397,7 +921,7 @@ def totp_verify():
 
 @app.post("/api/auth/totp/disable")
 def totp_disable():
-    token, user = get_current_user()
+    token, user = get_current_user(load=True)
     if not user:
         return jsonify({"error": "Unauthorized"}), 401
 
@@ -415,6 +939,7 @@ def totp_disable():
 
     user["totp_enabled"] = False
     user["totp_secret"] = None
+    state.save_user(user)
 
     return jsonify(
         {
@@ -435,8 +960,11 @@ def logout():
             }
         ), 401
 
-    if token in sessions:
-        del sessions[token]
+    if token_signer is not None and is_signed_token(token):
+        claims = token_signer.verify(token)
+        token_denylist.revoke(claims["jti"], claims["exp"])
+    else:
+        state.remove_session(token)
 
     return jsonify(
         {
@@ -445,6 +973,38 @@ def logout():
     ), 200
 
 
+def encode_cursor(sort_field: str, file_meta: FileRecord) -> str:
+    """
+    Opaque pagination cursor pointing just past `file_meta` in `sort_field`
+    order.
+    """
+    position = [sort_field, sort_key(file_meta, sort_field), file_meta.id]
+    raw = json.dumps(position, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_field: str):
+    """
+    (sort_key, file_id) position encoded in a cursor, or None if the cursor is
+    malformed or was issued for another sort field. The key must have the
+    type sort_key() gives for that field (a lowercased name or a microsecond
+    timestamp), or comparing it with the listing's keys would fail.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        field, sort_key, file_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        return None
+    key_type = str if sort_field == "fileName" else int
+    if (
+        field != sort_field
+        or type(sort_key) is not key_type
+        or not isinstance(file_id, str)
+    ):
+        return None
+    return sort_key, file_id
+
+
 @app.get("/api/files/my")
 def get_user_files():
     token, user = get_current_user()
@@ -458,59 +1018,61 @@ def get_user_files():
     limit = int(request.args.get("limit", 20))
     sort_by = request.args.get("sortBy", "createdAt")
     order = request.args.get("order", "desc")
+    after = request.args.get("after")
 
-    user_files_with_status = [
-        (file_meta, get_file_status(file_meta))
-        for file_meta in files.values()
-        if file_meta.get("ownerEmail") == user_email
-    ]
-
-    if status_filter != "all":
-        user_files_with_status = [
-            (file, status)
-            for file, status in user_files_with_status
-            if status == status_filter
-        ]
-
-    reverse_order = order == "desc"
-    if sort_by == "fileName":
-        user_files_with_status.sort(
-            key=lambda item: item[0].get("filename", "").lower(), reverse=reverse_order
-        )
-    else:
-        user_files_with_status.sort(
-            key=lambda item: item[0]["createdAt"], reverse=reverse_order
-        )
-
-    total_files = len(user_files_with_status)
-    start_index = (page - 1) * limit
-    end_index = start_index + limit
-    paginated_files_with_status = user_files_with_status[start_index:end_index]
+    sort_field = "fileName" if sort_by == "fileName" else "createdAt"
+    cursor = None
+    if after:
+        cursor = decode_cursor(after, sort_field)
+        if cursor is None:
+            return jsonify(
+                {"error": "Validation error", "message": "Invalid cursor"}
+            ), 400
 
-    serialized_files = []
+    now = now_us()
+    counts = state.owner_summary(user_email, now)
     summary = {
-        "activeFiles": 0,
-        "pendingFiles": 0,
-        "expiredFiles": 0,
-        "deletedFiles": 0,
+        "activeFiles": counts["active"],
+        "pendingFiles": counts["pending"],
+        "expiredFiles": counts["expired"],
+        "deletedFiles": counts["deleted"],
     }
 
-    for _, status in user_files_with_status:
-        if status == "active":
-            summary["activeFiles"] += 1
-        elif status == "pending":
-            summary["pendingFiles"] += 1
-        elif status == "expired":
-            summary["expiredFiles"] += 1
+    status = None
+    total_files = state.count_owner_files(user_email)
+    if status_filter != "all":
+        status = status_filter
+        # Deleted files are counted but no longer listed
+        total_files = counts.get(status_filter, 0) if status_filter != "deleted" else 0
+
+    # Deleted or unknown statuses have nothing to list
+    page_files = []
+    if status in (None, "active", "pending", "expired"):
+        # One extra file tells whether there is a next page
+        page_files = state.list_owner_files(
+            user_email,
+            sort_field,
+            descending=order == "desc",
+            now=now,
+            status=status,
+            after=cursor,
+            offset=0 if cursor else (page - 1) * limit,
+            limit=limit + 1,
+        )
+    next_cursor = None
+    if len(page_files) > limit:
+        page_files = page_files[:limit]
+        next_cursor = encode_cursor(sort_field, page_files[-1])
 
-    for file_meta, status in paginated_files_with_status:
+    serialized_files = []
+    for file_meta in page_files:
         serialized_files.append(
             {
-                "id": file_meta["id"],
-                "fileName": file_meta.get("filename", "N/A"),
-                "status": status,
-                "createdAt": file_meta["createdAt"],
-                "shareToken": file_meta.get("shareToken"),
+                "id": file_meta.id,
+                "fileName": file_meta.filename or "N/A",
+                "status": file_meta.status(now),
+                "createdAt": isoformat_us(file_meta.created_at),
+                "shareToken": file_meta.share_token,
             }
         )
 
@@ -520,6 +1082,7 @@ def get_user_files():
         "totalPages": total_pages,
         "totalFiles": total_files,
         "limit": limit,
+        "nextCursor": next_cursor,
     }
 
     return jsonify(
@@ -536,29 +1099,21 @@ def get_available_files():
     page = int(request.args.get("page", 1))
     limit = int(request.args.get("limit", 10))
 
-    # Filter public and active files
-    active_public_files = []
-    for file_meta in files.values():
-        if get_file_status(file_meta) == "active":
-            active_public_files.append(file_meta)
-
-    # Sort by createdAt desc
-    active_public_files.sort(key=lambda x: x["createdAt"], reverse=True)
-
-    total_files = len(active_public_files)
+    # Public active files come pre-sorted by createdAt from the backend
+    now = now_us()
+    total_files = state.count_public_files(now)
     start = (page - 1) * limit
-    end = start + limit
-    paginated = active_public_files[start:end]
+    paginated = state.list_public_files(now, start, limit)
 
     serialized = []
     for f in paginated:
         serialized.append(
             {
-                "fileid": f["id"],
-                "filename": f["filename"],
-                "owner": f["ownerEmail"],
-                "haspassword": f["passwordProtected"],
-                "sharetoken": f["shareToken"],
+                "fileid": f.id,
+                "filename": f.filename,
+                "owner": f.owner_email,
+                "haspassword": f.password_protected,
+                "sharetoken": f.share_token,
             }
         )
 
@@ -577,7 +1132,7 @@ def get_available_files():
 
 @app.get("/api/user")
 def get_user_profile():
-    token, user = get_current_user()
+    token, user = get_current_user(load=True)
     if not user:
         return jsonify({"message": "Unauthorized"}), 401
 
@@ -589,15 +1144,6 @@ def get_user_profile():
 
 
 # /admin endpoints
-policy = {
-    "id": 1,
-    "maxFileSizeMB": 50,
-    "minValidityHours": 1,
-    "maxValidityDays": 30,
-    "defaultValidityDays": 7,
-    "requirePasswordMinLength": 6,
-}
-
 UPDATABLE_FIELDS = {
     "maxFileSizeMB",
     "minValidityHours",
@@ -609,7 +1155,7 @@ UPDATABLE_FIELDS = {
 
 @app.get("/api/admin/policy")
 def get_policy():
-    return jsonify(policy), 200
+    return jsonify(state.get_policy()), 200
 
 
 @app.patch("/api/admin/policy")
@@ -619,9 +1165,8 @@ def update_policy():
     if not user or user.get("role") != "admin":
         return jsonify({"error": "Forbidden"}), 403
 
-    for key in UPDATABLE_FIELDS:
-        if key in data:
-            policy[key] = data[key]
+    changes = {key: data[key] for key in UPDATABLE_FIELDS if key in data}
+    policy = state.update_policy(changes)
 
     return jsonify(
         {
@@ -631,9 +1176,176 @@ def update_policy():
     ), 200
 
 
+@app.get("/api/admin/storage")
+def get_storage_stats():
+    """
+    Blob storage usage, including the bytes saved by content deduplication.
+    """
+    token, user = get_current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "Forbidden"}), 403
+
+    return jsonify({"storage": blob_store.stats()}), 200
+
+
+@app.get("/api/admin/sessions")
+def get_session_stats():
+    """
+    Size, capacity, evictions and expirations of the session stores.
+    """
+    token, user = get_current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "Forbidden"}), 403
+
+    return jsonify(state.session_stats()), 200
+
+
+def run_cleanup():
+    """
+    Remove every expired file. The backend finds them through an index on
+    availableTo instead of scanning all files. Returns (deleted_count,
+    reclaimed_bytes).
+    """
+    deleted_count = 0
+    reclaimed_bytes = 0
+
+    for fid in state.expired_file_ids(now_us()):
+        reclaimed = remove_file(fid)
+        if reclaimed is not None:
+            reclaimed_bytes += reclaimed
+            deleted_count += 1
+
+    upload_sessions.collect_garbage()
+    return deleted_count, reclaimed_bytes
+
+
+def cleanup_sweeper(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            deleted_count, reclaimed_bytes = run_cleanup()
+        except Exception:
+            app.logger.exception("Background cleanup failed")
+            continue
+        if deleted_count:
+            app.logger.info(
+                "Background cleanup removed %d files (%d bytes)",
+                deleted_count,
+                reclaimed_bytes,
+            )
+
+
+def start_cleanup_sweeper(interval: float) -> threading.Thread:
+    thread = threading.Thread(
+        target=cleanup_sweeper, args=(interval,), name="cleanup-sweeper", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+@app.post("/api/admin/users/import")
+def import_users():
+    """
+    Bulk registration.
+    Body: { "users": [{ "username", "email", "password" | "passwordHash",
+                        "role"? }, ...] }
+    Entries are validated, then all valid ones are added in one step. The
+    result of each entry (its userId or an error) is reported by index.
+    """
+    token, user = get_current_user()
+    if not user or user.get("role") != "admin":
+        return jsonify({"error": "Forbidden"}), 403
+
+    data = request.get_json(silent=True) or {}
+    entries = data.get("users")
+    if not isinstance(entries, list) or not entries:
+        return jsonify(
+            {"error": "Validation error", "message": "users must be a non-empty list"}
+        ), 400
+    if len(entries) > MAX_IMPORT_USERS:
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": f"At most {MAX_IMPORT_USERS} users can be imported at once",
+            }
+        ), 400
+
+    results = []
+    candidates = []
+    for index, entry in enumerate(entries):
+        new_user, message = (
+            build_user(entry, roles=("user", "admin"), accept_hashes=True)
+            if isinstance(entry, dict)
+            else (None, "Each user must be an object")
+        )
+        if message:
+            results.append(
+                {"index": index, "error": "Validation error", "message": message}
+            )
+        else:
+            results.append({"index": index, "userId": new_user["id"]})
+            candidates.append((index, new_user))
+
+    # Plaintext passwords are hashed in one batch spread over the hash workers
+    plaintext = [
+        new_user
+        for _, new_user in candidates
+        if not is_password_hash(new_user["password"])
+    ]
+    if len(plaintext) > MAX_IMPORT_PLAINTEXT_PASSWORDS:
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": (
+                    f"At most {MAX_IMPORT_PLAINTEXT_PASSWORDS} users with a plaintext "
+                    "password can be imported at once; send passwordHash instead"
+                ),
+            }
+        ), 400
+    hashes = password_hasher.hash_many([new_user["password"] for new_user in plaintext])
+    for new_user, password_hash in zip(plaintext, hashes):
+        new_user["password"] = password_hash
+
+    conflicts = state.add_users([new_user for _, new_user in candidates])
+    for (index, new_user), conflict in zip(candidates, conflicts):
+        if conflict:
+            results[index] = {
+                "index": index,
+                "error": "Conflict",
+                "message": CONFLICT_MESSAGES[conflict],
+            }
+
+    imported = sum(1 for result in results if "userId" in result)
+    return jsonify(
+        {
+            "message": "Users imported",
+            "imported": imported,
+            "failed": len(results) - imported,
+            "results": results,
+        }
+    ), 200
+
+
+def session_sweeper(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            state.expire_sessions(now_us())
+        except Exception:
+            app.logger.exception("Session sweep failed")
+
+
+def start_session_sweeper(interval: float) -> threading.Thread:
+    thread = threading.Thread(
+        target=session_sweeper, args=(interval,), name="session-sweeper", daemon=True
+    )
+    thread.start()
+    return thread
+
+
 @app.post("/api/admin/cleanup")
 def admin_cleanup():
-    # Mock cleanup: remove expired files from 'files' dict
+    # Mock cleanup: remove expired files
     token, user = get_current_user()
 
     # Simple admin check (in prod check X-Cron-Secret too)
@@ -645,64 +1357,67 @@ def admin_cleanup():
             }
         ), 403
 
-    deleted_count = 0
-    files_to_remove = []
-    now = datetime.now(timezone.utc)
-
-    for fid, file_meta in files.items():
-        status = get_file_status(file_meta)
-        if status == "expired":
-            files_to_remove.append(fid)
-
-    for fid in files_to_remove:
-        del files[fid]
-        deleted_count += 1
+    deleted_count, reclaimed_bytes = run_cleanup()
 
     return jsonify(
         {
             "message": "Expired files removed",
             "deletedFiles": deleted_count,
+            "reclaimedBytes": reclaimed_bytes,
             "timestamp": datetime.utcnow().isoformat() + "Z",
         }
     ), 200
 
 
-@app.post("/api/files/upload")
-def upload_file():
-    token, user = get_current_user()
+def payload_too_large_response():
+    return (
+        jsonify(
+            {
+                "error": "Payload too large",
+                "message": "File size exceeds the system limit",
+                "maxFileSizeMB": state.get_policy().get("maxFileSizeMB"),
+            }
+        ),
+        413,
+    )
 
-    upload_file = request.files.get("file")
-    if not upload_file:
-        return jsonify(
-            {"error": "Validation error", "message": "File is required"}
-        ), 400
 
-    filename = secure_filename(upload_file.filename or f"upload-{uuid.uuid4().hex}")
-    data = upload_file.read()
-    size = len(data)
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    return jsonify(
+        {
+            "error": "Service unavailable",
+            "message": "Too many password checks in progress, please retry",
+        }
+    ), 503
 
-    max_bytes = policy.get("maxFileSizeMB", 50) * 1024 * 1024
-    if size > max_bytes:
-        return (
-            jsonify(
-                {
-                    "error": "Payload too large",
-                    "message": "File size exceeds the system limit",
-                    "maxFileSizeMB": policy.get("maxFileSizeMB"),
-                }
-            ),
-            413,
-        )
 
-    is_public = str(request.form.get("isPublic", "false")).lower() in (
+@app.errorhandler(RequestEntityTooLarge)
+def payload_too_large(error):
+    return payload_too_large_response()
+
+
+def max_upload_bytes() -> int:
+    return state.get_policy().get("maxFileSizeMB", 50) * 1024 * 1024
+
+
+def parse_upload_options(data, shared_with: list, user: dict):
+    """
+    Validate the sharing settings of an upload against the policy. `data` is the
+    form of a single-request upload or the JSON body of an upload session.
+    Returns (options, None, None) or (None, error_response, status_code).
+    """
+    policy = state.get_policy()
+    is_public = str(data.get("isPublic", "false")).lower() in (
         "1",
         "true",
         "yes",
         "on",
     )
-    password = request.form.get("password") or None
+    password = data.get("password") or None
     if password and len(password) < policy.get("requirePasswordMinLength", 6):
         return (
+            None,
             jsonify(
                 {
                     "error": "Validation error",
@@ -713,8 +1428,8 @@ def upload_file():
             400,
         )
 
-    available_from_raw = request.form.get("availableFrom")
-    available_to_raw = request.form.get("availableTo")
+    available_from_raw = data.get("availableFrom")
+    available_to_raw = data.get("availableTo")
     available_from = None
     available_to = None
 
@@ -736,97 +1451,342 @@ def upload_file():
             )
 
         if available_from >= available_to:
-            return jsonify(
+            return (
+                None,
+                jsonify(
+                    {
+                        "error": "Validation error",
+                        "message": "availableFrom must be before availableTo and within allowed policy window",
+                    }
+                ),
+                400,
+            )
+    except Exception:
+        return (
+            None,
+            jsonify(
                 {
                     "error": "Validation error",
-                    "message": "availableFrom must be before availableTo and within allowed policy window",
+                    "message": "Invalid datetime format, use ISO format",
                 }
-            ), 400
-    except Exception:
-        return jsonify(
-            {
-                "error": "Validation error",
-                "message": "Invalid datetime format, use ISO format",
-            }
-        ), 400
+            ),
+            400,
+        )
 
-    shared_with = request.form.getlist("sharedWith") or []
     # enable_totp is NOT in spec but implemented in mock. We'll keep it as "hidden feature" or extension.
 
     # Auth check for private
     if not is_public and not user:
-        return jsonify(
-            {
-                "error": "Unauthorized",
-                "message": "Private uploads (isPublic=false/sharedWith) require authentication",
-            }
-        ), 401
+        return (
+            None,
+            jsonify(
+                {
+                    "error": "Unauthorized",
+                    "message": "Private uploads (isPublic=false/sharedWith) require authentication",
+                }
+            ),
+            401,
+        )
+
+    options = {
+        "isPublic": is_public,
+        # Only the hash is kept, also while a resumable upload is in progress
+        "password": password_hasher.hash(password) if password else None,
+        "availableFrom": available_from,
+        "availableTo": available_to,
+        "sharedWith": shared_with,
+    }
+    return options, None, None
+
 
+def create_file_record(
+    filename: str, size: int, blob_key: str, sha256: str, options: dict, user: dict
+) -> FileRecord:
+    """
+    Register a stored blob as a new shared file and initialize its stats.
+    """
     file_id = str(uuid.uuid4())
     share_token = file_id
     owner_email = user.get("email") if user else None
     share_link = f"http://localhost:3000/f/{share_token}"
 
-    owner_info = None
-    if user:
-        owner_info = serialize_user(user)
-
-    file_meta = {
-        "id": file_id,
-        "filename": filename,
-        "size": size,
-        "mimeType": "application/octet-stream",  # simplistic mock
-        "shareToken": share_token,
-        "ownerEmail": owner_email,
-        "owner": owner_info,
-        "isPublic": bool(is_public),
-        "passwordProtected": bool(password),
-        "password": password,  # Store password for verification
-        "availableFrom": available_from.isoformat(),
-        "availableTo": available_to.isoformat(),
-        "sharedWith": shared_with,
-        "shareLink": share_link,
-        "createdAt": datetime.now(timezone.utc).isoformat(),
-        # "totpEnabled": bool(enable_totp), # remove extra field
-    }
+    created_at = now_us()
+    available_from = to_epoch_us(options["availableFrom"])
+    available_to = to_epoch_us(options["availableTo"])
+    file_meta = FileRecord(
+        id=file_id,
+        filename=filename,
+        size=size,
+        blob_key=blob_key,
+        sha256=sha256,
+        mime_type="application/octet-stream",  # simplistic mock
+        share_token=share_token,
+        owner_email=owner_email,
+        is_public=bool(options["isPublic"]),
+        password=options["password"],  # scrypt hash, see passwords.py
+        available_from=available_from,
+        available_to=available_to,
+        shared_with=frozenset(options["sharedWith"]),
+        share_link=share_link,
+        created_at=created_at,
+    )
+
+    state.add_file(file_meta)
+    return file_meta
 
-    files[file_id] = file_meta
 
-    # Initialize stats
-    file_stats[file_id] = {
-        "downloadCount": 0,
-        "uniqueDownloaders": set(),
-        "lastDownloadedAt": None,
+def remove_file(file_id: str) -> int | None:
+    """
+    Drop a file with its stats and history, and release its blob. Returns the
+    number of blob bytes reclaimed, or None if the file was already gone.
+    """
+    file_meta = state.remove_file(file_id)
+    access_decisions.invalidate(file_id)
+    if file_meta is None:
+        return None
+    return blob_store.release(file_meta.blob_key)
+
+
+def file_uploaded_response(file_meta: FileRecord):
+    return jsonify(
+        {
+            "success": True,
+            "message": "File uploaded successfully",
+            "file": serialize_file_meta(file_meta),
+        }
+    ), 201
+
+
+@app.post("/api/files/upload")
+def upload_file():
+    token, user = get_current_user()
+
+    # Enforce the size limit while the body streams in, never after
+    request.max_upload_bytes = max_upload_bytes()
+    upload_file = request.files.get("file")
+    if not upload_file:
+        return jsonify(
+            {"error": "Validation error", "message": "File is required"}
+        ), 400
+
+    filename = secure_filename(upload_file.filename or f"upload-{uuid.uuid4().hex}")
+    # Size was counted by UploadSpool while the part streamed in
+    spool = upload_file.stream
+    size = spool.size
+
+    shared_with = request.form.getlist("sharedWith") or []
+    options, error_response, status_code = parse_upload_options(
+        request.form, shared_with, user
+    )
+    if error_response:
+        return error_response, status_code
+
+    file_meta = create_file_record(
+        filename, size, spool.commit(), spool.sha256, options, user
+    )
+    return file_uploaded_response(file_meta)
+
+
+def serialize_upload_session(session) -> dict:
+    expires_at = datetime.fromtimestamp(
+        upload_sessions.expires_at(session), timezone.utc
+    )
+    return {
+        "uploadId": session.id,
+        "fileName": session.filename,
+        "size": session.size,
+        "chunkSize": session.chunk_size,
+        "totalChunks": session.total_chunks,
+        "receivedChunks": sorted(session.received),
+        "expiresAt": expires_at.isoformat(),
     }
-    download_history[file_id] = []
+
+
+def get_upload_session(upload_id: str, user: dict):
+    """
+    Look up an upload session the current user may write to.
+    Returns (session, None, None) or (None, error_response, status_code).
+    """
+    session = upload_sessions.get(upload_id)
+    if not session:
+        return (
+            None,
+            jsonify(
+                {
+                    "error": "Not found",
+                    "message": "Upload session not found or expired",
+                }
+            ),
+            404,
+        )
+
+    if session.owner_email and (not user or user["email"] != session.owner_email):
+        return (
+            None,
+            jsonify(
+                {
+                    "error": "Forbidden",
+                    "message": "Upload session belongs to another user",
+                }
+            ),
+            403,
+        )
+
+    return session, None, None
+
+
+@app.post("/api/files/uploads")
+def create_upload_session():
+    """
+    Start a resumable upload. Policy checks run here, before any bytes arrive.
+    Body: { "fileName": string, "size": int, "chunkSize"?: int, "isPublic",
+            "password", "availableFrom", "availableTo", "sharedWith" }
+    """
+    token, user = get_current_user()
+    data = request.get_json(silent=True) or {}
+
+    try:
+        size = int(data.get("size"))
+        chunk_size = int(data.get("chunkSize") or UPLOAD_CHUNK_SIZE)
+    except (TypeError, ValueError):
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": "size and chunkSize must be integers",
+            }
+        ), 400
+
+    if size < 0:
+        return jsonify(
+            {"error": "Validation error", "message": "size must not be negative"}
+        ), 400
+
+    if size > max_upload_bytes():
+        return payload_too_large_response()
+
+    shared_with = data.get("sharedWith") or []
+    if isinstance(shared_with, str):
+        shared_with = [shared_with]
+    options, error_response, status_code = parse_upload_options(data, shared_with, user)
+    if error_response:
+        return error_response, status_code
+
+    chunk_size = min(max(chunk_size, MIN_UPLOAD_CHUNK_SIZE), MAX_UPLOAD_CHUNK_SIZE)
+    filename = secure_filename(data.get("fileName") or f"upload-{uuid.uuid4().hex}")
+    session = upload_sessions.create(
+        user["email"] if user else None, filename, size, chunk_size, options
+    )
 
     return jsonify(
-        {"success": True, "message": "File uploaded successfully", "file": file_meta}
+        {
+            "upload": serialize_upload_session(session),
+            "message": "Upload session created",
+        }
     ), 201
 
 
+@app.get("/api/files/uploads/<string:upload_id>")
+def get_upload_status(upload_id: str):
+    """
+    Upload progress, used by clients to resume after a reconnect.
+    """
+    token, user = get_current_user()
+    session, error_response, status_code = get_upload_session(upload_id, user)
+    if error_response:
+        return error_response, status_code
+
+    return jsonify({"upload": serialize_upload_session(session)}), 200
+
+
+@app.put("/api/files/uploads/<string:upload_id>/chunks/<int:index>")
+def upload_chunk(upload_id: str, index: int):
+    """
+    Store one chunk. Body: raw bytes of chunk `index` (0-based). Chunks may be
+    sent in any order and in parallel; resending a chunk overwrites it.
+    """
+    token, user = get_current_user()
+    session, error_response, status_code = get_upload_session(upload_id, user)
+    if error_response:
+        return error_response, status_code
+
+    try:
+        upload_sessions.write_chunk(
+            session, index, request.stream, request.content_length
+        )
+    except ChunkError as e:
+        return jsonify({"error": "Validation error", "message": str(e)}), 400
+
+    return jsonify(
+        {
+            "uploadId": session.id,
+            "index": index,
+            "receivedChunks": len(session.received),
+            "totalChunks": session.total_chunks,
+        }
+    ), 200
+
+
+@app.post("/api/files/uploads/<string:upload_id>/complete")
+def complete_upload(upload_id: str):
+    """
+    Assemble the uploaded chunks into a shared file.
+    """
+    token, user = get_current_user()
+    session, error_response, status_code = get_upload_session(upload_id, user)
+    if error_response:
+        return error_response, status_code
+
+    missing = session.missing_chunks()
+    if missing:
+        return jsonify(
+            {
+                "error": "Conflict",
+                "message": "Upload is missing chunks",
+                "missingChunks": missing,
+            }
+        ), 409
+
+    try:
+        blob_key, sha256 = upload_sessions.complete(session)
+    except ChunkError as e:
+        return jsonify({"error": "Conflict", "message": str(e)}), 409
+
+    file_meta = create_file_record(
+        session.filename,
+        session.size,
+        blob_key,
+        sha256,
+        session.options,
+        user if session.owner_email else None,
+    )
+    return file_uploaded_response(file_meta)
+
+
+@app.delete("/api/files/uploads/<string:upload_id>")
+def abort_upload(upload_id: str):
+    token, user = get_current_user()
+    session, error_response, status_code = get_upload_session(upload_id, user)
+    if error_response:
+        return error_response, status_code
+
+    upload_sessions.abort(session)
+    return jsonify({"message": "Upload session aborted", "uploadId": upload_id}), 200
+
+
 @app.delete("/api/files/info/<string:file_id>")
 def delete_file(file_id: str):
     token, user = get_current_user()
     if not user:
         return jsonify({"message": "Unauthorized"}), 401
 
-    if file_id not in files:
+    file_to_delete = state.get_file(file_id)
+    if file_to_delete is None:
         return jsonify({"message": "File not found"}), 404
 
-    file_to_delete = files[file_id]
-
-    if (
-        file_to_delete.get("ownerEmail") != user["email"]
-        and user.get("role") != "admin"
-    ):
+    if file_to_delete.owner_email != user["email"] and user.get("role") != "admin":
         return jsonify({"message": "Forbidden"}), 403
 
-    del files[file_id]
-    if file_id in file_stats:
-        del file_stats[file_id]
-    if file_id in download_history:
-        del download_history[file_id]
+    remove_file(file_id)
 
     return jsonify({"message": "File deleted successfully", "fileId": file_id}), 200
 
@@ -840,31 +1800,23 @@ def get_file_info_detailed(file_id: str):
     if not user:
         return jsonify({"message": "Unauthorized"}), 401
 
-    if file_id not in files:
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
         return jsonify({"message": "File not found"}), 404
 
-    file_meta = files[file_id]
-
     # Check permission
-    if file_meta.get("ownerEmail") != user["email"] and user.get("role") != "admin":
+    if file_meta.owner_email != user["email"] and user.get("role") != "admin":
         return jsonify({"message": "Forbidden"}), 403
 
     # Calculate hours remaining
-    status = get_file_status(file_meta)
-    hours_remaining = 0
-    if file_meta.get("availableTo"):
-        to_date = datetime.fromisoformat(file_meta["availableTo"])
-        now = datetime.now(timezone.utc)
-        diff = to_date - now
-        hours_remaining = max(0, diff.total_seconds() / 3600)
-
-    # Copy and enhance
-    response_file = file_meta.copy()
+    now = now_us()
+    status = file_meta.status(now)
+    hours_remaining = max(0, (file_meta.available_to - now) / US_PER_HOUR)
+
+    # Don't show password in response even to owner? Spec doesn't say. Usually no.
+    response_file = serialize_file_meta(file_meta)
     response_file["status"] = status
     response_file["hoursRemaining"] = hours_remaining
-    # Don't show password in response even to owner? Spec doesn't say. Usually no.
-    if "password" in response_file:
-        del response_file["password"]
 
     return jsonify({"file": response_file}), 200
 
@@ -877,10 +1829,9 @@ def get_file_info_public(share_token: str):
     # In our mock, share_token == file_id
     file_id = share_token
 
-    if file_id not in files:
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
         return jsonify({"error": "Not found", "message": "File not found"}), 404
-
-    file_meta = files[file_id]
     status = get_file_status(file_meta)
 
     if status == "expired":
@@ -888,16 +1839,16 @@ def get_file_info_public(share_token: str):
 
     # Only return basic info
     response_file = {
-        "id": file_meta["id"],
-        "fileName": file_meta["filename"],
-        "shareToken": file_meta["shareToken"],
+        "id": file_meta.id,
+        "fileName": file_meta.filename,
+        "shareToken": file_meta.share_token,
         "status": status,
-        "isPublic": file_meta["isPublic"],
-        "hasPassword": file_meta["passwordProtected"],
-        "fileSize": file_meta["size"],
-        "mimeType": file_meta.get("mimeType"),
-        "availableFrom": file_meta.get("availableFrom"),
-        "availableTo": file_meta.get("availableTo"),
+        "isPublic": file_meta.is_public,
+        "hasPassword": file_meta.password_protected,
+        "fileSize": file_meta.size,
+        "mimeType": file_meta.mime_type,
+        "availableFrom": isoformat_us(file_meta.available_from),
+        "availableTo": isoformat_us(file_meta.available_to),
     }
 
     return jsonify({"file": response_file}), 200
@@ -907,10 +1858,79 @@ def get_file_info_public(share_token: str):
 def download_file(share_token: str):
     file_id = share_token
 
-    if file_id not in files:
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
         return jsonify({"error": "Not found", "message": "File not found"}), 404
+    token, user = get_current_user()
+    pwd_header = request.headers.get("X-File-Password")
+
+    # Access was checked when this download's token was issued
+    continued = is_download_token_valid(
+        file_meta, user, request.headers.get("X-Download-Token", "")
+    )
+    if not continued:
+        error_response, status_code = validate_file_access(file_meta, user, pwd_header)
+        if error_response:
+            return error_response, status_code
+
+    ranges = requested_ranges(file_meta)
+    etag, last_modified = blob_validators(file_meta)
+    # Requests continuing a download with its token, revalidations answered
+    # with 304 and HEADs are not new downloads. Range and If-Range alone do
+    # not make a request a continuation: the ETag is the content hash, which
+    # anyone may know, and bytes=0- fetches the whole file.
+    not_modified = not is_resource_modified(
+        request.environ, etag, last_modified=last_modified
+    )
+    if not continued and not not_modified and request.method != "HEAD":
+        record_download(file_meta, user)
+
+    response = send_blob(
+        file_meta, "application/octet-stream", as_attachment=True, ranges=ranges
+    )
+    if not continued:
+        expires = min(
+            int(time.time()) + DOWNLOAD_TOKEN_TTL_SECONDS,
+            file_meta.available_to // 1_000_000,
+        )
+        response.headers["X-Download-Token"] = download_token(file_meta, user, expires)
+    return response
+
+
+def download_token(file_meta: FileRecord, user: dict, expires: int) -> str:
+    """
+    Token naming one user's download of one file's current contents, valid
+    until `expires` (epoch seconds).
+    """
+    email = user["email"] if user else ""
+    message = f"{expires}\n{file_meta.id}\n{file_meta.sha256}\n{email}"
+    digest = hmac.new(
+        PRESIGNED_URL_SECRET.encode("utf-8"), message.encode("utf-8"), "sha256"
+    )
+    return f"{expires}.{b64url_encode(digest.digest())}"
+
+
+def is_download_token_valid(file_meta: FileRecord, user: dict, token: str) -> bool:
+    expires, _, _ = token.partition(".")
+    if not expires.isdigit() or int(expires) <= time.time():
+        return False
+    return hmac.compare_digest(token, download_token(file_meta, user, int(expires)))
+
 
-    file_meta = files[file_id]
+@app.post("/api/files/<string:share_token>/download-url")
+def create_download_url(share_token: str):
+    """
+    Short-lived URL of a file that is served after only a signature check, by
+    presigned_download() or by nginx. Access is checked once, here, and the
+    download is counted here, since serving the URL never looks the file up.
+    Body (optional): expiresIn (seconds), bindClient (only the requesting
+    client address may use the URL)
+    """
+    file_id = share_token
+
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
+        return jsonify({"error": "Not found", "message": "File not found"}), 404
     token, user = get_current_user()
     pwd_header = request.headers.get("X-File-Password")
 
@@ -918,49 +1938,122 @@ def download_file(share_token: str):
     if error_response:
         return error_response, status_code
 
-    # Log stats
-    if file_id in file_stats:
-        file_stats[file_id]["downloadCount"] += 1
-        file_stats[file_id]["lastDownloadedAt"] = datetime.now(timezone.utc).isoformat()
-        if user:
-            file_stats[file_id]["uniqueDownloaders"].add(user["email"])
-
-    # Log history
-    if file_id in download_history:
-        downloader_info = None
-        if user:
-            downloader_info = {"username": user["username"], "email": user["email"]}
-
-        download_history[file_id].insert(
-            0,
+    data = request.get_json(silent=True) or {}
+    try:
+        expires_in = int(data.get("expiresIn", PRESIGNED_URL_TTL_SECONDS))
+    except (TypeError, ValueError):
+        expires_in = 0
+    if not 0 < expires_in <= PRESIGNED_URL_MAX_TTL_SECONDS:
+        return jsonify(
             {
-                "id": str(uuid.uuid4()),
-                "downloader": downloader_info,
-                "downloadedAt": datetime.now(timezone.utc).isoformat(),
-                "downloadCompleted": True,
-            },
-        )
+                "error": "Validation error",
+                "message": f"expiresIn must be between 1 and {PRESIGNED_URL_MAX_TTL_SECONDS} seconds",
+            }
+        ), 400
 
-    # Return dummy file content
-    dummy_content = f"This is the content of file {file_meta['filename']}".encode(
-        "utf-8"
+    # A URL never outlives the file's availability window
+    now = now_us()
+    expires = min(now // 1_000_000 + expires_in, file_meta.available_to // 1_000_000)
+    client = request_client_address() if data.get("bindClient") else None
+    if client == "":
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": "The client address is unknown, so the URL cannot be bound to it",
+            }
+        ), 400
+    path = download_urls.path(
+        file_meta.id, blob_store.relative_path(file_meta.blob_key), file_meta.filename
     )
+    record_download(file_meta, user)
+
+    return jsonify(
+        {
+            "url": download_urls.url(path, expires, client),
+            "expiresAt": isoformat_us(expires * 1_000_000),
+        }
+    ), 201
+
+
+@app.get("/api/dl/<string:file_id>/<path:blob_path>/<string:download_name>")
+def presigned_download(file_id: str, blob_path: str, download_name: str):
+    """
+    Fast path for URLs from create_download_url(): an HMAC check and the blob,
+    with no session, file or access lookups. nginx serves the same URLs itself
+    with PRESIGNED_URL_SIGNATURE=md5 (see nginx.conf).
+    """
+    client = request_client_address() if request.args.get("bind") == "1" else None
+    if not download_urls.verify(
+        request.path,
+        request.args.get("expires", ""),
+        request.args.get("sig", ""),
+        client,
+    ):
+        return jsonify(
+            {"error": "Forbidden", "message": "Invalid or expired download link"}
+        ), 403
+
+    # The blob key is the last part of its path, and also its content hash
+    key = blob_path.rsplit("/", 1)[-1]
+    path = blob_store.path(key)
+    if not os.path.isfile(path):
+        return jsonify({"error": "Not found", "message": "File not found"}), 404
+
+    if BLOB_ACCEL_REDIRECT_PREFIX:
+        response = app.response_class(mimetype="application/octet-stream")
+        response.headers["X-Accel-Redirect"] = (
+            BLOB_ACCEL_REDIRECT_PREFIX + blob_store.relative_path(key)
+        )
+        response.headers.set(
+            "Content-Disposition", "attachment", filename=download_name
+        )
+        return response
     return send_file(
-        io.BytesIO(dummy_content),
+        path,
         mimetype="application/octet-stream",
         as_attachment=True,
-        download_name=file_meta["filename"],
+        download_name=download_name,
+        etag=key,
     )
 
 
+def request_client_address() -> str:
+    if PRESIGNED_URL_CLIENT_HEADER:
+        return request.headers.get(PRESIGNED_URL_CLIENT_HEADER, "")
+    return request.remote_addr or ""
+
+
+def get_downloader_key(user: dict) -> str | None:
+    """
+    Identity used to count unique downloaders: the user's email, or for
+    anonymous downloads (when enabled) a hashed client fingerprint.
+    """
+    if user:
+        return user["email"]
+    if not COUNT_ANONYMOUS_DOWNLOADERS:
+        return None
+    client = f"{request.remote_addr}|{request.user_agent.string}".encode("utf-8")
+    digest = hashlib.blake2b(client, key=FINGERPRINT_SALT, digest_size=16)
+    return "anon:" + digest.hexdigest()
+
+
+def record_download(file_meta: FileRecord, user: dict):
+    downloader = None
+    if user:
+        downloader = {"username": user["username"], "email": user["email"]}
+
+    # Only queues the event; stats, history and rollups are updated in the
+    # background
+    state.record_download(file_meta, now_us(), get_downloader_key(user), downloader)
+
+
 @app.get("/api/files/<string:share_token>/preview")
 def preview_file(share_token: str):
     file_id = share_token
 
-    if file_id not in files:
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
         return jsonify({"error": "Not found", "message": "File not found"}), 404
-
-    file_meta = files[file_id]
     token, user = get_current_user()
     pwd_header = request.headers.get("X-File-Password")
 
@@ -968,45 +2061,125 @@ def preview_file(share_token: str):
     if error_response:
         return error_response, status_code
 
-    dummy_content = f"Preview of file {file_meta['filename']}".encode("utf-8")
-
-    return send_file(
-        io.BytesIO(dummy_content),
-        mimetype=file_meta.get("mimeType", "application/octet-stream"),
+    return send_blob(
+        file_meta,
+        file_meta.mime_type or "application/octet-stream",
         as_attachment=False,
-        download_name=file_meta["filename"],
+        ranges=requested_ranges(file_meta),
     )
 
 
+@app.get("/api/files/stats/timeline")
+def get_download_timeline():
+    """
+    Downloads per time bucket, for one file or summed over all of the current
+    user's files. Cost is proportional to the number of buckets.
+    Query: from, to (ISO, default the last 24 hours), bucket (minute|hour|day),
+           fileId (optional)
+    """
+    token, user = get_current_user()
+    if not user:
+        return jsonify({"message": "Unauthorized"}), 401
+
+    bucket = request.args.get("bucket", "hour")
+    if bucket not in DownloadRollup.RESOLUTIONS:
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": "bucket must be one of minute, hour, day",
+            }
+        ), 400
+
+    try:
+        to_raw = request.args.get("to")
+        from_raw = request.args.get("from")
+        end = now_us() // 1_000_000
+        if to_raw:
+            end = to_epoch_us(datetime.fromisoformat(to_raw.replace("Z", "+00:00")))
+            end //= 1_000_000
+        start = end - 24 * 3600
+        if from_raw:
+            start = to_epoch_us(datetime.fromisoformat(from_raw.replace("Z", "+00:00")))
+            start //= 1_000_000
+    except ValueError:
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": "Invalid datetime format, use ISO format",
+            }
+        ), 400
+
+    width = DownloadRollup.RESOLUTIONS[bucket][0]
+    first_bucket = start // width
+    bucket_count = (end - 1) // width - first_bucket + 1
+    if start >= end:
+        return jsonify(
+            {"error": "Validation error", "message": "from must be before to"}
+        ), 400
+    if bucket_count > MAX_TIMELINE_BUCKETS:
+        return jsonify(
+            {
+                "error": "Validation error",
+                "message": "Time range has too many buckets",
+                "maxBuckets": MAX_TIMELINE_BUCKETS,
+            }
+        ), 400
+
+    file_id = request.args.get("fileId")
+    if file_id:
+        file_meta = state.get_file(file_id)
+        if file_meta is None:
+            return jsonify({"message": "File not found"}), 404
+        if file_meta.owner_email != user["email"] and user.get("role") != "admin":
+            return jsonify({"message": "Forbidden"}), 403
+        counts = state.download_series("file", file_id, bucket, start, end)
+    else:
+        counts = state.download_series("owner", user["email"], bucket, start, end)
+
+    buckets = [
+        {
+            "start": isoformat_us((first_bucket + i) * width * 1_000_000),
+            "downloads": count,
+        }
+        for i, count in enumerate(counts)
+    ]
+
+    return jsonify(
+        {
+            "fileId": file_id,
+            "bucket": bucket,
+            "from": isoformat_us(start * 1_000_000),
+            "to": isoformat_us(end * 1_000_000),
+            "totalDownloads": sum(counts),
+            "buckets": buckets,
+        }
+    ), 200
+
+
 @app.get("/api/files/stats/<string:file_id>")
 def get_file_stats(file_id: str):
     token, user = get_current_user()
     if not user:
         return jsonify({"message": "Unauthorized"}), 401
 
-    if file_id not in files:
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
         return jsonify({"message": "File not found"}), 404
-
-    file_meta = files[file_id]
-    if file_meta.get("ownerEmail") != user["email"] and user.get("role") != "admin":
+    if file_meta.owner_email != user["email"] and user.get("role") != "admin":
         return jsonify({"message": "Forbidden"}), 403
 
-    if file_meta.get("ownerEmail") is None:  # Anonymous upload
+    if file_meta.owner_email is None:  # Anonymous upload
         return jsonify(
             {"message": "Statistics not available for anonymous uploads"}
         ), 404
 
-    stats = file_stats.get(file_id, {})
+    statistics = state.get_stats(file_id)
+    statistics["createdAt"] = isoformat_us(file_meta.created_at)
 
     response = {
         "fileId": file_id,
-        "fileName": file_meta["filename"],
-        "statistics": {
-            "downloadCount": stats.get("downloadCount", 0),
-            "uniqueDownloaders": len(stats.get("uniqueDownloaders", set())),
-            "lastDownloadedAt": stats.get("lastDownloadedAt"),
-            "createdAt": file_meta["createdAt"],
-        },
+        "fileName": file_meta.filename,
+        "statistics": statistics,
     }
     return jsonify(response), 200
 
@@ -1017,37 +2190,40 @@ def get_download_history(file_id: str):
     if not user:
         return jsonify({"message": "Unauthorized"}), 401
 
-    if file_id not in files:
+    file_meta = state.get_file(file_id)
+    if file_meta is None:
         return jsonify({"message": "File not found"}), 404
-
-    file_meta = files[file_id]
-    if file_meta.get("ownerEmail") != user["email"] and user.get("role") != "admin":
+    if file_meta.owner_email != user["email"] and user.get("role") != "admin":
         return jsonify({"message": "Forbidden"}), 403
 
-    history = download_history.get(file_id, [])
-
-    # Pagination
+    # Pagination, newest first
     page = int(request.args.get("page", 1))
     limit = int(request.args.get("limit", 50))
 
+    total_records = state.count_downloads(file_id)
     start = (page - 1) * limit
-    end = start + limit
-    paginated_history = history[start:end]
+    paginated_history = state.download_history(file_id, start, limit)
 
     response = {
         "fileId": file_id,
-        "fileName": file_meta["filename"],
+        "fileName": file_meta.filename,
         "history": paginated_history,
         "pagination": {
             "currentPage": page,
-            "totalPages": (len(history) + limit - 1) // limit,
-            "totalRecords": len(history),
+            "totalPages": (total_records + limit - 1) // limit,
+            "totalRecords": total_records,
             "limit": limit,
         },
     }
     return jsonify(response), 200
 
 
+if CLEANUP_INTERVAL_SECONDS > 0:
+    start_cleanup_sweeper(CLEANUP_INTERVAL_SECONDS)
+if SESSION_SWEEP_INTERVAL_SECONDS > 0:
+    start_session_sweeper(SESSION_SWEEP_INTERVAL_SECONDS)
+
+
 if __name__ == "__main__":
     # For local dev only
     app.run(host="0.0.0.0", port=8080, debug=True)
@@ -0,0 +1,121 @@
+"""
+Bounded stores for login sessions and logins waiting for a TOTP code.
+
+An entry expires `absolute_ttl` seconds after it was created, or `idle_ttl`
+seconds after it was last used, whichever comes first (0 disables either).
+Expired entries are dropped when looked up and by sweep(); past `capacity`
+entries, the least recently used one is evicted.
+
+Entries are kept in two OrderedDicts: one in creation order and one in
+last-use order. The oldest entries of each are always at the front, so
+a sweep only touches entries that have actually expired.
+"""
+
+import threading
+from collections import OrderedDict
+
+US_PER_SECOND = 1_000_000
+
+
+class SessionEntry:
+    __slots__ = ("value", "created_at", "last_seen_at")
+
+    def __init__(self, value, created_at: int):
+        self.value = value
+        self.created_at = created_at
+        self.last_seen_at = created_at
+
+
+class SessionStore:
+    """
+    Maps keys (tokens, TOTP cids) to values (emails) with expiry and LRU
+    eviction. Times are epoch microseconds. Safe to use from many threads.
+    """
+
+    def __init__(self, absolute_ttl: float = 0, idle_ttl: float = 0, capacity: int = 0):
+        self.absolute_ttl = int(absolute_ttl * US_PER_SECOND)
+        self.idle_ttl = int(idle_ttl * US_PER_SECOND)
+        self.capacity = capacity
+        # by_created[key] = SessionEntry, oldest first
+        self._by_created = OrderedDict()
+        # by_last_seen[key] = None, least recently used first
+        self._by_last_seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._by_created)
+
+    def _expired(self, entry: SessionEntry, now: int) -> bool:
+        if self.absolute_ttl and now - entry.created_at >= self.absolute_ttl:
+            return True
+        return bool(self.idle_ttl) and now - entry.last_seen_at >= self.idle_ttl
+
+    def _drop(self, key) -> None:
+        del self._by_created[key]
+        del self._by_last_seen[key]
+
+    def get(self, key, now: int):
+        """
+        The value stored under `key`, or None if missing or expired. A hit
+        counts as use for the idle TTL and the LRU order.
+        """
+        with self._lock:
+            entry = self._by_created.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                self._drop(key)
+                self.expirations += 1
+                return None
+            entry.last_seen_at = now
+            self._by_last_seen.move_to_end(key)
+            return entry.value
+
+    def put(self, key, value, now: int) -> None:
+        with self._lock:
+            if key in self._by_created:
+                self._drop(key)
+            self._by_created[key] = SessionEntry(value, now)
+            self._by_last_seen[key] = None
+            while self.capacity and len(self._by_created) > self.capacity:
+                self._drop(next(iter(self._by_last_seen)))
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._by_created.get(key)
+            if entry is None:
+                return None
+            self._drop(key)
+            return entry.value
+
+    def sweep(self, now: int) -> int:
+        """
+        Drop every expired entry. Returns how many were dropped.
+        """
+        expired = 0
+        with self._lock:
+            while self.absolute_ttl and self._by_created:
+                key, entry = next(iter(self._by_created.items()))
+                if now - entry.created_at < self.absolute_ttl:
+                    break
+                self._drop(key)
+                expired += 1
+            while self.idle_ttl and self._by_last_seen:
+                key = next(iter(self._by_last_seen))
+                if now - self._by_created[key].last_seen_at < self.idle_ttl:
+                    break
+                self._drop(key)
+                expired += 1
+            self.expirations += expired
+        return expired
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._by_created),
+            "capacity": self.capacity,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
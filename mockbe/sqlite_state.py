@@ -0,0 +1,1077 @@
+"""
+SQLite state backend.
+
+State survives restarts and can be shared by several processes on one host.
+The database runs in WAL mode so readers never block the writer. Every query
+is a fixed SQL string with bound parameters, so each pooled connection
+prepares a statement once and reuses it from its statement cache.
+
+Download events are buffered and written in batches: one transaction inserts
+the history rows and applies the per-file and per-bucket counter increments,
+coalesced, instead of several small transactions per download.
+
+Blob reference counts, resumable upload sessions and login sessions are kept
+here too, so every worker process sharing the database and blob directory
+sees them.
+
+Each file row stores its last known status, and owner_counters keeps every
+owner's number of files in each status, like StatusTracker does in memory.
+Transitions that came due are applied before counters are read; finding
+them is an index probe, so owner summaries never scan the owner's files.
+"""
+
+import json
+import queue
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from blobstore import ReferenceCounts
+from downloads import DownloadQueue
+from indexes import StatusTracker
+from records import FileRecord, isoformat_us, now_us
+from sessions import US_PER_SECOND
+from state import StateBackend, username_key
+from stats import DownloadRollup
+from uploads import UploadRegistry, UploadSession
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    username_key TEXT NOT NULL,
+    password TEXT NOT NULL,
+    role TEXT NOT NULL DEFAULT 'user',
+    totp_enabled INTEGER NOT NULL DEFAULT 0,
+    totp_secret TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_key ON users (username_key);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    last_seen_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created_at);
+CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen_at);
+
+CREATE TABLE IF NOT EXISTS totp_sessions (
+    cid TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    last_seen_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS totp_sessions_created ON totp_sessions (created_at);
+CREATE INDEX IF NOT EXISTS totp_sessions_last_seen
+    ON totp_sessions (last_seen_at);
+
+CREATE TABLE IF NOT EXISTS session_counters (
+    store TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (store, name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    jti TEXT PRIMARY KEY,
+    expires_at INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS policy (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    filename_key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    blob_key TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    share_token TEXT NOT NULL,
+    owner_email TEXT,
+    is_public INTEGER NOT NULL,
+    password TEXT,
+    available_from INTEGER NOT NULL,
+    available_to INTEGER NOT NULL,
+    shared_with TEXT NOT NULL,
+    share_link TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    download_count INTEGER NOT NULL DEFAULT 0,
+    last_downloaded_at INTEGER,
+    status TEXT NOT NULL DEFAULT 'active'
+);
+CREATE INDEX IF NOT EXISTS files_owner_created
+    ON files (owner_email, created_at, id);
+CREATE INDEX IF NOT EXISTS files_owner_filename
+    ON files (owner_email, filename_key, id);
+CREATE INDEX IF NOT EXISTS files_available_to ON files (available_to);
+CREATE INDEX IF NOT EXISTS files_public_created ON files (created_at, id)
+    WHERE is_public = 1 AND shared_with = '[]';
+CREATE INDEX IF NOT EXISTS files_pending_from ON files (available_from)
+    WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS files_unexpired_to ON files (available_to)
+    WHERE status != 'expired';
+
+CREATE TABLE IF NOT EXISTS owner_counters (
+    owner_email TEXT PRIMARY KEY,
+    active_files INTEGER NOT NULL DEFAULT 0,
+    pending_files INTEGER NOT NULL DEFAULT 0,
+    expired_files INTEGER NOT NULL DEFAULT 0,
+    deleted_files INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS downloads (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    downloaded_at INTEGER NOT NULL,
+    username TEXT,
+    email TEXT
+);
+CREATE INDEX IF NOT EXISTS downloads_file ON downloads (file_id);
+
+CREATE TABLE IF NOT EXISTS file_downloaders (
+    file_id TEXT NOT NULL,
+    downloader_key TEXT NOT NULL,
+    PRIMARY KEY (file_id, downloader_key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS download_rollups (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    downloads INTEGER NOT NULL,
+    PRIMARY KEY (scope, key, resolution, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS download_rollups_age
+    ON download_rollups (resolution, bucket);
+
+CREATE TABLE IF NOT EXISTS blob_refs (
+    key TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    owner_email TEXT,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    options TEXT NOT NULL,
+    staging_path TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    touched_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    upload_id TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    PRIMARY KEY (upload_id, chunk)
+) WITHOUT ROWID;
+"""
+
+FILE_COLUMNS = (
+    "id, filename, size, blob_key, sha256, mime_type, share_token, owner_email, "
+    "is_public, password, available_from, available_to, shared_with, share_link, "
+    "created_at"
+)
+USER_COLUMNS = "id, email, username, password, role, totp_enabled, totp_secret"
+USER_VALUES = f"""
+({USER_COLUMNS}, username_key)
+VALUES (:id, :email, :username, :password, :role, :totp_enabled, :totp_secret,
+        :username_key)
+"""
+
+# Columns whose uniqueness add_users() reports as a conflict
+USER_UNIQUE_COLUMNS = ("users.email", "users.username", "users.username_key")
+
+# Conditions matching StatusTracker.status_at / FileRecord.status
+STATUS_CONDITIONS = {
+    "active": "available_from <= :now AND available_to >= :now",
+    "pending": "available_from > :now",
+    "expired": "available_to < :now",
+}
+SORT_COLUMNS = {"createdAt": "created_at", "fileName": "filename_key"}
+# owner_counters column of each stored status
+STATUS_COUNTERS = {
+    "active": "active_files",
+    "pending": "pending_files",
+    "expired": "expired_files",
+}
+# Files whose stored status is behind `:now`; each half is served by one of
+# the partial indexes files_pending_from and files_unexpired_to
+DUE_TRANSITIONS = """
+SELECT id, owner_email, status, available_from, available_to FROM files
+WHERE status = 'pending' AND available_from <= :now
+UNION
+SELECT id, owner_email, status, available_from, available_to FROM files
+WHERE status != 'expired' AND available_to < :now
+"""
+
+INSERT_DOWNLOAD = """
+INSERT INTO downloads (id, file_id, downloaded_at, username, email)
+SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM files WHERE id = ?)
+"""
+UPDATE_FILE_DOWNLOADS = """
+UPDATE files
+SET download_count = download_count + ?,
+    last_downloaded_at = MAX(COALESCE(last_downloaded_at, 0), ?)
+WHERE id = ?
+"""
+INSERT_DOWNLOADER = """
+INSERT OR IGNORE INTO file_downloaders (file_id, downloader_key)
+SELECT ?, ? WHERE EXISTS (SELECT 1 FROM files WHERE id = ?)
+"""
+UPSERT_ROLLUP = """
+INSERT INTO download_rollups (scope, key, resolution, bucket, downloads)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (scope, key, resolution, bucket)
+DO UPDATE SET downloads = downloads + excluded.downloads
+"""
+
+
+def user_from_row(row) -> dict | None:
+    if row is None:
+        return None
+    user = dict(row)
+    user["totp_enabled"] = bool(user["totp_enabled"])
+    return user
+
+
+def file_from_row(row) -> FileRecord | None:
+    if row is None:
+        return None
+    return FileRecord(
+        id=row["id"],
+        filename=row["filename"],
+        size=row["size"],
+        blob_key=row["blob_key"],
+        sha256=row["sha256"],
+        mime_type=row["mime_type"],
+        share_token=row["share_token"],
+        owner_email=row["owner_email"],
+        is_public=bool(row["is_public"]),
+        password=row["password"],
+        available_from=row["available_from"],
+        available_to=row["available_to"],
+        shared_with=frozenset(json.loads(row["shared_with"])),
+        share_link=row["share_link"],
+        created_at=row["created_at"],
+    )
+
+
+class SQLiteBackend(StateBackend):
+    """
+    State in a SQLite database at `path`. Seed users and policy values are
+    only inserted when missing, so changes made at runtime are kept.
+
+    Download events are queued and written in one transaction per batch of up
+    to `batch_size`, at least every `flush_interval` seconds and before any
+    read of download stats.
+
+    `session_limits` and `totp_session_limits` are (absolute_ttl, idle_ttl,
+    capacity), as for MemoryBackend.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        seed_users: list = (),
+        policy: dict | None = None,
+        batch_size: int = 256,
+        flush_interval: float = 1.0,
+        session_limits: tuple = (0, 0, 0),
+        totp_session_limits: tuple = (0, 0, 0),
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self._pool = queue.SimpleQueue()
+
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            with conn:
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO users {USER_VALUES}",
+                    [
+                        dict(user, username_key=username_key(user["username"]))
+                        for user in seed_users
+                    ],
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO policy (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(value)) for key, value in (policy or {}).items()],
+                )
+                for table in ("sessions", "totp_sessions"):
+                    # Recounted on every start, so the size counter is right
+                    # even after the table was edited by hand
+                    conn.execute(
+                        "INSERT INTO session_counters (store, name, value) "
+                        f"SELECT ?, 'size', COUNT(*) FROM {table} WHERE true "
+                        "ON CONFLICT (store, name) DO UPDATE SET value = excluded.value",
+                        (table,),
+                    )
+
+        self.sessions = SQLiteSessionStore(self, "sessions", "token", *session_limits)
+        self.totp_sessions = SQLiteSessionStore(
+            self, "totp_sessions", "cid", *totp_session_limits
+        )
+
+        self.downloads = DownloadQueue(self.apply_downloads, batch_size, flush_interval)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """
+        A connection from the pool, returned to it afterwards. Connections are
+        only ever used by one thread at a time.
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def _query_one(self, sql: str, params=()):
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def _query_all(self, sql: str, params=()) -> list:
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _write(self, sql: str, params=()) -> None:
+        with self._connection() as conn, conn:
+            conn.execute(sql, params)
+
+    def get_user(self, email):
+        return user_from_row(
+            self._query_one(
+                f"SELECT {USER_COLUMNS} FROM users WHERE email = ?", (email,)
+            )
+        )
+
+    def get_user_by_id(self, user_id):
+        return user_from_row(
+            self._query_one(
+                f"SELECT {USER_COLUMNS} FROM users WHERE id = ?", (user_id,)
+            )
+        )
+
+    def find_user_by_username(self, username):
+        return user_from_row(
+            self._query_one(
+                f"SELECT {USER_COLUMNS} FROM users WHERE username_key = ?",
+                (username_key(username),),
+            )
+        )
+
+    def add_users(self, users):
+        results = []
+        with self._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for user in users:
+                # The unique indexes on email and username_key decide; a failed
+                # insert only undoes itself, not the rest of the batch
+                try:
+                    conn.execute(
+                        f"INSERT INTO users {USER_VALUES}",
+                        dict(user, username_key=username_key(user["username"])),
+                    )
+                except sqlite3.IntegrityError as error:
+                    column = str(error).rpartition(" ")[2]
+                    if column not in USER_UNIQUE_COLUMNS:
+                        raise
+                    # Like MemoryBackend, a taken email is reported first
+                    taken = conn.execute(
+                        "SELECT 1 FROM users WHERE email = ?", (user["email"],)
+                    ).fetchone()
+                    results.append("email" if taken else "username")
+                else:
+                    results.append(None)
+        return results
+
+    def save_user(self, user):
+        self._write(
+            "UPDATE users SET username = :username, username_key = :username_key, "
+            "password = :password, role = :role, totp_enabled = :totp_enabled, "
+            "totp_secret = :totp_secret WHERE email = :email",
+            dict(user, username_key=username_key(user["username"])),
+        )
+
+    def get_session(self, token):
+        return self.sessions.get(token, now_us())
+
+    def add_session(self, token, email):
+        self.sessions.put(token, email, now_us())
+
+    def remove_session(self, token):
+        self.sessions.pop(token)
+
+    def get_totp_session(self, cid):
+        return self.totp_sessions.get(cid, now_us())
+
+    def add_totp_session(self, cid, email):
+        self.totp_sessions.put(cid, email, now_us())
+
+    def remove_totp_session(self, cid):
+        self.totp_sessions.pop(cid)
+
+    def expire_sessions(self, now):
+        return self.sessions.sweep(now) + self.totp_sessions.sweep(now)
+
+    def session_stats(self):
+        return {
+            "sessions": self.sessions.stats(),
+            "totpSessions": self.totp_sessions.stats(),
+        }
+
+    def revoke_token(self, jti, expires_at):
+        self._write(
+            "INSERT OR REPLACE INTO revoked_tokens (jti, expires_at) VALUES (?, ?)",
+            (jti, expires_at),
+        )
+
+    def revoked_tokens(self, now):
+        self._write("DELETE FROM revoked_tokens WHERE expires_at <= ?", (now,))
+        rows = self._query_all("SELECT jti, expires_at FROM revoked_tokens")
+        return {row["jti"]: row["expires_at"] for row in rows}
+
+    def get_policy(self):
+        rows = self._query_all("SELECT key, value FROM policy")
+        return {row["key"]: json.loads(row["value"]) for row in rows}
+
+    def update_policy(self, changes):
+        with self._connection() as conn, conn:
+            conn.executemany(
+                "INSERT INTO policy (key, value) VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value)) for key, value in changes.items()],
+            )
+        return self.get_policy()
+
+    def get_file(self, file_id):
+        return file_from_row(
+            self._query_one(
+                f"SELECT {FILE_COLUMNS} FROM files WHERE id = ?", (file_id,)
+            )
+        )
+
+    def add_file(self, file_meta):
+        status = file_meta.status(now_us())
+        with self._connection() as conn, conn:
+            conn.execute(
+                f"INSERT INTO files ({FILE_COLUMNS}, filename_key, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    file_meta.id,
+                    file_meta.filename,
+                    file_meta.size,
+                    file_meta.blob_key,
+                    file_meta.sha256,
+                    file_meta.mime_type,
+                    file_meta.share_token,
+                    file_meta.owner_email,
+                    int(file_meta.is_public),
+                    file_meta.password,
+                    file_meta.available_from,
+                    file_meta.available_to,
+                    json.dumps(sorted(file_meta.shared_with)),
+                    file_meta.share_link,
+                    file_meta.created_at,
+                    file_meta.filename.lower(),
+                    status,
+                ),
+            )
+            if file_meta.owner_email:
+                column = STATUS_COUNTERS[status]
+                conn.execute(
+                    f"INSERT INTO owner_counters (owner_email, {column}) "
+                    "VALUES (?, 1) ON CONFLICT (owner_email) "
+                    f"DO UPDATE SET {column} = {column} + 1",
+                    (file_meta.owner_email,),
+                )
+
+    def remove_file(self, file_id):
+        # Write out queued downloads first so none land after the delete
+        self.downloads.flush()
+        with self._connection() as conn, conn:
+            # Take the write lock before reading, so when several processes
+            # remove the same file only one of them gets the record back
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT {FILE_COLUMNS}, status FROM files WHERE id = ?", (file_id,)
+            ).fetchone()
+            file_meta = file_from_row(row)
+            if file_meta is None:
+                return None
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+            conn.execute("DELETE FROM downloads WHERE file_id = ?", (file_id,))
+            conn.execute("DELETE FROM file_downloaders WHERE file_id = ?", (file_id,))
+            conn.execute(
+                "DELETE FROM download_rollups WHERE scope = 'file' AND key = ?",
+                (file_id,),
+            )
+            if file_meta.owner_email:
+                # The counter of the stored status, which advance_statuses()
+                # keeps in step with the file
+                column = STATUS_COUNTERS[row["status"]]
+                conn.execute(
+                    "INSERT INTO owner_counters (owner_email, deleted_files) "
+                    "VALUES (?, 1) ON CONFLICT (owner_email) "
+                    "DO UPDATE SET deleted_files = deleted_files + 1, "
+                    f"{column} = {column} - 1",
+                    (file_meta.owner_email,),
+                )
+        return file_meta
+
+    def advance_statuses(self, now: int) -> None:
+        """
+        Store the status of every file whose status changed by `now` and move
+        it between its owner's counters. Checking whether anything is due
+        does not take the write lock.
+        """
+        due = self._query_one(f"SELECT EXISTS ({DUE_TRANSITIONS}) AS due", {"now": now})
+        if not due["due"]:
+            return
+        with self._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            changes = []
+            # bumps[(owner, status)] = delta
+            bumps = {}
+            for row in conn.execute(DUE_TRANSITIONS, {"now": now}).fetchall():
+                status = StatusTracker.status_at(
+                    row["available_from"], row["available_to"], now
+                )
+                if status == row["status"]:
+                    continue
+                changes.append((status, row["id"]))
+                owner = row["owner_email"]
+                if owner:
+                    bumps[owner, row["status"]] = (
+                        bumps.get((owner, row["status"]), 0) - 1
+                    )
+                    bumps[owner, status] = bumps.get((owner, status), 0) + 1
+            conn.executemany("UPDATE files SET status = ? WHERE id = ?", changes)
+            for (owner, status), delta in bumps.items():
+                column = STATUS_COUNTERS[status]
+                conn.execute(
+                    f"UPDATE owner_counters SET {column} = {column} + ? "
+                    "WHERE owner_email = ?",
+                    (delta, owner),
+                )
+
+    def owner_summary(self, owner, now):
+        self.advance_statuses(now)
+        row = self._query_one(
+            "SELECT active_files, pending_files, expired_files, deleted_files "
+            "FROM owner_counters WHERE owner_email = ?",
+            (owner,),
+        )
+        if row is None:
+            return {"active": 0, "pending": 0, "expired": 0, "deleted": 0}
+        return {
+            "active": row["active_files"],
+            "pending": row["pending_files"],
+            "expired": row["expired_files"],
+            "deleted": row["deleted_files"],
+        }
+
+    def count_owner_files(self, owner):
+        row = self._query_one(
+            "SELECT active_files + pending_files + expired_files AS total "
+            "FROM owner_counters WHERE owner_email = ?",
+            (owner,),
+        )
+        return row["total"] if row else 0
+
+    def list_owner_files(
+        self,
+        owner,
+        field,
+        descending,
+        now,
+        status=None,
+        after=None,
+        offset=0,
+        limit=20,
+    ):
+        column = SORT_COLUMNS[field]
+        direction = "DESC" if descending else "ASC"
+        conditions = ["owner_email = :owner"]
+        params = {"owner": owner, "now": now, "limit": limit, "offset": offset}
+        if status is not None:
+            conditions.append(STATUS_CONDITIONS[status])
+        if after is not None:
+            conditions.append(
+                f"({column}, id) {'<' if descending else '>'} (:after_key, :after_id)"
+            )
+            params["after_key"], params["after_id"] = after
+        rows = self._query_all(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE {' AND '.join(conditions)} "
+            f"ORDER BY {column} {direction}, id {direction} "
+            "LIMIT :limit OFFSET :offset",
+            params,
+        )
+        return [file_from_row(row) for row in rows]
+
+    def count_public_files(self, now):
+        row = self._query_one(
+            "SELECT COUNT(*) AS total FROM files "
+            "WHERE is_public = 1 AND shared_with = '[]' "
+            f"AND {STATUS_CONDITIONS['active']}",
+            {"now": now},
+        )
+        return row["total"]
+
+    def list_public_files(self, now, offset, limit):
+        rows = self._query_all(
+            f"SELECT {FILE_COLUMNS} FROM files "
+            "WHERE is_public = 1 AND shared_with = '[]' "
+            f"AND {STATUS_CONDITIONS['active']} "
+            "ORDER BY created_at DESC, id DESC LIMIT :limit OFFSET :offset",
+            {"now": now, "limit": limit, "offset": offset},
+        )
+        return [file_from_row(row) for row in rows]
+
+    def expired_file_ids(self, now):
+        self._prune_rollups(now // 1_000_000)
+        rows = self._query_all(
+            "SELECT id FROM files WHERE available_to < ? ORDER BY available_to",
+            (now,),
+        )
+        return [row["id"] for row in rows]
+
+    def _prune_rollups(self, now_seconds: int) -> None:
+        """
+        Drop buckets older than DownloadRollup keeps in memory.
+        """
+        with self._connection() as conn, conn:
+            conn.executemany(
+                "DELETE FROM download_rollups WHERE resolution = ? AND bucket <= ?",
+                [
+                    (name, now_seconds // width - size)
+                    for name, (width, size) in DownloadRollup.RESOLUTIONS.items()
+                ],
+            )
+
+    def blob_reference_counts(self):
+        return SQLiteReferenceCounts(self)
+
+    def upload_registry(self):
+        return SQLiteUploadRegistry(self)
+
+    def record_download(self, file_meta, downloaded_at, downloader_key, downloader):
+        self.downloads.push(file_meta, downloaded_at, downloader_key, downloader)
+
+    def apply_downloads(self, batch):
+        history = []
+        downloaders = []
+        rollups = {}
+        for downloads in batch:
+            file_id = downloads.file_meta.id
+            for entry_id, at, downloader in downloads.entries:
+                username = downloader["username"] if downloader else None
+                email = downloader["email"] if downloader else None
+                history.append((entry_id, file_id, at, username, email, file_id))
+            downloaders.extend(
+                (file_id, key, file_id) for key in downloads.downloader_keys
+            )
+
+            owner = downloads.file_meta.owner_email
+            scopes = [("file", file_id)] + ([("owner", owner)] if owner else [])
+            for second, count in downloads.per_second.items():
+                for name, (width, _) in DownloadRollup.RESOLUTIONS.items():
+                    for scope, scope_key in scopes:
+                        bucket = (scope, scope_key, name, second // width)
+                        rollups[bucket] = rollups.get(bucket, 0) + count
+
+        with self._connection() as conn, conn:
+            conn.executemany(INSERT_DOWNLOAD, history)
+            conn.executemany(
+                UPDATE_FILE_DOWNLOADS,
+                [
+                    (
+                        downloads.count,
+                        downloads.last_downloaded_at,
+                        downloads.file_meta.id,
+                    )
+                    for downloads in batch
+                ],
+            )
+            conn.executemany(INSERT_DOWNLOADER, downloaders)
+            conn.executemany(
+                UPSERT_ROLLUP,
+                [(*bucket, count) for bucket, count in rollups.items()],
+            )
+
+    def get_stats(self, file_id):
+        self.downloads.flush()
+        row = self._query_one(
+            "SELECT download_count, last_downloaded_at FROM files WHERE id = ?",
+            (file_id,),
+        )
+        unique = self._query_one(
+            "SELECT COUNT(*) AS total FROM file_downloaders WHERE file_id = ?",
+            (file_id,),
+        )
+        return {
+            "downloadCount": row["download_count"] if row else 0,
+            "uniqueDownloaders": unique["total"],
+            "uniqueDownloadersApproximate": False,
+            "uniqueDownloadersStdError": 0.0,
+            "lastDownloadedAt": isoformat_us(row["last_downloaded_at"])
+            if row
+            else None,
+        }
+
+    def count_downloads(self, file_id):
+        self.downloads.flush()
+        row = self._query_one(
+            "SELECT COUNT(*) AS total FROM downloads WHERE file_id = ?", (file_id,)
+        )
+        return row["total"]
+
+    def download_history(self, file_id, offset, limit):
+        self.downloads.flush()
+        rows = self._query_all(
+            "SELECT id, downloaded_at, username, email FROM downloads "
+            "WHERE file_id = ? ORDER BY seq DESC LIMIT ? OFFSET ?",
+            (file_id, limit, offset),
+        )
+        return [
+            {
+                "id": row["id"],
+                "downloader": (
+                    {"username": row["username"], "email": row["email"]}
+                    if row["email"]
+                    else None
+                ),
+                "downloadedAt": isoformat_us(row["downloaded_at"]),
+                "downloadCompleted": True,
+            }
+            for row in rows
+        ]
+
+    def download_series(self, scope, key, resolution, start, end):
+        self.downloads.flush()
+        width = DownloadRollup.RESOLUTIONS[resolution][0]
+        first = start // width
+        last = (end - 1) // width
+        rows = self._query_all(
+            "SELECT bucket, downloads FROM download_rollups "
+            "WHERE scope = ? AND key = ? AND resolution = ? "
+            "AND bucket BETWEEN ? AND ?",
+            (scope, key, resolution, first, last),
+        )
+        counts = [0] * (last - first + 1)
+        for row in rows:
+            counts[row["bucket"] - first] = row["downloads"]
+        return counts
+
+    def close(self):
+        self.downloads.close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SQLiteReferenceCounts(ReferenceCounts):
+    """
+    Blob reference counts in the blob_refs table. add() and remove() take the
+    database write lock (BEGIN IMMEDIATE) before looking at a count and keep
+    it while the blob is created or destroyed, which serializes them across
+    all processes using the database.
+    """
+
+    def __init__(self, backend: SQLiteBackend):
+        self.backend = backend
+
+    def add(self, key, create):
+        with self.backend._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            updated = conn.execute(
+                "UPDATE blob_refs SET refs = refs + 1 WHERE key = ?", (key,)
+            ).rowcount
+            if updated:
+                return False
+            conn.execute(
+                "INSERT INTO blob_refs (key, refs, size) VALUES (?, 1, ?)",
+                (key, create()),
+            )
+            return True
+
+    def remove(self, key, destroy):
+        with self.backend._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT refs, size FROM blob_refs WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return 0
+            if row["refs"] > 1:
+                conn.execute(
+                    "UPDATE blob_refs SET refs = refs - 1 WHERE key = ?", (key,)
+                )
+                return 0
+            conn.execute("DELETE FROM blob_refs WHERE key = ?", (key,))
+            destroy()
+            return row["size"]
+
+    def entries(self):
+        rows = self.backend._query_all("SELECT refs, size FROM blob_refs")
+        return [(row["refs"], row["size"]) for row in rows]
+
+
+class SQLiteUploadRegistry(UploadRegistry):
+    """
+    Upload sessions in the upload_sessions table, with one upload_chunks row
+    per received chunk.
+    """
+
+    # Option values stored as ISO strings
+    DATETIME_OPTIONS = ("availableFrom", "availableTo")
+
+    def __init__(self, backend: SQLiteBackend):
+        self.backend = backend
+
+    def put(self, session):
+        options = dict(session.options)
+        for name in self.DATETIME_OPTIONS:
+            options[name] = options[name].isoformat()
+        self.backend._write(
+            "INSERT INTO upload_sessions (id, owner_email, filename, size, "
+            "chunk_size, options, staging_path, created_at, touched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                session.id,
+                session.owner_email,
+                session.filename,
+                session.size,
+                session.chunk_size,
+                json.dumps(options),
+                session.staging_path,
+                session.created_at,
+                session.touched_at,
+            ),
+        )
+
+    def _session_from_row(self, row) -> UploadSession:
+        options = json.loads(row["options"])
+        for name in self.DATETIME_OPTIONS:
+            options[name] = datetime.fromisoformat(options[name])
+        session = UploadSession(
+            row["id"],
+            row["owner_email"],
+            row["filename"],
+            row["size"],
+            row["chunk_size"],
+            options,
+            row["staging_path"],
+        )
+        session.created_at = row["created_at"]
+        session.touched_at = row["touched_at"]
+        return session
+
+    def get(self, upload_id):
+        row = self.backend._query_one(
+            "SELECT * FROM upload_sessions WHERE id = ?", (upload_id,)
+        )
+        if row is None:
+            return None
+        session = self._session_from_row(row)
+        chunks = self.backend._query_all(
+            "SELECT chunk FROM upload_chunks WHERE upload_id = ?", (upload_id,)
+        )
+        session.received = {chunk["chunk"] for chunk in chunks}
+        return session
+
+    def mark_received(self, session, index):
+        touched_at = time.time()
+        with self.backend._connection() as conn, conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO upload_chunks (upload_id, chunk) VALUES (?, ?)",
+                (session.id, index),
+            )
+            conn.execute(
+                "UPDATE upload_sessions SET touched_at = ? WHERE id = ?",
+                (touched_at, session.id),
+            )
+            # Pick up chunks other processes stored in the meantime
+            chunks = conn.execute(
+                "SELECT chunk FROM upload_chunks WHERE upload_id = ?", (session.id,)
+            ).fetchall()
+        session.received = {chunk["chunk"] for chunk in chunks}
+        session.touched_at = touched_at
+
+    def pop(self, upload_id):
+        with self.backend._connection() as conn, conn:
+            deleted = conn.execute(
+                "DELETE FROM upload_sessions WHERE id = ?", (upload_id,)
+            ).rowcount
+            conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+        return deleted > 0
+
+    def all(self):
+        # Only used for expiry, so received chunks are not loaded
+        rows = self.backend._query_all("SELECT * FROM upload_sessions")
+        return [self._session_from_row(row) for row in rows]
+
+
+class SQLiteSessionStore:
+    """
+    SessionStore (see sessions.py) over one of the session tables. Counters,
+    including the number of entries, live in session_counters, so they cover
+    every process and checking the capacity needs no COUNT(*).
+
+    To keep lookups read-only most of the time, last_seen_at is only rewritten
+    once it is 1% of the idle TTL old (a minute without one), so an idle
+    session may expire up to that much early.
+    """
+
+    def __init__(
+        self,
+        backend: SQLiteBackend,
+        table: str,
+        key_column: str,
+        absolute_ttl: float = 0,
+        idle_ttl: float = 0,
+        capacity: int = 0,
+    ):
+        self.backend = backend
+        self.table = table
+        self.key_column = key_column
+        self.absolute_ttl = int(absolute_ttl * US_PER_SECOND)
+        self.idle_ttl = int(idle_ttl * US_PER_SECOND)
+        self.capacity = capacity
+        self.touch_interval = (
+            self.idle_ttl // 100 if self.idle_ttl else 60 * US_PER_SECOND
+        )
+
+    def _expired(self, row, now: int) -> bool:
+        if self.absolute_ttl and now - row["created_at"] >= self.absolute_ttl:
+            return True
+        return bool(self.idle_ttl) and now - row["last_seen_at"] >= self.idle_ttl
+
+    def _bump(self, conn, name: str, count: int) -> None:
+        if count:
+            conn.execute(
+                "INSERT INTO session_counters (store, name, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (store, name) DO UPDATE SET value = value + excluded.value",
+                (self.table, name, count),
+            )
+
+    def get(self, key, now: int):
+        row = self.backend._query_one(
+            f"SELECT email, created_at, last_seen_at FROM {self.table} "
+            f"WHERE {self.key_column} = ?",
+            (key,),
+        )
+        if row is None:
+            return None
+        if self._expired(row, now):
+            with self.backend._connection() as conn, conn:
+                deleted = conn.execute(
+                    f"DELETE FROM {self.table} WHERE {self.key_column} = ?", (key,)
+                ).rowcount
+                self._bump(conn, "expirations", deleted)
+                self._bump(conn, "size", -deleted)
+            return None
+        if now - row["last_seen_at"] >= self.touch_interval:
+            self.backend._write(
+                f"UPDATE {self.table} SET last_seen_at = ? WHERE {self.key_column} = ?",
+                (now, key),
+            )
+        return row["email"]
+
+    def put(self, key, value, now: int) -> None:
+        with self.backend._connection() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            replaced = conn.execute(
+                f"DELETE FROM {self.table} WHERE {self.key_column} = ?", (key,)
+            ).rowcount
+            conn.execute(
+                f"INSERT INTO {self.table} "
+                f"({self.key_column}, email, created_at, last_seen_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._bump(conn, "size", 1 - replaced)
+            if not self.capacity:
+                return
+            excess = self._size(conn) - self.capacity
+            if excess > 0:
+                evicted = conn.execute(
+                    f"DELETE FROM {self.table} WHERE {self.key_column} IN ("
+                    f"SELECT {self.key_column} FROM {self.table} "
+                    "ORDER BY last_seen_at LIMIT ?)",
+                    (excess,),
+                ).rowcount
+                self._bump(conn, "evictions", evicted)
+                self._bump(conn, "size", -evicted)
+
+    def pop(self, key):
+        with self.backend._connection() as conn, conn:
+            row = conn.execute(
+                f"DELETE FROM {self.table} WHERE {self.key_column} = ? RETURNING email",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                self._bump(conn, "size", -1)
+        return row["email"] if row else None
+
+    def sweep(self, now: int) -> int:
+        # A TTL of 0 disables its condition: nothing is older than `now`
+        created_before = now - self.absolute_ttl if self.absolute_ttl else -1
+        seen_before = now - self.idle_ttl if self.idle_ttl else -1
+        with self.backend._connection() as conn, conn:
+            expired = conn.execute(
+                f"DELETE FROM {self.table} WHERE created_at <= ? OR last_seen_at <= ?",
+                (created_before, seen_before),
+            ).rowcount
+            self._bump(conn, "expirations", expired)
+            self._bump(conn, "size", -expired)
+        return expired
+
+    def _size(self, conn) -> int:
+        row = conn.execute(
+            "SELECT value FROM session_counters WHERE store = ? AND name = 'size'",
+            (self.table,),
+        ).fetchone()
+        return row["value"] if row else 0
+
+    def stats(self) -> dict:
+        counters = {
+            row["name"]: row["value"]
+            for row in self.backend._query_all(
+                "SELECT name, value FROM session_counters WHERE store = ?",
+                (self.table,),
+            )
+        }
+        return {
+            "size": counters.get("size", 0),
+            "capacity": self.capacity,
+            "evictions": counters.get("evictions", 0),
+            "expirations": counters.get("expirations", 0),
+        }
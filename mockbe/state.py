@@ -0,0 +1,615 @@
+"""
+Application state: users, login sessions, the upload policy, file metadata and
+download statistics.
+
+Handlers only talk to a StateBackend, so the same code runs on top of plain
+in-memory structures (MemoryBackend, the default) or on a durable database
+(see sqlite_state.py).
+"""
+
+import threading
+
+from blobstore import ReferenceCounts
+from downloads import DownloadQueue
+from history import HistoryStore
+from indexes import ExpiryIndex, OwnerIndex, SortedIndex, StatusTracker
+from records import FileRecord, isoformat_us, now_us
+from sessions import SessionStore
+from stats import DownloadRollup, UniqueCounter
+from uploads import UploadRegistry
+
+
+def sort_key(file_meta: FileRecord, field: str):
+    """
+    Position of a file in an owner listing sorted by `field`.
+    """
+    if field == "fileName":
+        return file_meta.filename.lower()
+    return file_meta.created_at
+
+
+def username_key(username: str) -> str:
+    """
+    Usernames are unique regardless of case.
+    """
+    return username.casefold()
+
+
+def is_listed_publicly(file_meta: FileRecord) -> bool:
+    # Files with a sharedWith list need authentication, so they are not public
+    return file_meta.is_public and not file_meta.shared_with
+
+
+class StateBackend:
+    """
+    Interface every state backend implements. Users are plain dicts in the
+    shape of the seed users; files are FileRecords.
+    """
+
+    # Users
+
+    def get_user(self, email: str) -> dict | None:
+        raise NotImplementedError
+
+    def get_user_by_id(self, user_id: str) -> dict | None:
+        raise NotImplementedError
+
+    def find_user_by_username(self, username: str) -> dict | None:
+        """
+        The user whose username matches, ignoring case.
+        """
+        raise NotImplementedError
+
+    def add_user(self, user: dict) -> str | None:
+        """
+        Add `user` unless its email or username is taken, checked and stored
+        in one atomic step. Returns the name of the conflicting field ("email"
+        or "username"), or None once added.
+        """
+        return self.add_users([user])[0]
+
+    def add_users(self, users: list) -> list:
+        """
+        add_user() for a batch, in one step: a conflict result (or None) per
+        user. Users earlier in the batch count as taken.
+        """
+        raise NotImplementedError
+
+    def save_user(self, user: dict) -> None:
+        """
+        Persist changes made to a user dict returned by get_user().
+        """
+        raise NotImplementedError
+
+    # Login sessions and logins waiting for a TOTP code
+
+    def get_session(self, token: str) -> str | None:
+        raise NotImplementedError
+
+    def add_session(self, token: str, email: str) -> None:
+        raise NotImplementedError
+
+    def remove_session(self, token: str) -> None:
+        raise NotImplementedError
+
+    def get_totp_session(self, cid: str) -> str | None:
+        raise NotImplementedError
+
+    def add_totp_session(self, cid: str, email: str) -> None:
+        raise NotImplementedError
+
+    def remove_totp_session(self, cid: str) -> None:
+        raise NotImplementedError
+
+    def expire_sessions(self, now: int) -> int:
+        """
+        Drop expired login and TOTP sessions. Returns how many were dropped.
+        """
+        raise NotImplementedError
+
+    def session_stats(self) -> dict:
+        """
+        size, capacity, evictions and expirations of the login sessions
+        ("sessions") and of logins waiting for a TOTP code ("totpSessions").
+        """
+        raise NotImplementedError
+
+    def revoke_token(self, jti: str, expires_at: int) -> None:
+        """
+        Deny the signed token `jti` until `expires_at` (epoch seconds).
+        """
+        raise NotImplementedError
+
+    def revoked_tokens(self, now: int) -> dict:
+        """
+        revoked[jti] = expires_at of every revoked token not yet expired.
+        """
+        raise NotImplementedError
+
+    # Upload policy
+
+    def get_policy(self) -> dict:
+        raise NotImplementedError
+
+    def update_policy(self, changes: dict) -> dict:
+        raise NotImplementedError
+
+    # Files
+
+    def get_file(self, file_id: str) -> FileRecord | None:
+        raise NotImplementedError
+
+    def add_file(self, file_meta: FileRecord) -> None:
+        raise NotImplementedError
+
+    def remove_file(self, file_id: str) -> FileRecord | None:
+        """
+        Drop a file with its stats and history and count it as deleted for its
+        owner. Returns the removed record.
+        """
+        raise NotImplementedError
+
+    def owner_summary(self, owner: str, now: int) -> dict:
+        """
+        Number of the owner's files per status: active, pending, expired and
+        deleted.
+        """
+        raise NotImplementedError
+
+    def count_owner_files(self, owner: str) -> int:
+        raise NotImplementedError
+
+    def list_owner_files(
+        self,
+        owner: str,
+        field: str,
+        descending: bool,
+        now: int,
+        status: str | None = None,
+        after=None,
+        offset: int = 0,
+        limit: int = 20,
+    ) -> list:
+        """
+        Up to `limit` of an owner's FileRecords in `field` order, optionally
+        only those with `status`. `after` is a (sort_key, file_id) position
+        from a previous page.
+        """
+        raise NotImplementedError
+
+    def count_public_files(self, now: int) -> int:
+        raise NotImplementedError
+
+    def list_public_files(self, now: int, offset: int, limit: int) -> list:
+        """
+        Active public FileRecords without a sharedWith list, newest first.
+        """
+        raise NotImplementedError
+
+    def expired_file_ids(self, now: int) -> list:
+        """
+        Ids of files whose availableTo is before `now`.
+        """
+        raise NotImplementedError
+
+    def blob_reference_counts(self) -> ReferenceCounts:
+        """
+        Where the blob store keeps its reference counts.
+        """
+        raise NotImplementedError
+
+    def upload_registry(self) -> UploadRegistry:
+        """
+        Where resumable upload sessions are tracked.
+        """
+        raise NotImplementedError
+
+    # Download statistics
+
+    def record_download(
+        self,
+        file_meta: FileRecord,
+        downloaded_at: int,
+        downloader_key: str | None,
+        downloader: dict | None,
+    ) -> None:
+        """
+        Queue a download; it is applied in the background (see downloads.py).
+        """
+        raise NotImplementedError
+
+    def apply_downloads(self, batch: list) -> None:
+        """
+        Apply a batch of queued downloads, one FileDownloads per file.
+        """
+        raise NotImplementedError
+
+    def get_stats(self, file_id: str) -> dict:
+        """
+        downloadCount, uniqueDownloaders, uniqueDownloadersApproximate,
+        uniqueDownloadersStdError and lastDownloadedAt of a file.
+        """
+        raise NotImplementedError
+
+    def count_downloads(self, file_id: str) -> int:
+        raise NotImplementedError
+
+    def download_history(self, file_id: str, offset: int, limit: int) -> list:
+        """
+        History entries, newest first.
+        """
+        raise NotImplementedError
+
+    def download_series(
+        self, scope: str, key: str, resolution: str, start: int, end: int
+    ) -> list:
+        """
+        Downloads per `resolution` bucket overlapping [start, end) in epoch
+        seconds, for one file (scope "file") or an owner (scope "owner").
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """
+    Everything in process memory, with indexes kept up to date on every change
+    so listings and cleanup never scan all files. Lost on restart and not
+    shared between processes.
+
+    Safe to use from many threads. A file's stats, history and rollups are
+    guarded by one of `lock_stripes` locks picked by hashing its id (owner
+    rollups likewise by the owner's email). Downloads of different files
+    rarely share a lock, and a lock is held only for a few counter updates.
+    Downloads are queued and applied in batches of up to `batch_size`, at
+    least every `flush_interval` seconds and before any read of their stats.
+
+    `session_limits` and `totp_session_limits` are (absolute_ttl, idle_ttl,
+    capacity) of the two SessionStores.
+    """
+
+    def __init__(
+        self,
+        seed_users: list,
+        policy: dict,
+        history_dir: str,
+        history_memory_entries: int = 100,
+        hll_threshold: int = 0,
+        hll_precision: int = 12,
+        lock_stripes: int = 64,
+        batch_size: int = 256,
+        flush_interval: float = 1.0,
+        session_limits: tuple = (0, 0, 0),
+        totp_session_limits: tuple = (0, 0, 0),
+    ):
+        self.users = {user["email"]: dict(user) for user in seed_users}
+        # users_by_id[id] and usernames[username_key(username)] = the same dict
+        self.users_by_id = {user["id"]: user for user in self.users.values()}
+        self.usernames = {
+            username_key(user["username"]): user for user in self.users.values()
+        }
+        self._users_lock = threading.Lock()
+        # sessions[token] = email
+        self.sessions = SessionStore(*session_limits)
+        # totp_temp_sessions[cid] = email
+        self.totp_temp_sessions = SessionStore(*totp_session_limits)
+        # revoked[jti] = expires_at, for signed tokens
+        self.revoked = {}
+        self.policy = dict(policy)
+        self.hll_threshold = hll_threshold
+        self.hll_precision = hll_precision
+
+        # files[file_id] = FileRecord
+        self.files = {}
+        # file_stats[file_id] = { downloadCount, uniqueDownloaders: UniqueCounter, lastDownloadedAt }
+        self.file_stats = {}
+        # Download history entries { id, downloader, downloadedAt, downloadCompleted }
+        # per file; the newest history_memory_entries stay in memory
+        self.history = HistoryStore(history_dir, history_memory_entries)
+        # Downloads per minute/hour/day, per file and summed per owner
+        self.download_rollups = {}
+        self.owner_rollups = {}
+
+        # Files ordered by availableTo, so cleanup only touches expired files
+        self.expiry_index = ExpiryIndex()
+        # Each owner's files ordered by createdAt and by lowercase filename
+        self.owner_index = OwnerIndex()
+        # Per-file status and per-owner status counters
+        self.status_tracker = StatusTracker()
+        # Currently active public files without a sharedWith list, by createdAt
+        self.public_index = SortedIndex()
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        self.downloads = DownloadQueue(self.apply_downloads, batch_size, flush_interval)
+
+    def _stripe(self, key: str) -> threading.Lock:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get_user(self, email):
+        return self.users.get(email)
+
+    def get_user_by_id(self, user_id):
+        return self.users_by_id.get(user_id)
+
+    def find_user_by_username(self, username):
+        return self.usernames.get(username_key(username))
+
+    def add_users(self, users):
+        results = []
+        with self._users_lock:
+            for user in users:
+                key = username_key(user["username"])
+                if user["email"] in self.users:
+                    results.append("email")
+                elif key in self.usernames:
+                    results.append("username")
+                else:
+                    self.users[user["email"]] = user
+                    self.users_by_id[user["id"]] = user
+                    self.usernames[key] = user
+                    results.append(None)
+        return results
+
+    def save_user(self, user):
+        # get_user() hands out the stored dict, so it is already up to date
+        pass
+
+    def get_session(self, token):
+        return self.sessions.get(token, now_us())
+
+    def add_session(self, token, email):
+        self.sessions.put(token, email, now_us())
+
+    def remove_session(self, token):
+        self.sessions.pop(token)
+
+    def get_totp_session(self, cid):
+        return self.totp_temp_sessions.get(cid, now_us())
+
+    def add_totp_session(self, cid, email):
+        self.totp_temp_sessions.put(cid, email, now_us())
+
+    def remove_totp_session(self, cid):
+        self.totp_temp_sessions.pop(cid)
+
+    def expire_sessions(self, now):
+        return self.sessions.sweep(now) + self.totp_temp_sessions.sweep(now)
+
+    def session_stats(self):
+        return {
+            "sessions": self.sessions.stats(),
+            "totpSessions": self.totp_temp_sessions.stats(),
+        }
+
+    def revoke_token(self, jti, expires_at):
+        with self._lock:
+            self.revoked[jti] = expires_at
+
+    def revoked_tokens(self, now):
+        with self._lock:
+            self.revoked = {
+                jti: expires_at
+                for jti, expires_at in self.revoked.items()
+                if expires_at > now
+            }
+            return dict(self.revoked)
+
+    def get_policy(self):
+        return self.policy
+
+    def update_policy(self, changes):
+        self.policy.update(changes)
+        return self.policy
+
+    def get_file(self, file_id):
+        return self.files.get(file_id)
+
+    def add_file(self, file_meta):
+        file_id = file_meta.id
+        # Stats first, so the file is never visible without them
+        with self._stripe(file_id):
+            self.file_stats[file_id] = {
+                "downloadCount": 0,
+                "uniqueDownloaders": UniqueCounter(
+                    self.hll_threshold, self.hll_precision
+                ),
+                "lastDownloadedAt": None,
+            }
+            self.history.create(file_id)
+
+        self.files[file_id] = file_meta
+        self.expiry_index.add(file_id, file_meta.available_to)
+        self.status_tracker.add(
+            file_id,
+            file_meta.owner_email,
+            file_meta.available_from,
+            file_meta.available_to,
+            file_meta.created_at,
+        )
+        if self.status_tracker.status(file_id) == "active" and is_listed_publicly(
+            file_meta
+        ):
+            self.public_index.add(file_id, file_meta.created_at)
+        if file_meta.owner_email:
+            self.owner_index.add(
+                file_meta.owner_email,
+                file_id,
+                {
+                    field: sort_key(file_meta, field)
+                    for field in self.owner_index.fields
+                },
+            )
+
+    def remove_file(self, file_id):
+        file_meta = self.files.pop(file_id, None)
+        if file_meta is None:
+            return None
+        self.expiry_index.discard(file_id)
+        self.owner_index.discard(file_id)
+        self.status_tracker.remove(file_id)
+        self.public_index.discard(file_id)
+        with self._stripe(file_id):
+            self.file_stats.pop(file_id, None)
+            self.download_rollups.pop(file_id, None)
+            self.history.drop(file_id)
+        return file_meta
+
+    def advance(self, now: int) -> None:
+        """
+        Apply due pending/active/expired transitions and keep the public listing
+        in step with them.
+        """
+        with self._lock:
+            for file_id, status in self.status_tracker.advance(now):
+                file_meta = self.files.get(file_id)
+                if status == "active" and file_meta and is_listed_publicly(file_meta):
+                    self.public_index.add(file_id, file_meta.created_at)
+                else:
+                    self.public_index.discard(file_id)
+
+    def owner_summary(self, owner, now):
+        self.advance(now)
+        return self.status_tracker.summary(owner)
+
+    def count_owner_files(self, owner):
+        return self.owner_index.count(owner)
+
+    def list_owner_files(
+        self,
+        owner,
+        field,
+        descending,
+        now,
+        status=None,
+        after=None,
+        offset=0,
+        limit=20,
+    ):
+        self.advance(now)
+        predicate = None
+        if status is not None:
+
+            def predicate(fid):
+                return self.status_tracker.status(fid) == status
+
+        page_ids = self.owner_index.page(
+            owner,
+            field,
+            descending=descending,
+            after=after,
+            offset=offset,
+            limit=limit,
+            predicate=predicate,
+        )
+        return self._records(page_ids)
+
+    def _records(self, file_ids) -> list:
+        # A file removed since its id was read from an index is skipped
+        records = (self.files.get(fid) for fid in file_ids)
+        return [file_meta for file_meta in records if file_meta is not None]
+
+    def count_public_files(self, now):
+        self.advance(now)
+        return len(self.public_index)
+
+    def list_public_files(self, now, offset, limit):
+        self.advance(now)
+        page_ids = self.public_index.page(offset, limit, descending=True)
+        return self._records(page_ids)
+
+    def expired_file_ids(self, now):
+        self.advance(now)
+        return [fid for fid in self.expiry_index.pop_expired(now) if fid in self.files]
+
+    def blob_reference_counts(self):
+        return ReferenceCounts()
+
+    def upload_registry(self):
+        return UploadRegistry()
+
+    def record_download(self, file_meta, downloaded_at, downloader_key, downloader):
+        self.downloads.push(file_meta, downloaded_at, downloader_key, downloader)
+
+    def apply_downloads(self, batch):
+        # per_owner[email][epoch second] = downloads
+        per_owner = {}
+        for downloads in batch:
+            file_id = downloads.file_meta.id
+            with self._stripe(file_id):
+                stats = self.file_stats.get(file_id)
+                if stats is None:
+                    continue
+                stats["downloadCount"] += downloads.count
+                stats["lastDownloadedAt"] = isoformat_us(downloads.last_downloaded_at)
+                for key in downloads.downloader_keys:
+                    stats["uniqueDownloaders"].add(key)
+
+                # Time-bucketed rollups, for the file and (below) for its owner
+                rollup = self.download_rollups.get(file_id)
+                if rollup is None:
+                    rollup = self.download_rollups[file_id] = DownloadRollup()
+                for second, count in downloads.per_second.items():
+                    rollup.add(second, count)
+
+                for entry_id, downloaded_at, downloader in downloads.entries:
+                    self.history.append(
+                        file_id,
+                        {
+                            "id": entry_id,
+                            "downloader": downloader,
+                            "downloadedAt": isoformat_us(downloaded_at),
+                            "downloadCompleted": True,
+                        },
+                    )
+
+            owner = downloads.file_meta.owner_email
+            if owner:
+                seconds = per_owner.setdefault(owner, {})
+                for second, count in downloads.per_second.items():
+                    seconds[second] = seconds.get(second, 0) + count
+
+        # Only taken once the file's lock is released, so no thread ever holds
+        # two stripes
+        for owner, seconds in per_owner.items():
+            with self._stripe(owner):
+                rollup = self.owner_rollups.get(owner)
+                if rollup is None:
+                    rollup = self.owner_rollups[owner] = DownloadRollup()
+                for second, count in seconds.items():
+                    rollup.add(second, count)
+
+    def get_stats(self, file_id):
+        self.downloads.flush()
+        with self._stripe(file_id):
+            stats = self.file_stats.get(file_id, {})
+            unique_downloaders = stats.get("uniqueDownloaders") or UniqueCounter()
+            return {
+                "downloadCount": stats.get("downloadCount", 0),
+                "uniqueDownloaders": len(unique_downloaders),
+                "uniqueDownloadersApproximate": unique_downloaders.approximate,
+                "uniqueDownloadersStdError": unique_downloaders.std_error,
+                "lastDownloadedAt": stats.get("lastDownloadedAt"),
+            }
+
+    def count_downloads(self, file_id):
+        self.downloads.flush()
+        return self.history.count(file_id)
+
+    def download_history(self, file_id, offset, limit):
+        self.downloads.flush()
+        return self.history.page(file_id, offset, limit)
+
+    def download_series(self, scope, key, resolution, start, end):
+        self.downloads.flush()
+        rollups = self.download_rollups if scope == "file" else self.owner_rollups
+        with self._stripe(key):
+            rollup = rollups.get(key)
+            if rollup is not None:
+                return rollup.series(resolution, start, end)
+        width = DownloadRollup.RESOLUTIONS[resolution][0]
+        return [0] * ((end - 1) // width - start // width + 1)
+
+    def close(self):
+        self.downloads.close()
@@ -0,0 +1,165 @@
+"""
+Compact download statistics structures.
+"""
+
+import hashlib
+import math
+from array import array
+
+
+class HyperLogLog:
+    """
+    HyperLogLog cardinality sketch with 2**precision one-byte registers. The
+    relative standard error is about 1.04 / sqrt(2**precision), e.g. 1.6% for
+    the default precision of 12 (4 KiB per sketch).
+    """
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = 12):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    @property
+    def std_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, key: str) -> None:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        rest_bits = 64 - self.precision
+        index = value >> rest_bits
+        rest = value & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def __len__(self) -> int:
+        return round(self.estimate())
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Small-range correction: linear counting
+            return m * math.log(m / zeros)
+        return raw
+
+
+class UniqueCounter:
+    """
+    Counts distinct keys exactly with a set until it holds `threshold` keys,
+    then switches to a HyperLogLog sketch so memory stops growing. A threshold
+    of 0 keeps the exact set forever.
+    """
+
+    __slots__ = ("threshold", "precision", "_keys", "_sketch")
+
+    def __init__(self, threshold: int = 0, precision: int = 12):
+        self.threshold = threshold
+        self.precision = precision
+        self._keys = set()
+        self._sketch = None
+
+    @property
+    def approximate(self) -> bool:
+        return self._sketch is not None
+
+    @property
+    def std_error(self) -> float:
+        return self._sketch.std_error if self._sketch else 0.0
+
+    def add(self, key: str) -> None:
+        if self._sketch is not None:
+            self._sketch.add(key)
+            return
+
+        self._keys.add(key)
+        if self.threshold and len(self._keys) > self.threshold:
+            self._sketch = HyperLogLog(self.precision)
+            for existing in self._keys:
+                self._sketch.add(existing)
+            self._keys = None
+
+    def __len__(self) -> int:
+        if self._sketch is not None:
+            return len(self._sketch)
+        return len(self._keys)
+
+
+class RollupRing:
+    """
+    Download counts for the last `size` buckets of `width` seconds, stored in a
+    fixed-size array used as a ring. Slots are zeroed as time moves past them,
+    so old buckets never need a separate cleanup.
+    """
+
+    __slots__ = ("width", "counts", "head")
+
+    def __init__(self, width: int, size: int):
+        self.width = width
+        self.counts = array("I", [0]) * size
+        # Most recent bucket number written, or None
+        self.head = None
+
+    def add(self, timestamp: int, count: int = 1) -> None:
+        bucket = timestamp // self.width
+        size = len(self.counts)
+        if self.head is None:
+            self.head = bucket
+        elif bucket > self.head:
+            for b in range(max(self.head + 1, bucket - size + 1), bucket + 1):
+                self.counts[b % size] = 0
+            self.head = bucket
+        elif bucket <= self.head - size:
+            return
+        self.counts[bucket % size] += count
+
+    def get(self, bucket: int) -> int:
+        if (
+            self.head is None
+            or bucket > self.head
+            or bucket <= self.head - len(self.counts)
+        ):
+            return 0
+        return self.counts[bucket % len(self.counts)]
+
+
+class DownloadRollup:
+    """
+    Downloads per minute (last day), hour (last 31 days) and day (last year),
+    about 10 KiB in total. Range queries cost one array read per bucket.
+    """
+
+    # resolution -> (bucket width in seconds, number of buckets kept)
+    RESOLUTIONS = {
+        "minute": (60, 24 * 60),
+        "hour": (3600, 31 * 24),
+        "day": (86400, 366),
+    }
+
+    __slots__ = ("rings",)
+
+    def __init__(self):
+        self.rings = {
+            name: RollupRing(width, size)
+            for name, (width, size) in self.RESOLUTIONS.items()
+        }
+
+    def add(self, timestamp: int, count: int = 1) -> None:
+        for ring in self.rings.values():
+            ring.add(timestamp, count)
+
+    def series(self, resolution: str, start: int, end: int) -> list:
+        """
+        Counts for each `resolution` bucket overlapping [start, end) in epoch
+        seconds, oldest first.
+        """
+        ring = self.rings[resolution]
+        first = start // ring.width
+        last = (end - 1) // ring.width
+        return [ring.get(bucket) for bucket in range(first, last + 1)]
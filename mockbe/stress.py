@@ -0,0 +1,178 @@
+"""
+Concurrency stress test for the state backends.
+
+    python stress.py --backend memory --threads 16 --downloads 2000
+
+Many threads record downloads of a few shared files at once, while other
+threads upload, delete and list unrelated files and register users. Once
+they finish, every file's downloadCount, history length and timeline total
+must equal the number of downloads recorded for it, and the owner timeline
+must cover at least the total. The script exits non-zero if any increment was lost.
+"""
+
+import argparse
+import random
+import sys
+import tempfile
+import threading
+import uuid
+
+from records import US_PER_HOUR, FileRecord, now_us
+from sqlite_state import SQLiteBackend
+from state import MemoryBackend
+
+OWNER = "owner@example.com"
+
+
+def make_file(owner: str | None = OWNER) -> FileRecord:
+    file_id = str(uuid.uuid4())
+    now = now_us()
+    return FileRecord(
+        id=file_id,
+        filename=f"{file_id}.bin",
+        size=1,
+        blob_key="0" * 64,
+        sha256="0" * 64,
+        mime_type="application/octet-stream",
+        share_token=file_id,
+        owner_email=owner,
+        is_public=True,
+        password=None,
+        available_from=now - US_PER_HOUR,
+        available_to=now + US_PER_HOUR,
+        shared_with=frozenset(),
+        share_link=f"http://localhost:3000/f/{file_id}",
+        created_at=now,
+    )
+
+
+def make_backend(name: str, directory: str):
+    owner = {
+        "id": str(uuid.uuid4()),
+        "username": "owner",
+        "email": OWNER,
+        "password": "owner@123",
+        "role": "user",
+        "totp_enabled": False,
+        "totp_secret": None,
+    }
+    if name == "sqlite":
+        return SQLiteBackend(f"{directory}/stress.sqlite3", [owner], {}, batch_size=64)
+    # A small in-memory tail makes histories spill to disk during the run
+    return MemoryBackend([owner], {}, f"{directory}/history", 16)
+
+
+def downloader(backend, files, counts, lock, downloads: int, seed: int):
+    rng = random.Random(seed)
+    local = {}
+    for i in range(downloads):
+        file_meta = rng.choice(files)
+        user = f"user{rng.randrange(50)}@example.com"
+        backend.record_download(
+            file_meta, now_us(), user, {"username": user.split("@")[0], "email": user}
+        )
+        local[file_meta.id] = local.get(file_meta.id, 0) + 1
+    with lock:
+        for file_id, count in local.items():
+            counts[file_id] = counts.get(file_id, 0) + count
+
+
+def churner(backend, stop: threading.Event, seed: int):
+    """
+    Upload, download, list and delete unrelated files, and register users.
+    """
+    rng = random.Random(seed)
+    while not stop.is_set():
+        file_meta = make_file(rng.choice([OWNER, None]))
+        backend.add_file(file_meta)
+        backend.record_download(file_meta, now_us(), None, None)
+        backend.list_owner_files(OWNER, "createdAt", True, now_us(), limit=5)
+        backend.list_public_files(now_us(), 0, 5)
+        backend.remove_file(file_meta.id)
+        name = uuid.uuid4().hex[:12]
+        backend.add_user(
+            {
+                "id": str(uuid.uuid4()),
+                "username": name,
+                "email": f"{name}@example.com",
+                "password": "password",
+                "role": "user",
+                "totp_enabled": False,
+                "totp_secret": None,
+            }
+        )
+        backend.find_user_by_username(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--churn-threads", type=int, default=2)
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--downloads", type=int, default=2000)
+    args = parser.parse_args()
+
+    # Switch threads as often as possible to shake out races
+    sys.setswitchinterval(1e-6)
+
+    backend = make_backend(args.backend, tempfile.mkdtemp(prefix="mockbe-stress-"))
+    files = [make_file() for _ in range(args.files)]
+    for file_meta in files:
+        backend.add_file(file_meta)
+
+    counts = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    churners = [
+        threading.Thread(target=churner, args=(backend, stop, seed))
+        for seed in range(args.churn_threads)
+    ]
+    workers = [
+        threading.Thread(
+            target=downloader,
+            args=(backend, files, counts, lock, args.downloads, 1000 + seed),
+        )
+        for seed in range(args.threads)
+    ]
+    for thread in churners + workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stop.set()
+    for thread in churners:
+        thread.join()
+
+    sys.setswitchinterval(0.005)
+    end = now_us() // 1_000_000 + 1
+    start = end - 24 * 3600
+    failures = 0
+    for file_meta in files:
+        expected = counts.get(file_meta.id, 0)
+        stats = backend.get_stats(file_meta.id)
+        history = backend.count_downloads(file_meta.id)
+        timeline = sum(backend.download_series("file", file_meta.id, "day", start, end))
+        ok = stats["downloadCount"] == history == timeline == expected
+        failures += not ok
+        print(
+            f"{file_meta.id[:8]} expected={expected} count={stats['downloadCount']} "
+            f"history={history} timeline={timeline} "
+            f"unique={stats['uniqueDownloaders']} {'ok' if ok else 'LOST'}"
+        )
+
+    total = sum(counts.values())
+    owner_total = sum(backend.download_series("owner", OWNER, "day", start, end))
+    # Churned files of the same owner add their own single downloads
+    if owner_total < total:
+        failures += 1
+    print(f"owner timeline={owner_total} (at least {total})")
+
+    backend.close()
+    if failures:
+        print(f"FAILED: {failures} counters lost increments")
+        sys.exit(1)
+    print("OK: no lost increments")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+TOTP enrollment payloads: the otpauth:// provisioning URI of a secret and a QR
+code of it as a data: URI.
+
+QR codes are rendered with segno (see requirements.txt); where it is not
+installed every secret gets the placeholder image in assets/. Rendering is the
+slow part, so results are kept in an LRU cache keyed by (secret, account), and
+can be computed on a small thread pool so at most that many renders run at
+once. Concurrent requests for the same secret share one render. The
+placeholder is not cached: it costs nothing to return.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+try:
+    import segno
+except ImportError:
+    segno = None
+
+PLACEHOLDER_PATH = os.path.join(
+    os.path.dirname(__file__), "assets", "totp-qr-placeholder.txt"
+)
+
+_placeholder = None
+
+
+def placeholder_qr_code() -> str:
+    """
+    The static QR image, read from disk on first use.
+    """
+    global _placeholder
+    if _placeholder is None:
+        with open(PLACEHOLDER_PATH, encoding="ascii") as file:
+            _placeholder = file.read().strip()
+    return _placeholder
+
+
+def provisioning_uri(secret: str, account: str, issuer: str) -> str:
+    label = quote(f"{issuer}:{account}", safe=":@")
+    query = urlencode({"secret": secret.rstrip("="), "issuer": issuer})
+    return f"otpauth://totp/{label}?{query}"
+
+
+def render_qr_code(uri: str) -> str:
+    if segno is None:
+        return placeholder_qr_code()
+    return segno.make(uri, error="m").png_data_uri(scale=5)
+
+
+class QrCodeCache:
+    """
+    QR codes of provisioning URIs, at most `size` of them, least recently used
+    dropped first. With `threads` > 0 renders run on a pool of that many
+    threads instead of in the calling one.
+    """
+
+    def __init__(self, issuer: str, size: int = 1024, threads: int = 0):
+        self.issuer = issuer
+        self.size = size
+        # entries[(secret, account)] = Future of the data: URI
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = (
+            ThreadPoolExecutor(max_workers=threads, thread_name_prefix="totp-qr")
+            if threads > 0
+            else None
+        )
+
+    def qr_code(self, secret: str, account: str) -> str:
+        if segno is None:
+            return placeholder_qr_code()
+        key = (secret, account)
+        with self._lock:
+            future = self._entries.get(key)
+            owner = future is None
+            if owner:
+                future = self._entries[key] = Future()
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+
+        # Rendered outside the lock, by the first request for this key; later
+        # ones wait on its future
+        if owner:
+            uri = provisioning_uri(secret, account, self.issuer)
+            try:
+                if self._executor is not None:
+                    qr_code = self._executor.submit(render_qr_code, uri).result()
+                else:
+                    qr_code = render_qr_code(uri)
+                future.set_result(qr_code)
+            except Exception as error:
+                # A failed render is not cached, so the next request retries
+                with self._lock:
+                    if self._entries.get(key) is future:
+                        del self._entries[key]
+                future.set_exception(error)
+        return future.result()
+
+    def setup_payload(self, secret: str, account: str) -> dict:
+        return {
+            "secret": secret,
+            "qrCode": self.qr_code(secret, account),
+            "provisioningUri": provisioning_uri(secret, account, self.issuer),
+        }
@@ -0,0 +1,204 @@
+"""
+Resumable upload sessions.
+
+A session is created once with the final size and sharing settings (so policy
+checks happen up front), then receives numbered chunks in any order, possibly
+in parallel, and is finally committed into the blob store. Chunks are written
+at their offset in a preallocated staging file, so a client that reconnects
+only needs to resend the chunks missing from `received`.
+
+Sessions are tracked by an UploadRegistry: in process memory by default, or in
+the state database so chunks of one upload can arrive at different processes.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+
+from blobstore import COPY_CHUNK_SIZE
+
+
+class ChunkError(Exception):
+    pass
+
+
+class UploadSession:
+    def __init__(
+        self,
+        upload_id: str,
+        owner_email: str | None,
+        filename: str,
+        size: int,
+        chunk_size: int,
+        options: dict,
+        staging_path: str,
+    ):
+        self.id = upload_id
+        self.owner_email = owner_email
+        self.filename = filename
+        self.size = size
+        self.chunk_size = chunk_size
+        self.total_chunks = max(1, -(-size // chunk_size))
+        self.options = options
+        self.staging_path = staging_path
+        self.received = set()
+        self.created_at = time.time()
+        self.touched_at = self.created_at
+
+    def chunk_length(self, index: int) -> int:
+        if index == self.total_chunks - 1:
+            return self.size - index * self.chunk_size
+        return self.chunk_size
+
+    def missing_chunks(self) -> list:
+        return [i for i in range(self.total_chunks) if i not in self.received]
+
+
+class UploadRegistry:
+    """
+    In-memory registry of upload sessions.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def put(self, session: UploadSession) -> None:
+        with self._lock:
+            self.sessions[session.id] = session
+
+    def get(self, upload_id: str) -> UploadSession | None:
+        return self.sessions.get(upload_id)
+
+    def mark_received(self, session: UploadSession, index: int) -> None:
+        with self._lock:
+            session.received.add(index)
+            session.touched_at = time.time()
+
+    def pop(self, upload_id: str) -> bool:
+        """
+        Forget a session. Returns False if it was already gone, so only one
+        caller gets to complete or abort it.
+        """
+        with self._lock:
+            return self.sessions.pop(upload_id, None) is not None
+
+    def all(self) -> list:
+        with self._lock:
+            return list(self.sessions.values())
+
+
+class UploadSessionStore:
+    """
+    Upload sessions backed by staging files in a blob store. Sessions idle for
+    longer than `ttl_seconds` are garbage-collected together with their staging
+    file.
+    """
+
+    def __init__(self, blob_store, ttl_seconds: int, registry: UploadRegistry = None):
+        self.blob_store = blob_store
+        self.ttl_seconds = ttl_seconds
+        self.registry = registry if registry is not None else UploadRegistry()
+
+    def create(
+        self,
+        owner_email: str | None,
+        filename: str,
+        size: int,
+        chunk_size: int,
+        options: dict,
+    ) -> UploadSession:
+        self.collect_garbage()
+
+        with self.blob_store.open_staging() as staging:
+            staging.truncate(size)
+        session = UploadSession(
+            uuid.uuid4().hex,
+            owner_email,
+            filename,
+            size,
+            chunk_size,
+            options,
+            staging.name,
+        )
+        self.registry.put(session)
+        return session
+
+    def get(self, upload_id: str) -> UploadSession | None:
+        session = self.registry.get(upload_id)
+        if session and self._is_expired(session, time.time()):
+            self.abort(session)
+            return None
+        return session
+
+    def write_chunk(
+        self,
+        session: UploadSession,
+        index: int,
+        stream,
+        content_length: int | None = None,
+    ) -> None:
+        """
+        Copy one chunk from `stream` to its offset in the staging file. Raises
+        ChunkError if the index is out of range or the length is wrong; a bad
+        Content-Length is rejected before any of the body is read.
+        """
+        if index < 0 or index >= session.total_chunks:
+            raise ChunkError("Chunk index out of range")
+
+        expected = session.chunk_length(index)
+        if content_length is not None and content_length != expected:
+            raise ChunkError(f"Chunk {index} must be {expected} bytes")
+
+        written = 0
+        with open(session.staging_path, "r+b") as staging:
+            staging.seek(index * session.chunk_size)
+            while True:
+                data = stream.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                written += len(data)
+                if written > expected:
+                    raise ChunkError("Chunk is larger than expected")
+                staging.write(data)
+
+        if written != expected:
+            raise ChunkError("Chunk is smaller than expected")
+
+        self.registry.mark_received(session, index)
+
+    def complete(self, session: UploadSession):
+        """
+        Hash the assembled staging file and commit it to the blob store.
+        Returns (blob_key, sha256). The caller checks missing_chunks() first.
+        """
+        if not self.registry.pop(session.id):
+            raise ChunkError("Upload session already completed")
+
+        digest = hashlib.sha256()
+        with open(session.staging_path, "rb") as staging:
+            while data := staging.read(COPY_CHUNK_SIZE):
+                digest.update(data)
+        sha256 = digest.hexdigest()
+        return self.blob_store.commit(session.staging_path, sha256), sha256
+
+    def abort(self, session: UploadSession) -> None:
+        self.registry.pop(session.id)
+        self.blob_store.discard(session.staging_path)
+
+    def collect_garbage(self) -> int:
+        """
+        Drop sessions idle for longer than the TTL. Returns how many were removed.
+        """
+        now = time.time()
+        expired = [s for s in self.registry.all() if self._is_expired(s, now)]
+        for session in expired:
+            self.abort(session)
+        return len(expired)
+
+    def expires_at(self, session: UploadSession) -> float:
+        return session.touched_at + self.ttl_seconds
+
+    def _is_expired(self, session: UploadSession, now: float) -> bool:
+        return now > self.expires_at(session)
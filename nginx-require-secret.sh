@@ -0,0 +1,11 @@
+#!/bin/sh
+# Run by the nginx image's entrypoint before it renders the config template.
+# The presigned download location checks signatures against
+# PRESIGNED_URL_SECRET; rendered empty, anyone who knows a blob path could
+# sign their own download URLs, so nginx is not started without it.
+set -eu
+
+if [ -z "${PRESIGNED_URL_SECRET:-}" ]; then
+    echo "$0: PRESIGNED_URL_SECRET is not set (see example.env); refusing to start" >&2
+    exit 1
+fi